@@ -6,41 +6,74 @@ import os.path as osp
 import re
 import logging
 import time
-from .zfs import ZfsPoolHealth
+import threading
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from .zfs import ZfsPoolHealth, ZfsInventory, ZfsName, ZfsSnapshot, isPoolBusyError
+from .cmdrunner import ProcessError
 from .snapshots import BackupSnapshot, BackupSnapshots
+from .relay import BufferRelay
+from .throttle import RateLimiter
+from .plan import TransferStep, FsPlan, BackupSetPlan
 from .typeOps import asNameStrOrNone, asStrOrEmpty, currentGmtTimeStr
 logger = logging.getLogger()
 
 class BackupRecorder(object):
-    "record history of backups in a file"
+    """record history of backups in a file, records maybe written from multiple threads.
+    An existing file with a different header is renamed, so each file has one set of columns"""
 
-    header = ("time", "backupSet", "backupPool", "action", "src1Snap", "src2Snap", "backupSnap", "size", "exception", "info")
+    header = ("time", "backupSet", "backupPool", "action", "src1Snap", "src2Snap", "backupSnap", "size", "exception", "info", "sendOpts", "estSize", "secs")
 
     def __init__(self, recordTsvFile, outFh=None):
         "if recordTsvFile or outFh can be  None made"
         self.recordTsvFh = None
         self.outFh = outFh
+        self.lock = threading.Lock()
         if recordTsvFile is not None:
             if not osp.exists(osp.dirname(recordTsvFile)):
                 os.makedirs(osp.dirname(recordTsvFile))
+            self._rotateChangedHeader(recordTsvFile)
             self.recordTsvFh = open(recordTsvFile, "a", buffering=1)  # line buffered
         self._writeHeader()
 
+    def _headerLine(self):
+        return "\t".join(self.header) + "\n"
+
+    def _rotateChangedHeader(self, recordTsvFile):
+        "rename an existing file with a different header to the first unused recordTsvFile.N"
+        try:
+            with open(recordTsvFile) as fh:
+                headerLine = fh.readline()
+        except FileNotFoundError:
+            return
+        if headerLine in ("", self._headerLine()):
+            return
+        n = 1
+        while osp.exists("{}.{}".format(recordTsvFile, n)):
+            n += 1
+        logger.warning("record file {} has different columns, renamed to {}.{}".format(recordTsvFile, recordTsvFile, n))
+        os.rename(recordTsvFile, "{}.{}".format(recordTsvFile, n))
+
     def _writeHeader(self):
-        headerLine = "\t".join(self.header) + "\n"
+        headerLine = self._headerLine()
         if (self.recordTsvFh is not None) and (self.recordTsvFh.tell() == 0):
             self.recordTsvFh.write(headerLine)  # file is empty, write header
         if self.outFh is not None:
             self.outFh.write(headerLine)
 
-    def record(self, backupSet, backupPool, action, src1Snap=None, src2Snap=None, backupSnap=None, size=None, exception=None, info=None):
-        rec = (currentGmtTimeStr(), asNameStrOrNone(backupSet), asNameStrOrNone(backupPool), action, asStrOrEmpty(src1Snap), asStrOrEmpty(src2Snap), asStrOrEmpty(backupSnap), asStrOrEmpty(size), asStrOrEmpty(exception), asStrOrEmpty(info))
+    def record(self, backupSet, backupPool, action, src1Snap=None, src2Snap=None, backupSnap=None, size=None, exception=None, info=None,
+               sendOpts=None, estSize=None, secs=None):
+        """sendOpts is a sequence of zfs send options, estSize is the estimated size of a send
+        and secs the time it took"""
+        rec = (currentGmtTimeStr(), asNameStrOrNone(backupSet), asNameStrOrNone(backupPool), action, asStrOrEmpty(src1Snap), asStrOrEmpty(src2Snap), asStrOrEmpty(backupSnap), asStrOrEmpty(size), asStrOrEmpty(exception), asStrOrEmpty(info),
+               " ".join(sendOpts) if sendOpts is not None else "", asStrOrEmpty(estSize), "{:.1f}".format(secs) if secs is not None else "")
         line = "\t".join(rec) + "\n"
-        if self.recordTsvFh is not None:
-            self.recordTsvFh.write(line)
-        if self.outFh is not None:
-            self.outFh.write(line)
-            self.outFh.flush()
+        with self.lock:
+            if self.recordTsvFh is not None:
+                self.recordTsvFh.write(line)
+            if self.outFh is not None:
+                self.outFh.write(line)
+                self.outFh.flush()
 
     def error(self, backupSet, backupPool, exception, src1Snap=None, src2Snap=None, backupSnap=None):
         # make sure there are no newlines or tabs
@@ -65,33 +98,274 @@ class BackupError(Exception):
     "Backup error"
     pass
 
+class BackupSetFailures(BackupError):
+    "one or more file systems in a backup set failed, failures is a list of (sourceFileSystemName, exception)"
+    def __init__(self, backupSetConf, failures, fileSystemCount):
+        self.failures = tuple(failures)
+        msgs = ["{}: {}".format(fsName, ex) for fsName, ex in self.failures]
+        super(BackupSetFailures, self).__init__("backup of {} of {} file systems in backup set {} failed:\n    {}"
+                                                .format(len(self.failures), fileSystemCount, backupSetConf.name, "\n    ".join(msgs)))
+
+class StreamLimiter(object):
+    """Limits the number of concurrent send streams from each source pool.  One
+    object is shared by all backup sets in a run.  If maxStreamsPerPool is None,
+    the number of streams is not limited."""
+    def __init__(self, maxStreamsPerPool=None):
+        if (maxStreamsPerPool is not None) and (maxStreamsPerPool < 1):
+            raise ValueError("maximum streams per pool must be at least 1, got {}".format(maxStreamsPerPool))
+        self.maxStreamsPerPool = maxStreamsPerPool
+        self.lock = threading.Lock()
+        self.semaphores = {}  # by pool name
+
+    def _obtainSemaphore(self, poolName):
+        with self.lock:
+            semaphore = self.semaphores.get(poolName)
+            if semaphore is None:
+                semaphore = self.semaphores[poolName] = threading.BoundedSemaphore(self.maxStreamsPerPool)
+            return semaphore
+
+    @contextmanager
+    def stream(self, sourcePoolName):
+        "context manager that waits for a free stream slot on the pool"
+        if self.maxStreamsPerPool is None:
+            yield
+        else:
+            with self._obtainSemaphore(sourcePoolName):
+                yield
+
 class FsBackup(object):
-    "backup one file system (args are objects, not names).  backupPool is None for snapOnly "
-    def __init__(self, zfs, recorder, backupSetConf, sourceFileSystem, backupPool):
+    """backup one file system (args are objects, not names).  backupPool is None for snapOnly.
+    A backup is done in two phases, plan() determines the sends needed without
+    moving any data and execute() runs them."""
+    # relay buffer used for rate limiting when the pool doesn't configure one
+    throttleBufferSize = 16 * 1024 * 1024
+
+    def __init__(self, zfs, recorder, backupSetConf, sourceFileSystem, backupPool, inventory=None, *, streamLimiter=None,
+                 abortIncomplete=False, progressReporter=None, newSourceSnapshot=None, rateLimiters=()):
+        """
+        inventory - ZfsInventory shared by all FsBackup objects of a run, one is created if not specified
+        streamLimiter - StreamLimiter shared by all backup sets of a run, defaults to no limits
+        abortIncomplete - discard an interrupted receive into the backup file system rather than resuming it
+        progressReporter - if not None, progress.ProgressReporter used to report the progress of sends
+        newSourceSnapshot - if not None, BackupSnapshot of the new source snapshot, already created by the
+          backup set, otherwise one is created when the sends are executed
+        rateLimiters - throttle.RateLimiter objects applied to each send
+        """
         self.zfs = zfs
         self.recorder = recorder
         self.backupSetConf = backupSetConf
+        self.inventory = inventory if inventory is not None else ZfsInventory(zfs)
+        self.streamLimiter = streamLimiter if streamLimiter is not None else StreamLimiter()
+        self.abortIncomplete = abortIncomplete
+        self.progressReporter = progressReporter
+        self.rateLimiters = tuple(rateLimiters)
 
         # backup source
         self.sourceFileSystem = sourceFileSystem
-        self.sourceSnapshots = BackupSnapshots(zfs, sourceFileSystem)
+        self.sourcePoolName = ZfsName(sourceFileSystem.name).pool
+        self.sourceSnapshots = BackupSnapshots(self.inventory, sourceFileSystem)
+        self.newSourceSnapshot = newSourceSnapshot
+        if newSourceSnapshot is not None:
+            # planned as the snapshot to create, not an existing one
+            self.sourceSnapshots.remove(newSourceSnapshot)
 
         # backup target
         self.backupPool = backupPool
         if backupPool is not None:
-            self.backupFileSystemName = backupSetConf.getBackupPoolConf(backupPool.name).determineBackupFileSystemName(sourceFileSystem)
+            self.backupPoolConf = backupSetConf.getBackupPoolConf(backupPool.name)
+            self.backupFileSystemName = self.backupPoolConf.determineBackupFileSystemName(sourceFileSystem)
+            self.sendOptions = backupSetConf.getSendOptions(sourceFileSystem.name, backupPool.name)
 
         self.backupFileSystem = None
         self.backupSnapshots = None
+        self.resumeToken = None
+        self.discardResume = False  # interrupted receive is to be discarded
+        self.steps = None
+        self.transferSecs = None
+
+    @contextmanager
+    def _recordingErrors(self):
+        "log and record an exception before passing it on"
+        try:
+            yield
+        except Exception as ex:
+            logger.exception("backup of {} to {} failed"
+                             .format(self.backupSetConf.name, self.sourceFileSystem.name))
+            self.recorder.error(self.backupSetConf, self.backupPool, ex, self.sourceFileSystem.name)
+            raise
 
-    def _setupBackupPoolFs(self):
-        "Create the file system if it doesn't exist"
+    def _findBackupPoolFs(self):
+        "find the backup file system and any interrupted receive, no changes are made"
         self.backupFileSystem = self.zfs.findFileSystem(self.backupFileSystemName)
-        if self.backupFileSystem is None:
-            self.backupFileSystem = self.zfs.createFileSystem(self.backupFileSystemName)
-        self.backupSnapshots = BackupSnapshots(self.zfs, self.backupFileSystem)
+        self.backupSnapshots = BackupSnapshots(self.inventory, self.backupFileSystem)
+        self.resumeToken = None
+        if self.backupFileSystem is not None:
+            self.resumeToken = self.zfs.getResumeToken(self.backupFileSystem)
+
+    def _planResume(self):
+        """plan resuming an interrupted receive, which is dry-run to find the snapshot being sent.
+        The receive is stale if that snapshot is no longer a source snapshot or is not newer than
+        the newest snapshot already on the backup, in which case None is returned and the
+        receive is aborted when the normal sends are executed"""
+        try:
+            prevSourceSnapshotName, sourceSnapshotName, size = self._parseResumeInfo(self.zfs.getResumeTokenInfo(self.resumeToken))
+        except ProcessError as ex:
+            logger.warning("can't resume interrupted receive into {}, it will be aborted: {}".format(self.backupFileSystemName, ex))
+            return None
+        sourceIdx = self.sourceSnapshots.findIdx(ZfsSnapshot(sourceSnapshotName).snapName)
+        commonSourceSnapshot = self.sourceSnapshots.findNewestCommon(self.backupSnapshots)
+        if (sourceIdx < 0) or ((commonSourceSnapshot is not None) and (sourceIdx >= self.sourceSnapshots.getIdx(commonSourceSnapshot))):
+            logger.warning("interrupted receive into {} is of {}, which is not a source snapshot to be sent, it will be aborted"
+                           .format(self.backupFileSystemName, sourceSnapshotName))
+            return None
+        prevSourceSnapshot = BackupSnapshot.createFromSnapshotName(prevSourceSnapshotName) if prevSourceSnapshotName is not None else None
+        return TransferStep("resume", prevSourceSnapshot, self.sourceSnapshots[sourceIdx], int(size))
+
+    def _planIncrs(self, commonSourceSnapshot):
+        "plan sending all source snapshots after commonSourceSnapshot and a new snapshot"
+        if self.backupSetConf.collapseIncrementals:
+            return [TransferStep("incrRange", commonSourceSnapshot, None, None)]
+        steps = []
+        commonSourceIdx = self.sourceSnapshots.getIdx(commonSourceSnapshot)
+        for sourceIdx in range(commonSourceIdx, 0, -1):
+            steps.append(TransferStep("incr", self.sourceSnapshots[sourceIdx], self.sourceSnapshots[sourceIdx - 1], None))
+        steps.append(TransferStep("incr", self.sourceSnapshots[0], None, None))
+        return steps
+
+    def _planSteps(self):
+        "plan resuming an interrupted receive, unless abortIncomplete, followed by the sends from the newest common snapshot"
+        steps = []
+        commonSourceSnapshot = None
+        self.discardResume = (self.resumeToken is not None) and self.abortIncomplete
+        if (self.resumeToken is not None) and not self.abortIncomplete:
+            resumeStep = self._planResume()
+            if resumeStep is not None:
+                steps.append(resumeStep)
+                commonSourceSnapshot = resumeStep.sourceSnapshot
+            else:
+                self.discardResume = True
+        if len(self.sourceSnapshots) == 0:
+            # there are no source snapshots, so we just make a new snapshot and sent the whole thing
+            steps.append(TransferStep("full", None, None, None))
+            return steps
+        if commonSourceSnapshot is None:
+            commonSourceSnapshot = self.sourceSnapshots.findNewestCommon(self.backupSnapshots)
+        if commonSourceSnapshot is None:
+            # existing source snapshots, but none in common, which might be a new back pool,
+            # sync the oldest and we go from there
+            commonSourceSnapshot = self.sourceSnapshots[-1]
+            steps.append(TransferStep("full", None, commonSourceSnapshot, None))
+        return steps + self._planIncrs(commonSourceSnapshot)
+
+    def _estimateStep(self, step):
+        "estimate the stream size of a step"
+        if step.kind == "resume":
+            return step  # obtained in planning
+        if step.sourceSnapshot is None:
+            # snapshot not created yet, use data written since the base snapshot
+            if step.prevSourceSnapshot is None:
+                size = self.zfs.getIntProp(self.sourceFileSystem, "referenced")
+            else:
+                size = self.zfs.getIntProp(self.sourceFileSystem, "written@" + step.prevSourceSnapshot.getSnapName())
+        elif step.kind == "full":
+            size = self.zfs.estimateSendFull(step.sourceSnapshot.getSnapshotName(), sendOptions=self.sendOptions)
+        else:
+            size = self.zfs.estimateSendIncr(step.prevSourceSnapshot.getSnapshotName(), step.sourceSnapshot.getSnapshotName(),
+                                             sendOptions=self.sendOptions, intermediate=(step.kind == "incrRange"))
+        return step._replace(estimate=size)
+
+    def plan(self, estimate=False):
+        """Determine the sends needed to bring the backup file system up to date,
+        without changing anything, and optionally estimate their stream size.
+        Sets and returns steps, a list of TransferStep."""
+        with self._recordingErrors():
+            self._findBackupPoolFs()
+            self.steps = self._planSteps()
+            if estimate:
+                self.steps = [self._estimateStep(step) for step in self.steps]
+        return self.steps
+
+    def toPlan(self):
+        "return the planned steps as a plan.FsPlan"
+        return FsPlan(self.sourceFileSystem.name, self.backupFileSystemName, tuple(self.steps))
+
+    def usePlan(self, fsPlan):
+        """Replace the planned steps with those of a saved plan.FsPlan, so its
+        estimates are used.  The saved steps must send the same snapshots as
+        those just planned, otherwise the saved plan is out of date."""
+        if ((fsPlan.backupFileSystemName != self.backupFileSystemName) or (len(fsPlan.steps) != len(self.steps))
+                or not all([saved.sameTransfer(step) for saved, step in zip(fsPlan.steps, self.steps)])):
+            raise BackupError("saved plan for {} is out of date, the sends needed to update {} have changed"
+                              .format(self.sourceFileSystem.name, self.backupFileSystemName))
+        self.steps = list(fsPlan.steps)
+
+    def needsNewSourceSnapshot(self):
+        "do the planned steps send the new source snapshot"
+        return any([step.sourceSnapshot is None for step in self.steps])
+
+    @property
+    def estimatedSize(self):
+        "sum of the estimates of the planned steps"
+        return sum([step.estimate for step in self.steps if step.estimate is not None])
+
+    def trimSteps(self, available):
+        """drop planned steps that would not fit in available bytes, along with all
+        later steps, which depend on them.  Returns estimated size of steps that are kept"""
+        keptSize = 0
+        for idx in range(len(self.steps)):
+            if keptSize + (self.steps[idx].estimate or 0) > available:
+                for step in self.steps[idx:]:
+                    self.recorder.record(self.backupSetConf, self.backupPool, "skip",
+                                         src1Snap=step.prevSourceSnapshot.getSnapshotName() if step.prevSourceSnapshot is not None else None,
+                                         src2Snap=step.sourceSnapshot.getSnapshotName() if step.sourceSnapshot is not None else None,
+                                         info="insufficient space on backup pool for " + self.sourceFileSystem.name,
+                                         estSize=step.estimate)
+                self.steps = self.steps[0:idx]
+                break
+            keptSize += self.steps[idx].estimate or 0
+        return keptSize
+
+    def _abortReceive(self):
+        logger.info("abort incomplete receive into {}".format(self.backupFileSystemName))
+        self.zfs.abortResume(self.backupFileSystem)
+        self.recorder.record(self.backupSetConf, self.backupPool, "abort", info=self.backupFileSystemName)
+
+    def _resumeReceive(self, step):
+        logger.info("resume incomplete receive into {}".format(self.backupFileSystemName))
+        relay = self._mkRelay()
+        with self._transfer(self.backupFileSystemName) as progress:
+            info = self.zfs.sendRecvResume(self.resumeToken, self.backupFileSystem, relay=relay, progress=progress)
+        prevSourceSnapshotName, sourceSnapshotName, size = self._parseResumeInfo(info)
+        backupSnapshot = BackupSnapshot.createFromSnapshotName(sourceSnapshotName).createFromSnapshot(self.backupFileSystemName)
+        self._logRelay(relay, backupSnapshot)
+        self.inventory.addSnapshot(backupSnapshot)
+        self.recorder.record(self.backupSetConf, self.backupPool, "resume",
+                             src1Snap=prevSourceSnapshotName if prevSourceSnapshotName is not None else sourceSnapshotName,
+                             src2Snap=sourceSnapshotName if prevSourceSnapshotName is not None else None,
+                             backupSnap=backupSnapshot.getSnapshotName(),
+                             size=size, estSize=step.estimate, secs=self.transferSecs)
 
-    def _recordFull(self, sourceSnapshot, backupSnapshot, info):
+    def _parseResumeInfo(self, info):
+        """parse resumed send -P output, which starts with the token contents, returning
+        (prevSourceSnapshotName, sourceSnapshotName, size), where prevSourceSnapshotName
+        is None if a full was resumed"""
+        # full	test_src@snap1	481832
+        # incremental	snap1	test_src@snap2	593632
+        for row in info:
+            if (row[0] == "full") and (len(row) == 3):
+                return (None, row[1], row[2])
+            elif (row[0] == "incremental") and (len(row) == 4):
+                return (self._incrFromSnapshotName(row[1], row[2]), row[2], row[3])
+        raise BackupError("expected full or incremental line from ZFS send|receive resume, got: " + str(info))
+
+    @staticmethod
+    def _incrFromSnapshotName(fromSnap, toSnapshotName):
+        "send -P incremental rows may only have the snapshot part of the from snapshot name"
+        if "@" in fromSnap:
+            return fromSnap
+        return ZfsSnapshot.factory(ZfsSnapshot(toSnapshotName).fileSystem, fromSnap).name
+
+    def _recordFull(self, sourceSnapshot, backupSnapshot, info, estimate, secs):
         # full	test_src@snap1	481832
         # size	481832
         if len(info) != 2:
@@ -104,9 +378,9 @@ class FsBackup(object):
         self.recorder.record(self.backupSetConf, self.backupPool, "full",
                              src1Snap=sourceSnapshot.getSnapshotName(),
                              backupSnap=backupSnapshot.getSnapshotName(),
-                             size=info0[2])
+                             size=info0[2], sendOpts=self.sendOptions, estSize=estimate, secs=secs)
 
-    def _recordIncr(self, prevSourceSnapshot, sourceSnapshot, backupSnapshot, info):
+    def _recordIncr(self, prevSourceSnapshot, sourceSnapshot, backupSnapshot, info, estimate, secs):
         # incremental	snap1	test_src@snap2	593632
         # size	481832
         if len(info) != 2:
@@ -120,84 +394,184 @@ class FsBackup(object):
                              src1Snap=prevSourceSnapshot.getSnapshotName(),
                              src2Snap=sourceSnapshot.getSnapshotName(),
                              backupSnap=backupSnapshot.getSnapshotName(),
-                             size=info0[3])
+                             size=info0[3], sendOpts=self.sendOptions, estSize=estimate, secs=secs)
 
-    def _sendFull(self, sourceSnapshot):
+    def _recordIncrRange(self, sourceSnapshot, info, estimate, secs):
+        """record each snapshot in a send -I stream as an incremental, also adding
+        them to the inventory.  The estimate and time are for the whole stream and
+        are recorded with the last snapshot"""
+        # incremental	snap1	test_src@snap2	593632
+        # incremental	snap2	test_src@snap3	24816
+        # size	618448
+        rows = [row for row in info if row[0] == "incremental"]
+        if len(rows) == 0:
+            raise BackupError("expected incremental lines from ZFS send -I|receive, got: " + str(info))
+        for row in rows:
+            if len(row) != 4:
+                raise BackupError("expected 4 columns in ZFS send -I|receive incremental record, got: " + str(row))
+            backupSnapshot = ZfsSnapshot.factory(self.backupFileSystemName, ZfsSnapshot(row[2]).snapName)
+            self.inventory.addSnapshot(backupSnapshot)
+            self.recorder.record(self.backupSetConf, self.backupPool, "incr",
+                                 src1Snap=self._incrFromSnapshotName(row[1], row[2]),
+                                 src2Snap=row[2],
+                                 backupSnap=backupSnapshot.name,
+                                 size=row[3], sendOpts=self.sendOptions,
+                                 estSize=estimate if row is rows[-1] else None,
+                                 secs=secs if row is rows[-1] else None)
+        if rows[-1][2] != sourceSnapshot.getSnapshotName():
+            raise BackupError("expected ZFS send -I|receive to end with {}, got: {}".format(sourceSnapshot, rows[-1][2]))
+
+    def _mkRelay(self):
+        """create a relay if the backup pool is configured to use one or the send is rate limited,
+        which uses a relay even if the backup pool isn't configured with a buffer"""
+        bufferSize = self.backupPoolConf.bufferSize
+        if (bufferSize is None) and (len(self.rateLimiters) > 0):
+            bufferSize = self.throttleBufferSize
+        if bufferSize is None:
+            return None
+        return BufferRelay(bufferSize, rateLimiters=self.rateLimiters)
+
+    def _logRelay(self, relay, backupSnapshot):
+        if relay is not None:
+            logger.info("buffer relay for {}: {}".format(backupSnapshot, relay.stats))
+            for rateLimiter in self.rateLimiters:
+                logger.info(str(rateLimiter))
+
+    @contextmanager
+    def _transfer(self, name):
+        """limit concurrent sends from the source pool and track the progress of
+        a send, yields a progress.SendProgress or None.  The time taken by the
+        send, excluding waiting on the limit, is saved in transferSecs."""
+        with self.streamLimiter.stream(self.sourcePoolName):
+            startTime = time.monotonic()
+            progress = self.progressReporter.start(name) if self.progressReporter is not None else None
+            try:
+                yield progress
+            finally:
+                if progress is not None:
+                    self.progressReporter.finish(progress)
+                self.transferSecs = time.monotonic() - startTime
+
+    def _sendFull(self, sourceSnapshot, estimate=None):
         backupSnapshot = sourceSnapshot.createFromSnapshot(self.backupFileSystemName)
         logger.info("send full snapshot {} -> {}".format(sourceSnapshot, backupSnapshot))
-        info = self.zfs.sendRecvFull(sourceSnapshot.getSnapshotName(), backupSnapshot.getSnapshotName())
-        self._recordFull(sourceSnapshot, backupSnapshot, info)
+        relay = self._mkRelay()
+        with self._transfer(backupSnapshot.getSnapshotName()) as progress:
+            info = self.zfs.sendRecvFull(sourceSnapshot.getSnapshotName(), backupSnapshot.getSnapshotName(),
+                                         sendOptions=self.sendOptions, relay=relay, progress=progress)
+        self._logRelay(relay, backupSnapshot)
+        self.inventory.addSnapshot(backupSnapshot)
+        self._recordFull(sourceSnapshot, backupSnapshot, info, estimate, self.transferSecs)
         return backupSnapshot
 
-    def _sendIncr(self, prevSourceSnapshot, sourceSnapshot):
+    def _sendIncr(self, prevSourceSnapshot, sourceSnapshot, estimate=None):
         backupSnapshot = sourceSnapshot.createFromSnapshot(self.backupFileSystemName)
         logger.info("send incr snapshot {}..{} -> {}".format(prevSourceSnapshot, sourceSnapshot, backupSnapshot))
-        info = self.zfs.sendRecvIncr(prevSourceSnapshot.getSnapshotName(), sourceSnapshot.getSnapshotName(), backupSnapshot.getSnapshotName())
-        self._recordIncr(prevSourceSnapshot, sourceSnapshot, backupSnapshot, info)
+        relay = self._mkRelay()
+        with self._transfer(backupSnapshot.getSnapshotName()) as progress:
+            info = self.zfs.sendRecvIncr(prevSourceSnapshot.getSnapshotName(), sourceSnapshot.getSnapshotName(), backupSnapshot.getSnapshotName(),
+                                         sendOptions=self.sendOptions, relay=relay, progress=progress)
+        self._logRelay(relay, backupSnapshot)
+        self.inventory.addSnapshot(backupSnapshot)
+        self._recordIncr(prevSourceSnapshot, sourceSnapshot, backupSnapshot, info, estimate, self.transferSecs)
         return backupSnapshot
 
-    def _createSourceSnapshot(self):
-        newSourceSnapshot = BackupSnapshot.createCurrent(self.backupSetConf.name, fileSystem=self.sourceFileSystem)
-        logger.info("create source snapshot {}".format(newSourceSnapshot))
-        self.zfs.createSnapshot(newSourceSnapshot.getSnapshotName())
-        return newSourceSnapshot
-
-    def _backupNewSource(self):
-        "there are no source snapshots, so we just make a new snapshot and sent the whole thing"
-        self._sendFull(self._createSourceSnapshot())
-
-    def _backupNoCommonSnapshot(self):
-        """there are existing source snapshots, but none in common, which might be a new back pool,
-        sync the oldest and we go from there"""
-        self._sendFull(self.sourceSnapshots[-1])
-        return self.sourceSnapshots[-1]
-
-    def _backupIncrExisting(self, newestCommonSourceSnapshot):
-        """sync all existing source snapshot as incrementals, starting with
-        the newestCommonSourceSnapshot.  Return the final new common snapshot"""
-        commonSourceIdx = self.sourceSnapshots.getIdx(newestCommonSourceSnapshot)
-        for sourceIdx in range(commonSourceIdx, 0, -1):
-            self._sendIncr(self.sourceSnapshots[sourceIdx], self.sourceSnapshots[sourceIdx - 1])
-        return self.sourceSnapshots[0]
-
-    def _backupIncr(self, newestCommonSourceSnapshot):
-        # back up all snapshots from common point to newest
-        newestCommonSourceSnapshot = self._backupIncrExisting(newestCommonSourceSnapshot)
-        self._sendIncr(newestCommonSourceSnapshot, self._createSourceSnapshot())
+    def _sendIncrRange(self, prevSourceSnapshot, sourceSnapshot, estimate=None):
+        logger.info("send incr snapshot range {}..{} -> {}".format(prevSourceSnapshot, sourceSnapshot, self.backupFileSystemName))
+        relay = self._mkRelay()
+        with self._transfer(sourceSnapshot.createFromSnapshot(self.backupFileSystemName).getSnapshotName()) as progress:
+            info = self.zfs.sendRecvIncrRange(prevSourceSnapshot.getSnapshotName(), sourceSnapshot.getSnapshotName(), self.backupFileSystemName,
+                                              sendOptions=self.sendOptions, relay=relay, progress=progress)
+        self._logRelay(relay, self.backupFileSystemName)
+        self._recordIncrRange(sourceSnapshot, info, estimate, self.transferSecs)
 
-    def _backup(self):
-        self._setupBackupPoolFs()
-        if len(self.sourceSnapshots) == 0:
-            self._backupNewSource()
+    def _createSourceSnapshot(self):
+        "create the new source snapshot, unless it was created by the backup set"
+        if self.newSourceSnapshot is None:
+            self.newSourceSnapshot = BackupSnapshot.createCurrent(self.backupSetConf.name, fileSystem=self.sourceFileSystem,
+                                                                  after=self.sourceSnapshots.newestTimestamp())
+            logger.info("create source snapshot {}".format(self.newSourceSnapshot))
+            self.zfs.createSnapshot(self.newSourceSnapshot.getSnapshotName())
+            self.inventory.addSnapshot(self.newSourceSnapshot)
+        return self.newSourceSnapshot
+
+    def _executeStep(self, step):
+        sourceSnapshot = step.sourceSnapshot
+        if step.kind == "resume":
+            self._resumeReceive(step)
+            return
+        if sourceSnapshot is None:
+            sourceSnapshot = self._createSourceSnapshot()
+        if step.kind == "full":
+            self._sendFull(sourceSnapshot, step.estimate)
+        elif step.kind == "incr":
+            self._sendIncr(step.prevSourceSnapshot, sourceSnapshot, step.estimate)
         else:
-            # existing source snapshots
-            newestCommonSourceSnapshot = self.sourceSnapshots.findNewestCommon(self.backupSnapshots)
-            if newestCommonSourceSnapshot is None:
-                newestCommonSourceSnapshot = self._backupNoCommonSnapshot()
-            self._backupIncr(newestCommonSourceSnapshot)
+            self._sendIncrRange(step.prevSourceSnapshot, sourceSnapshot, step.estimate)
+
+    def execute(self):
+        "run the planned steps"
+        with self._recordingErrors():
+            if self.backupFileSystem is None:
+                self.backupFileSystem = self.zfs.createFileSystem(self.backupFileSystemName)
+            elif self.discardResume:
+                self._abortReceive()
+            for step in self.steps:
+                self._executeStep(step)
 
     def backup(self):
         logger.info("backup: backupSet {} {} -> {}"
                     .format(self.backupSetConf.name, self.sourceFileSystem.name, self.backupFileSystemName))
-        try:
-            self._backup()
-        except Exception as ex:
-            logger.exception("backup of {} to {} failed"
-                             .format(self.backupSetConf.name, self.sourceFileSystem.name))
-            self.recorder.error(self.backupSetConf, self.backupPool, ex, self.sourceFileSystem.name)
-            raise
+        self.plan()
+        self.execute()
 
     def snapOnly(self):
         self._createSourceSnapshot()
 
 
 class BackupSetBackup(object):
-    "backup of all data in a backup set"
-    def __init__(self, zfs, recorder, backupSetConf, allowDegraded):
+    """backup of all data in a backup set to one of it's backup pools.  Up to jobs
+    file systems are backed up concurrently, a failure of one doesn't stop the others.
+    """
+    # delays between clean export attempts, doubled each attempt up to the maximum
+    exportInitialDelay = 0.5
+    exportMaxDelay = 30.0
+
+    def __init__(self, zfs, recorder, backupSetConf, allowDegraded, inventory=None, *, jobs=None, streamLimiter=None,
+                 abortIncomplete=False, progressReporter=None, spaceCheck=None, exportTimeout=300.0, transferOrder=None,
+                 rateLimiter=None, rateControl=None, poolLock=None):
+        """
+        inventory - ZfsInventory, which maybe shared between backup sets, one is created if not specified
+        jobs - number of file systems backed up concurrently, if None, the backup set configuration is used
+        streamLimiter - StreamLimiter shared by all concurrent backup sets
+        abortIncomplete - discard interrupted receives rather than resuming them
+        progressReporter - if not None, progress.ProgressReporter shared by all concurrent backup sets
+        spaceCheck - if not None, check the estimated size of the sends against the space on the backup pool, see _admit()
+        exportTimeout - seconds to retry the clean export of a busy backup pool before forcing it
+        transferOrder - order in which file systems are transferred, see _scheduleOrder(), if None, the backup
+          set configuration is used
+        rateLimiter - if not None, throttle.RateLimiter for the global limit shared by all backup sets, sends
+          are also throttled by the backup set's configured rate limit
+        rateControl - if not None, throttle.RateControl used to adjust the backup set's limit at runtime
+        poolLock - if not None, function that returns a context manager locking the named backup pool,
+          see _backupPoolInUse()
+        """
         self.recorder = recorder
         self.zfs = zfs
         self.backupSetConf = backupSetConf
         self.allowDegraded = allowDegraded
+        self.inventory = inventory if inventory is not None else ZfsInventory(zfs)
+        self.jobs = jobs if jobs is not None else backupSetConf.jobs
+        self.streamLimiter = streamLimiter if streamLimiter is not None else StreamLimiter()
+        self.abortIncomplete = abortIncomplete
+        self.progressReporter = progressReporter
+        self.spaceCheck = spaceCheck
+        self.exportTimeout = exportTimeout
+        self.transferOrder = transferOrder if transferOrder is not None else backupSetConf.transferOrder
+        self.newSourceSnapshots = {}  # by source file system name
+        self.setRateLimiter = RateLimiter(backupSetConf.name, backupSetConf.rateLimit, rateControl)
+        self.rateLimiters = tuple([l for l in (rateLimiter, self.setRateLimiter) if (l is not None) and l.enabled])
+        self.poolLock = poolLock
 
     def _getExportedPool(self):
         pools = self._getExportedPools()
@@ -209,10 +583,20 @@ class BackupSetBackup(object):
             raise BackupError("multiple backup pools are exported for backupset {} in {}"
                               .format(self.backupSetConf.name, [pool.name for pool in pools]))
 
+    def _guidMatches(self, pool):
+        "does the GUID of pool match the configured GUID, if both are known"
+        guid = self.backupSetConf.getBackupPoolConf(pool.name).guid
+        if (guid is not None) and (pool.guid is not None) and (pool.guid != guid):
+            logger.warning("{} pool {} has GUID {}, not the configured backup pool GUID {}"
+                           .format("imported" if pool.imported else "exported", pool.name, pool.guid, guid))
+            return False
+        return True
+
     def _getExportedPools(self):
         pools = []
         for pool in self.zfs.listExportedPools():
-            if (pool.name in self.backupSetConf.backupPoolNames) and (pool.health in (ZfsPoolHealth.ONLINE, ZfsPoolHealth.DEGRADED)):
+            if ((pool.name in self.backupSetConf.backupPoolNames) and (pool.health in (ZfsPoolHealth.ONLINE, ZfsPoolHealth.DEGRADED))
+                    and self._guidMatches(pool)):
                 pools.append(pool)
         return pools
 
@@ -228,10 +612,9 @@ class BackupSetBackup(object):
 
     def _lookupImportedPool(self, poolName):
         backupPool = self.zfs.findPool(poolName)
-        if (backupPool is not None) and (backupPool.health in (ZfsPoolHealth.ONLINE, ZfsPoolHealth.DEGRADED)):
-            return backupPool
-        else:
+        if (backupPool is None) or (backupPool.health not in (ZfsPoolHealth.ONLINE, ZfsPoolHealth.DEGRADED)):
             return None
+        return backupPool if self._guidMatches(backupPool) else None
 
     def _getImportedPools(self):
         pools = []
@@ -247,16 +630,152 @@ class BackupSetBackup(object):
             raise BackupError("configured file system not in ZFS: " + sourceFileSystemConf.name)
         return sourceFileSystem
 
-    def _fsBackup(self, sourceFileSystemConf, backupPool):
+    def _createSourceSnapshots(self, sourceFileSystems):
+        """create new snapshots of all source file systems in one batch, saving them in newSourceSnapshots.
+        The snapshots have a single timestamp and are created with one zfs snapshot command per source
+        pool, giving a consistent point in time across file systems"""
+        newestTimestamps = [BackupSnapshots(self.inventory, fs).newestTimestamp() for fs in sourceFileSystems]
+        newestTimestamps = [t for t in newestTimestamps if t is not None]
+        timestampSnapshot = BackupSnapshot.createCurrent(self.backupSetConf.name,
+                                                         after=max(newestTimestamps) if len(newestTimestamps) > 0 else None)
+        newSourceSnapshots = [timestampSnapshot.createFromSnapshot(fs) for fs in sourceFileSystems]
+        logger.info("create source snapshots {}".format(" ".join([str(s) for s in newSourceSnapshots])))
+        self.zfs.createSnapshots([s.getSnapshotName() for s in newSourceSnapshots])
+        for newSourceSnapshot in newSourceSnapshots:
+            self.inventory.addSnapshot(newSourceSnapshot)
+            self.newSourceSnapshots[newSourceSnapshot.fileSystemName] = newSourceSnapshot
+
+    def _createBackupSourceSnapshots(self, sourceFileSystems, backupPool):
+        "create the new source snapshots for a backup, recording an error on failure"
         try:
-            fsBackup = FsBackup(self.zfs, self.recorder, self.backupSetConf,
-                                self._getSourceFileSystem(sourceFileSystemConf),
-                                backupPool)
-            fsBackup.backup()
+            self._createSourceSnapshots(sourceFileSystems)
         except Exception as ex:
             self.recorder.error(self.backupSetConf, backupPool, ex)
             raise
 
+    def _fsBackups(self, sourceFileSystemConfs, backupPool):
+        """backup each file system, a failure doesn't stop the others.  Missing file
+        systems are not snapshotted, they are reported as failures when backed up.
+        Return list of (sourceFileSystemName, exception) for failures."""
+        sourceFileSystems = [self.zfs.findFileSystem(sfsc.name) for sfsc in sourceFileSystemConfs]
+        self._createBackupSourceSnapshots([fs for fs in sourceFileSystems if fs is not None], backupPool)
+        results = self._fsRunAll(lambda sfsc: self._mkFsBackup(sfsc, backupPool).backup(),
+                                 sourceFileSystemConfs, backupPool)
+        return [(sfsc.name, ex) for sfsc, (ignored, ex) in zip(sourceFileSystemConfs, results)
+                if ex is not None]
+
+    def _mkFsBackup(self, sourceFileSystemConf, backupPool):
+        return FsBackup(self.zfs, self.recorder, self.backupSetConf,
+                        self._getSourceFileSystem(sourceFileSystemConf),
+                        backupPool, self.inventory, streamLimiter=self.streamLimiter,
+                        abortIncomplete=self.abortIncomplete, progressReporter=self.progressReporter,
+                        newSourceSnapshot=self.newSourceSnapshots.get(sourceFileSystemConf.name),
+                        rateLimiters=self.rateLimiters)
+
+    def _fsRunNoThrow(self, func, item, backupPool):
+        """returns (result, None) or (None, exception) if func(item) failed, which
+        has been logged and recorded"""
+        try:
+            return (func(item), None)
+        except Exception as ex:
+            self.recorder.error(self.backupSetConf, backupPool, ex)
+            return (None, ex)
+
+    def _fsRunAll(self, func, items, backupPool):
+        """call func on each item, a failure doesn't stop the others.  Up to jobs
+        calls are run concurrently.  Return list of (result, exception), in the same order"""
+        if self.jobs <= 1:
+            return [self._fsRunNoThrow(func, item, backupPool) for item in items]
+        with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="fsBackup") as executor:
+            return list(executor.map(lambda item: self._fsRunNoThrow(func, item, backupPool), items))
+
+    def _planFsBackup(self, sourceFileSystemConf, backupPool):
+        fsBackup = self._mkFsBackup(sourceFileSystemConf, backupPool)
+        fsBackup.plan(estimate=True)
+        return fsBackup
+
+    def _admitTrimmed(self, fsBackups, available):
+        "admit file systems, smallest first, trimming sends that don't fit"
+        admitted = []
+        for fsBackup in sorted(fsBackups, key=lambda fb: fb.estimatedSize):
+            available -= fsBackup.trimSteps(available)
+            if len(fsBackup.steps) > 0:
+                admitted.append(fsBackup)
+        return admitted
+
+    def _admit(self, fsBackups, backupPool):
+        """check the estimated size of the planned sends against the space available
+        on the backup pool, returning the FsBackup objects to execute.  If the total
+        exceeds the space, spaceCheck determines what is done:
+          warn - log a warning and proceed
+          refuse - fail without sending anything
+          trim - admit file systems smallest first, dropping the sends that don't fit"""
+        available = self.zfs.getIntProp(backupPool, "available")
+        total = sum([fb.estimatedSize for fb in fsBackups])
+        logger.info("backup set {} estimated to send {} bytes to {}, which has {} bytes available"
+                    .format(self.backupSetConf.name, total, backupPool.name, available))
+        if total <= available:
+            return fsBackups
+        msg = ("estimated size of sends for backup set {} ({} bytes) exceeds space available on {} ({} bytes)"
+               .format(self.backupSetConf.name, total, backupPool.name, available))
+        if self.spaceCheck == "refuse":
+            raise BackupError(msg)
+        logger.warning(msg)
+        if self.spaceCheck == "trim":
+            return self._admitTrimmed(fsBackups, available)
+        return fsBackups
+
+    def _scheduleOrder(self, fsBackups):
+        """order planned FsBackup objects by transferOrder, either "config" order, or by estimated
+        size.  Largest first minimizes the total time when running concurrent jobs, smallest
+        first gets the most file systems backed up early"""
+        if self.transferOrder == "config":
+            return fsBackups
+        ordered = sorted(fsBackups, key=lambda fb: fb.estimatedSize, reverse=(self.transferOrder == "largest"))
+        logger.info("backup set {} transfer order ({} first): {}"
+                    .format(self.backupSetConf.name, self.transferOrder,
+                            ", ".join(["{} ({} bytes)".format(fb.sourceFileSystem.name, fb.estimatedSize) for fb in ordered])))
+        return ordered
+
+    def _executePlanned(self, planned, backupPool):
+        """check space if requested, then create the new source snapshots that are
+        needed by the admitted FsBackup objects and execute them in the scheduled
+        order.  Return list of (sourceFileSystemName, exception) for failures."""
+        admitted = planned
+        if self.spaceCheck is not None:
+            try:
+                admitted = self._admit(planned, backupPool)
+            except Exception as ex:
+                self.recorder.error(self.backupSetConf, backupPool, ex)
+                raise
+        admitted = self._scheduleOrder(admitted)
+        needSnapshot = [fb for fb in admitted if fb.needsNewSourceSnapshot()]
+        self._createBackupSourceSnapshots([fb.sourceFileSystem for fb in needSnapshot], backupPool)
+        for fsBackup in needSnapshot:
+            fsBackup.newSourceSnapshot = self.newSourceSnapshots[fsBackup.sourceFileSystem.name]
+        results = self._fsRunAll(lambda fb: fb.execute(), admitted, backupPool)
+        return [(fb.sourceFileSystem.name, ex) for fb, (ignored, ex) in zip(admitted, results)
+                if ex is not None]
+
+    def _fsCheckedBackups(self, sourceFileSystemConfs, backupPool):
+        """plan all file systems, check space and order them, then execute them.  A failure of one
+        file system doesn't stop the others.  Return list of (sourceFileSystemName, exception)
+        for failures."""
+        results = self._fsRunAll(lambda sfsc: self._planFsBackup(sfsc, backupPool),
+                                 sourceFileSystemConfs, backupPool)
+        failures = [(sfsc.name, ex) for sfsc, (ignored, ex) in zip(sourceFileSystemConfs, results)
+                    if ex is not None]
+        planned = [fsBackup for fsBackup, ex in results if ex is None]
+        return failures + self._executePlanned(planned, backupPool)
+
+    def _loadFsPlan(self, fsPlan, backupPool):
+        "plan a file system and replace the steps with the saved plan"
+        sourceFileSystemConf = self.backupSetConf.getSourceFileSystem(fsPlan.sourceFileSystemName)
+        fsBackup = self._mkFsBackup(sourceFileSystemConf, backupPool)
+        fsBackup.plan()
+        fsBackup.usePlan(fsPlan)
+        return fsBackup
+
     def _findBackupPoolToUse(self):
         pool = self._getImportedPool()
         if pool is not None:
@@ -267,45 +786,138 @@ class BackupSetBackup(object):
         raise BackupError("no backup pool is imported or ready for import for backupset {} in {}"
                           .format(self.backupSetConf.name, self.backupSetConf.backupPoolNames))
 
-    def _obtainBackupPool(self):
-        backupPool, needToImport = self._findBackupPoolToUse()
-        if needToImport:
-            self.zfs.importPool(backupPool)
+    def _checkBackupPoolHealth(self, backupPool):
         if (backupPool.health == ZfsPoolHealth.DEGRADED):
             if self.allowDegraded:
                 logger.warning("backing up to degraded pool: {}".format(backupPool.name))
             else:
                 raise BackupError("backup pool degraded: {}".format(backupPool.name))
-        return backupPool, needToImport
+
+    def _refreshLockedBackupPool(self, backupPool, needToImport):
+        """get the current state of backupPool once it is locked, as the run that held
+        the lock may have imported or exported it.  Returns (backupPool, needToImport)"""
+        self.zfs.invalidateListings()
+        pool = self._lookupImportedPool(backupPool.name)
+        if pool is not None:
+            return pool, False
+        if needToImport:
+            return backupPool, True  # still exported
+        for pool in self._getExportedPools():
+            if pool.name == backupPool.name:
+                return pool, True
+        raise BackupError("backup pool {} of backupset {} is no longer imported or ready for import"
+                          .format(backupPool.name, self.backupSetConf.name))
+
+    @contextmanager
+    def _backupPoolInUse(self):
+        """context manager that locks the backup pool to use with poolLock, importing
+        it if needed, a pool imported here is exported on exit"""
+        backupPool, needToImport = self._findBackupPoolToUse()
+        with self.poolLock(backupPool.name) if self.poolLock is not None else nullcontext():
+            if self.poolLock is not None:
+                backupPool, needToImport = self._refreshLockedBackupPool(backupPool, needToImport)
+            if needToImport:
+                self.zfs.importPool(backupPool)
+            try:
+                self._checkBackupPoolHealth(backupPool)
+                yield backupPool
+            finally:
+                if needToImport:
+                    self._exportBackupPool(backupPool)
+
+    def _tryCleanExport(self, backupPool):
+        "try to export without force, returning False if the pool is busy, other errors are raised"
+        try:
+            self.zfs.exportPool(backupPool)
+            return True
+        except Exception as ex:
+            if not isPoolBusyError(ex):
+                raise
+            logger.info("clean export of {} failed, pool is busy: {}".format(backupPool.name, ex))
+            return False
 
     def _exportBackupPool(self, backupPool):
-        # sometimes this is busy even after backup completes, just wait and
-        # then force
-        time.sleep(5.0)
-        self.zfs.exportPool(backupPool, force=True)
+        """export pool, which is sometimes busy for a while after the backup
+        completes.  Poll with clean exports, backing off, and then force.
+        The time spent is recorded."""
+        startTime = time.monotonic()
+        delay = self.exportInitialDelay
+        attempts = 1
+        forced = False
+        while not self._tryCleanExport(backupPool):
+            remaining = self.exportTimeout - (time.monotonic() - startTime)
+            if remaining <= 0:
+                logger.warning("pool {} still busy after {} seconds, forcing export".format(backupPool.name, self.exportTimeout))
+                self.zfs.exportPool(backupPool, force=True)
+                forced = True
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(2 * delay, self.exportMaxDelay)
+            attempts += 1
+        self.inventory.invalidate(backupPool)
+        self.recorder.record(self.backupSetConf, backupPool, "export",
+                             info="{} export after {} attempts in {:.1f} sec".format("forced" if forced else "clean", attempts,
+                                                                                     time.monotonic() - startTime))
+
+    def _logRateLimit(self):
+        "report the allowed and actual rate of the backup set"
+        if self.setRateLimiter.enabled:
+            logger.info("backup set {}".format(self.setRateLimiter))
 
     def backup(self, sourceFileSystemConfs=None):
         """specifying sourceFileSystemConfs can limit the file systems backed
         up to a subset."""
         if sourceFileSystemConfs is None:
             sourceFileSystemConfs = self.backupSetConf.sourceFileSystemConfs
-        backupPool, needToImport = self._obtainBackupPool()
         try:
-            for sourceFileSystemConf in sourceFileSystemConfs:
-                self._fsBackup(sourceFileSystemConf, backupPool)
+            with self._backupPoolInUse() as backupPool:
+                if (self.spaceCheck is None) and (self.transferOrder == "config"):
+                    failures = self._fsBackups(sourceFileSystemConfs, backupPool)
+                else:
+                    failures = self._fsCheckedBackups(sourceFileSystemConfs, backupPool)
         finally:
-            if needToImport:
-                self._exportBackupPool(backupPool)
+            self._logRateLimit()
+        if len(failures) > 0:
+            raise BackupSetFailures(self.backupSetConf, failures, len(sourceFileSystemConfs))
 
-    def _fsSnapOnly(self, sourceFileSystemConf):
-        fsBackup = FsBackup(self.zfs, self.recorder, self.backupSetConf,
-                            self._getSourceFileSystem(sourceFileSystemConf),
-                            backupPool=None)
-        fsBackup.snapOnly()
+    def plan(self, sourceFileSystemConfs=None):
+        """Plan the backup without moving any data, returning a plan.BackupSetPlan.
+        The backup pool is imported if needed to examine it and exported again."""
+        if sourceFileSystemConfs is None:
+            sourceFileSystemConfs = self.backupSetConf.sourceFileSystemConfs
+        with self._backupPoolInUse() as backupPool:
+            results = self._fsRunAll(lambda sfsc: self._planFsBackup(sfsc, backupPool),
+                                     sourceFileSystemConfs, backupPool)
+            available = self.zfs.getIntProp(backupPool, "available")
+        failures = [(sfsc.name, ex) for sfsc, (ignored, ex) in zip(sourceFileSystemConfs, results)
+                    if ex is not None]
+        if len(failures) > 0:
+            raise BackupSetFailures(self.backupSetConf, failures, len(sourceFileSystemConfs))
+        return BackupSetPlan(self.backupSetConf.name, backupPool.name, available,
+                             tuple([fsBackup.toPlan() for fsBackup, ex in results]))
+
+    def executePlan(self, setPlan):
+        """Execute a saved plan.BackupSetPlan.  Each file system is planned again and
+        fails if the saved steps are no longer the ones needed.  The saved estimates
+        are used if a space check is requested."""
+        try:
+            with self._backupPoolInUse() as backupPool:
+                if backupPool.name != setPlan.backupPoolName:
+                    raise BackupError("plan for backup set {} is for backup pool {}, however {} is available"
+                                      .format(self.backupSetConf.name, setPlan.backupPoolName, backupPool.name))
+                results = self._fsRunAll(lambda fsPlan: self._loadFsPlan(fsPlan, backupPool),
+                                         setPlan.fileSystems, backupPool)
+                failures = [(fsPlan.sourceFileSystemName, ex) for fsPlan, (ignored, ex) in zip(setPlan.fileSystems, results)
+                            if ex is not None]
+                planned = [fsBackup for fsBackup, ex in results if ex is None]
+                failures += self._executePlanned(planned, backupPool)
+        finally:
+            self._logRateLimit()
+        if len(failures) > 0:
+            raise BackupSetFailures(self.backupSetConf, failures, len(setPlan.fileSystems))
 
     def snapOnly(self, sourceFileSystemConfs=None):
         """create snapshots without backing up."""
         if sourceFileSystemConfs is None:
             sourceFileSystemConfs = self.backupSetConf.sourceFileSystemConfs
-        for sourceFileSystemConf in sourceFileSystemConfs:
-            self._fsSnapOnly(sourceFileSystemConf)
+        self._createSourceSnapshots([self._getSourceFileSystem(sfsc) for sfsc in sourceFileSystemConfs])
@@ -1,10 +1,15 @@
 """
 Object for running commands.
 """
+import os
 import sys
+import signal
+import asyncio
 import subprocess
-import tempfile
+import threading
 import logging
+import time
+from collections import deque
 logger = logging.getLogger()
 
 def stdflush():
@@ -26,37 +31,234 @@ class ProcessError(Exception):
         Exception.__init__(self, msg)
 
 
-class Pipeline2Exception(Exception):
-    def __init__(self, except1, except2):
-        "either can be null"
-        self.except1 = except1
-        self.except2 = except2
-        msgs = [str(except1) if except1 is not None else "",
-                str(except2) if except1 is not None else ""]
+class StderrCollector(object):
+    """Drain the stderr of a process in a thread as it is written, so the
+    process never blocks on a full pipe.  A bounded number of lines are kept
+    from the start and end of the output, with a count of those omitted from
+    the middle.  Each line is passed to lineCallback as it arrives.  Lines for
+    which lineFilter returns False are not kept."""
+    def __init__(self, fh, lineCallback=None, lineFilter=None, maxHeadLines=500, maxTailLines=100):
+        self.maxHeadLines = maxHeadLines
+        self.head = []
+        self.tail = deque(maxlen=maxTailLines)
+        self.omitted = 0
+        self.thread = threading.Thread(target=self._read, args=(fh, lineCallback, lineFilter),
+                                       name="stderr", daemon=True)
+        self.thread.start()
+
+    def _read(self, fh, lineCallback, lineFilter):
+        try:
+            for line in fh:
+                if lineCallback is not None:
+                    try:
+                        lineCallback(line)
+                    except Exception:
+                        logger.exception("stderr line callback failed")
+                if (lineFilter is None) or lineFilter(line):
+                    self._keep(line)
+        finally:
+            fh.close()
+
+    def _keep(self, line):
+        if len(self.head) < self.maxHeadLines:
+            self.head.append(line)
+        else:
+            if len(self.tail) == self.tail.maxlen:
+                self.omitted += 1
+            self.tail.append(line)
+
+    def wait(self):
+        "wait for end of file and return the kept text"
+        self.thread.join()
+        text = "".join(self.head)
+        if self.omitted > 0:
+            text += "[{} lines omitted]\n".format(self.omitted)
+        return text + "".join(self.tail)
+
+class PipelineStage(object):
+    """A process in a Pipeline.  Once the pipeline has completed, returncode,
+    stderr and rusage (from os.wait4) are set, exception is the ProcessError if
+    the process failed.  If the stage was sent SIGTERM due to the failure of
+    another stage, terminated is True.  If relay is not None, it is an
+    unstarted relay.BufferRelay used to copy data from the previous stage and
+    relayException is set if it fails."""
+    def __init__(self, cmd, relay=None, stderrLineCallback=None, stderrLineFilter=None):
+        self.cmd = tuple(cmd)
+        self.relay = relay
+        self.stderrLineCallback = stderrLineCallback
+        self.stderrLineFilter = stderrLineFilter
+        self.proc = None
+        self.stderrCollector = None
+        self.returncode = None
+        self.stderr = None
+        self.rusage = None
+        self.exception = None
+        self.relayException = None
+        self.terminated = False
+
+    def start(self, stdin, stdout):
+        self.proc = subprocess.Popen(self.cmd, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE,
+                                     encoding="utf-8", errors="replace")
+        self.stderrCollector = StderrCollector(self.proc.stderr, self.stderrLineCallback, self.stderrLineFilter)
+
+    def __str__(self):
+        return " ".join(self.cmd)
+
+class PipelineException(Exception):
+    """A Pipeline failed, the stages are available with their results.  The
+    failed stages are reported, followed by those that were terminated
+    because of the failure."""
+    def __init__(self, stages):
+        self.stages = tuple(stages)
+        msgs = []
+        for stage in self.stages:
+            if stage.relayException is not None:
+                msgs.append("relay to {} failed: {}".format(stage, stage.relayException))
+            if (stage.exception is not None) and not stage.terminated:
+                msgs.append(str(stage.exception))
+        for stage in self.stages:
+            if stage.terminated:
+                msgs.append("terminated: {}".format(stage))
         Exception.__init__(self, "\n".join(msgs))
 
-class AsyncProc(object):
-    def __init__(self, cmd, stdin=None, stdout=None):
-        self.cmd = cmd
-        self.stderrFh = tempfile.NamedTemporaryFile(prefix="zfszipper", mode="w+", encoding="utf-8")
-        self.proc = subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=self.stderrFh, encoding="utf-8")
+class Pipeline(object):
+    """Pipeline of any number of processes, with the stdout of each stage
+    connected to the stdin of the next, either directly or through a relay.
+    All stages are waited on concurrently; when the first stage or relay
+    fails, the remaining running stages are sent SIGTERM."""
+    # interval for polling for the exit of stages, where os.waitid() is not available
+    reapPollSecs = 0.05
+
+    def __init__(self, stdin=None, stdout=None):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stages = []
+        self.lock = threading.Lock()
+        self.cancelled = False
+
+    def add(self, cmd, *, relay=None, stderrLineCallback=None, stderrLineFilter=None):
+        """add a stage, returning the PipelineStage object.  If relay is not None, it
+        is an unstarted relay.BufferRelay used to copy data from the previous stage.
+        stderrLineCallback and stderrLineFilter are passed to the StderrCollector."""
+        if (relay is not None) and (len(self.stages) == 0):
+            raise ValueError("relay can not be used on the first stage of a pipeline")
+        stage = PipelineStage(cmd, relay, stderrLineCallback, stderrLineFilter)
+        self.stages.append(stage)
+        return stage
+
+    def __str__(self):
+        return " | ".join([str(stage) for stage in self.stages])
+
+    def _startStage(self, iStage):
+        stage = self.stages[iStage]
+        prevStdout = self.stages[iStage - 1].proc.stdout if iStage > 0 else None
+        stdout = subprocess.PIPE if iStage < len(self.stages) - 1 else self.stdout
+        if iStage == 0:
+            stage.start(self.stdin, stdout)
+        elif stage.relay is None:
+            stage.start(prevStdout, stdout)
+            prevStdout.close()  # allow previous process to receive a SIGPIPE if this process exits
+        else:
+            stage.start(subprocess.PIPE, stdout)
+            stage.relay.start(prevStdout, stage.proc.stdin)  # relay closes pipes
+
+    def _start(self):
+        try:
+            for iStage in range(len(self.stages)):
+                self._startStage(iStage)
+        except Exception:
+            logger.exception("failed to start: " + str(self))
+            self._cancel(None)
+            for stage in self.stages:
+                if stage.proc is not None:
+                    self._waitStage(stage)
+            self._cleanupStart()
+            raise
+
+    def _cleanupStart(self):
+        "after a failed start, wait for the relays that were started and close the pipes they didn't take over"
+        for stage in self.stages:
+            if stage.relay is not None:
+                try:
+                    stage.relay.wait()  # returns at once if not started
+                except Exception as ex:
+                    logger.debug("buffer relay of failed pipeline: {}".format(ex))
+        for stage in self.stages:
+            if stage.proc is not None:
+                for pipe in (stage.proc.stdin, stage.proc.stdout):
+                    if pipe is not None:
+                        pipe.close()
+
+    def _cancel(self, failedStage):
+        "send SIGTERM to all running stages except the one that failed"
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            for stage in self.stages:
+                if (stage is not failedStage) and (stage.proc is not None) and (stage.returncode is None):
+                    self._terminateStage(stage)
+
+    def _terminateStage(self, stage):
+        """send SIGTERM if it has not already exited and is just waiting to be reaped.
+        Called with the lock held, which prevents the process being reaped, so
+        the pid can't have been reused by another process.  Without os.waitid(),
+        a process that has exited but not been reaped is also marked terminated"""
+        if hasattr(os, "waitid") and (os.waitid(os.P_PID, stage.proc.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None):
+            return
+        stage.terminated = True
+        os.kill(stage.proc.pid, signal.SIGTERM)
+
+    def _reapStage(self, stage, options):
+        "reap the process with the lock held, see _terminateStage, returning False if it's still running"
+        with self.lock:
+            pid, status, rusage = os.wait4(stage.proc.pid, options)
+            if pid == 0:
+                return False
+            stage.returncode = stage.proc.returncode = os.waitstatus_to_exitcode(status)
+        stage.rusage = rusage
+        return True
+
+    def _waitStage(self, stage):
+        if hasattr(os, "waitid"):
+            # wait for exit without reaping, so it's reaped with the lock held
+            os.waitid(os.P_PID, stage.proc.pid, os.WEXITED | os.WNOWAIT)
+            self._reapStage(stage, 0)
+        else:
+            # no waitid on macOS before Python 3.13, poll so the lock isn't held while waiting
+            while not self._reapStage(stage, os.WNOHANG):
+                time.sleep(self.reapPollSecs)
+        stage.stderr = stage.stderrCollector.wait()
+        if stage.returncode != 0:
+            stage.exception = ProcessError(stage.returncode, stage.cmd, stage.stderr)
+            if not stage.terminated:
+                logger.error("failed: {} got {}".format(stage.exception, stage.stderr))
+                self._cancel(stage)
 
-    def waitNoThrow(self):
-        "return (stderr, None) or (stderr, exception) on error, logs errors"
+    def _waitRelay(self, stage):
         try:
-            code = self.proc.wait()
-            if code != 0:
-                self.stderrFh.seek(0)
-                raise ProcessError(code, self.cmd, self.stderrFh.read())
-            self.stderrFh.seek(0)
-            return (self.stderrFh.read(), None)
+            stage.relay.wait()
         except Exception as ex:
-            self.stderrFh.seek(0)
-            stderr = self.stderrFh.read()
-            logger.exception("failed: " + " " .join(self.cmd) + " got " + stderr)
-            return (stderr, ex)
-        finally:
-            self.stderrFh.close()
+            logger.exception("buffer relay failed")
+            stage.relayException = ex
+            self._cancel(None)
+
+    def run(self):
+        """run the pipeline to completion, raising a PipelineException if any stage
+        or relay failed, return the list of stages"""
+        self._start()
+        waiters = [threading.Thread(target=self._waitStage, args=(stage,), name="waitStage", daemon=True)
+                   for stage in self.stages]
+        waiters += [threading.Thread(target=self._waitRelay, args=(stage,), name="waitRelay", daemon=True)
+                    for stage in self.stages if stage.relay is not None]
+        for waiter in waiters:
+            waiter.start()
+        for waiter in waiters:
+            waiter.join()
+        for stage in self.stages:
+            if (stage.exception is not None) or (stage.relayException is not None):
+                raise PipelineException(self.stages)
+        return self.stages
 
 class CmdRunner(object):
     def _logCmd(self, cmd):
@@ -85,15 +287,29 @@ class CmdRunner(object):
         lines = self.call(cmd)
         return [l.split("\t") for l in lines]
 
-    def pipeline2(self, cmd1, cmd2):
-        """pipeline two processes, capturing stderr, either throw in exception or
-        returned as (stderr1, strderr2)"""
-        self._logCmd(cmd1 + ["|"] + cmd2)
-        p1 = AsyncProc(cmd1, stdout=subprocess.PIPE)
-        p2 = AsyncProc(cmd2, stdin=p1.proc.stdout)
-        p1.proc.stdout.close()  # Allow process to receive a SIGPIPE if other process exits
-        stderr1, ex1 = p1.waitNoThrow()
-        stderr2, ex2 = p2.waitNoThrow()
-        if (ex1 is not None) or (ex2 is not None):
-            raise Pipeline2Exception(ex1, ex2)
-        return (stderr1, stderr2)
+    async def _runAsync(self, cmd):
+        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise ProcessError(process.returncode, cmd, stderr)
+        return stdout.decode("utf-8")
+
+    async def callAsync(self, cmd):
+        """asyncio version of call, so that independent read-only commands can be
+        run concurrently with asyncio.gather()"""
+        self._logCmd(cmd)
+        try:
+            lines = (await self._runAsync(cmd)).splitlines()
+        except Exception:
+            logger.exception("command failed:" + " " .join(cmd))
+            raise
+        return lines
+
+    async def callTabSplitAsync(self, cmd):
+        "asyncio version of callTabSplit"
+        return [l.split("\t") for l in await self.callAsync(cmd)]
+
+    def runPipeline(self, pipeline):
+        "run a Pipeline object, raising a PipelineException on error"
+        self._logCmd([str(pipeline)])
+        return pipeline.run()
@@ -1,42 +1,166 @@
 """
 Configuration objects.
 """
+import os
 import os.path as osp
+import sys
 import time
+import pickle
+import logging
 from collections import OrderedDict
 from zfszipper import loggingOps
+from zfszipper.typeOps import parseByteSize
+from zfszipper.throttle import RateSchedule, RateLimitError
+from zfszipper.cron import CronSchedule, CronError
+
+logger = logging.getLogger()
 
 class BackupConfigError(Exception):
     pass
 
+# actions when estimated send sizes exceed available space on a backup pool, see BackupSetBackup
+spaceCheckPolicies = ("warn", "refuse", "trim")
+
+# order in which file systems are transferred:
+#   config - as listed in the configuration
+#   largest - largest estimated send first, minimizes total time with concurrent jobs
+#   smallest - smallest estimated send first, protects the most file systems soonest
+transferOrders = ("config", "largest", "smallest")
+
+# zfs send options that may be configured: compressed, large-block, embedded and raw
+validSendOptions = frozenset(("-c", "-L", "-e", "-w"))
+
+def parseSendOptions(sendOptions):
+    """parse send options, either a string of white-space separated options or a
+    sequence of options, into a tuple"""
+    if isinstance(sendOptions, str):
+        sendOptions = sendOptions.split()
+    sendOptions = tuple(sendOptions)
+    for opt in sendOptions:
+        if opt not in validSendOptions:
+            raise BackupConfigError("invalid zfs send option '{}', expected one of {}".format(opt, ", ".join(sorted(validSendOptions))))
+    return sendOptions
+
+def parseRateLimit(rateLimit):
+    """parse a rate limit in bytes/sec into a throttle.RateSchedule, or None if
+    not limited.  Either a constant rate, such as 20000000 or "20M", or time of
+    day windows in local time, such as "08:00-18:00=20M,22:00-06:00=200M" or
+    [("08:00", "18:00", "20M")], outside of the windows the rate is unlimited"""
+    if rateLimit is None:
+        return None
+    try:
+        return RateSchedule.parse(rateLimit)
+    except (RateLimitError, TypeError, ValueError) as ex:
+        raise BackupConfigError("invalid rateLimit {!r}: {}".format(rateLimit, ex)) from ex
+
+def parseSchedule(schedule):
+    "parse a crontab style schedule into a cron.CronSchedule, or None if not scheduled"
+    if schedule is None:
+        return None
+    try:
+        return CronSchedule(schedule)
+    except CronError as ex:
+        raise BackupConfigError(str(ex)) from ex
+
 class SourceFileSystemConf(object):
-    "a file system to backup, full ZFS file system name"
-    def __init__(self, name):
+    """a file system to backup, full ZFS file system name.
+    sendOptions - if not None, zfs send options to use for this file system, overriding
+    the backup pool default, see validSendOptions"""
+    def __init__(self, name, sendOptions=None):
         self.name = osp.normpath(name)
+        self.sendOptions = parseSendOptions(sendOptions) if sendOptions is not None else None
 
 class BackupPoolConf(object):
-    "Configuration of a backup pool"
-    def __init__(self, name):
+    """Configuration of a backup pool.
+    bufferSize - if not None, the size of a memory buffer between zfs send and receive,
+    either bytes or a string such as "1G".
+    sendOptions - zfs send options used for file systems that don't specify them, see validSendOptions
+    deviceDirs - directories, or devices, to search for the pool when exported (zpool import -d),
+    rather than scanning all devices, a string or sequence of strings.
+    cacheFile - if not None, a pool cache file that records the pool's devices (zpool import -c).
+    The daemon's --watch only detects the pool being attached if it has deviceDirs or a cacheFile,
+    or its devices are in the poolDeviceCacheFile.
+    guid - if not None, the GUID of the pool.  Exported pools with the same name and a different
+    GUID are ignored, and the pool is imported by GUID."""
+    def __init__(self, name, bufferSize=None, sendOptions=(), deviceDirs=(), cacheFile=None, guid=None):
         self.name = name
+        self.bufferSize = parseByteSize(bufferSize) if bufferSize is not None else None
+        self.sendOptions = parseSendOptions(sendOptions)
+        self.deviceDirs = (deviceDirs,) if isinstance(deviceDirs, str) else tuple(deviceDirs)
+        self.cacheFile = cacheFile
+        if (guid is not None) and not str(guid).isdigit():
+            raise BackupConfigError("guid of backup pool {} must be a decimal number, got '{}'".format(name, guid))
+        self.guid = str(guid) if guid is not None else None
 
     def __str__(self):
         return self.name
 
+    @property
+    def isRemote(self):
+        return False
+
     def determineBackupFileSystemName(self, fileSystem):
         """determine ZFS fileSystemName used to backup fileSystem (file systems can be name or zfs.FileSystem)"""
         return osp.normpath(self.name + "/" + (fileSystem if isinstance(fileSystem, str) else fileSystem.name))
 
+class RemoteBackupPoolConf(BackupPoolConf):
+    """Configuration of a backup pool on another host, accessed with ssh.
+    All commands to the host use one multiplexed ssh connection.
+    host - host name of the backup pool
+    user - if not None, user to log in as, this user must be able to run zfs and zpool
+    port - if not None, ssh port
+    compression - compress the ssh connection, including the send streams
+    sshCommand - ssh command, as a string or sequence.  Connections use ssh BatchMode,
+    so keys must be configured.
+    Other arguments are as with BackupPoolConf."""
+    def __init__(self, name, host, bufferSize=None, sendOptions=(), user=None, port=None, compression=False, sshCommand="ssh",
+                 deviceDirs=(), cacheFile=None, guid=None):
+        super(RemoteBackupPoolConf, self).__init__(name, bufferSize=bufferSize, sendOptions=sendOptions,
+                                                   deviceDirs=deviceDirs, cacheFile=cacheFile, guid=guid)
+        self.host = host
+        self.user = user
+        self.port = port
+        self.compression = compression
+        self.sshCommand = sshCommand
+
+    @property
+    def isRemote(self):
+        return True
+
 class BackupSetConf(object):
     """Configuration of a backup set.  A backup set consists of a set of file systems
     and a set of rotating backup pools use to backup those file systems.
+    Source file systems and backup pools are indexed by name.
     """
 
-    def __init__(self, name, sourceFileSystemSpecs, backupPoolConfs):
-        "sourceFileSystemSpecs can be ZFS file system names or SourceFileSystemConf objects"
+    def __init__(self, name, sourceFileSystemSpecs, backupPoolConfs, jobs=1, collapseIncrementals=False,
+                 transferOrder="config", rateLimit=None, schedule=None, snapSchedule=None):
+        """sourceFileSystemSpecs can be ZFS file system names or SourceFileSystemConf objects.
+        jobs is the number of file systems to backup concurrently to the backup pool.
+        If collapseIncrementals is True, all snapshots from the newest one in common
+        with the backup pool are sent in a single send -I stream rather than an
+        incremental per snapshot.  This also sends other snapshots of the file system
+        in that range.  transferOrder is the order file systems are backed up,
+        one of "config", "largest" or "smallest", the later two order by the
+        estimated size of the sends.  rateLimit, if not None, limits the combined
+        rate of the sends of the backup set, see parseRateLimit().  schedule and
+        snapSchedule are crontab style schedules, such as "0 2 * * *", used by
+        the daemon to backup the set and to only snapshot it."""
         if not name.isalnum():  # used as a separator in snapshot names
             raise BackupConfigError("backup set name may only contain alpha-numeric characters, got '{}'".format(name))
+        if jobs < 1:
+            raise BackupConfigError("backup set jobs must be at least 1, got {}".format(jobs))
+        if transferOrder not in transferOrders:
+            raise BackupConfigError("transferOrder must be one of {}, got '{}'".format(", ".join(transferOrders), transferOrder))
         self.name = name
+        self.jobs = jobs
+        self.collapseIncrementals = collapseIncrementals
+        self.transferOrder = transferOrder
+        self.rateLimit = parseRateLimit(rateLimit)
+        self.schedule = parseSchedule(schedule)
+        self.snapSchedule = parseSchedule(snapSchedule)
         self.sourceFileSystemConfs = self._buildSourceFileSystemConfs(sourceFileSystemSpecs)
+        self.bySourceFileSystemName = {fs.name: fs for fs in self.sourceFileSystemConfs}
         self.backupPoolConfs = tuple(backupPoolConfs)
         self.byBackupPoolName = OrderedDict()
         for backupPoolConf in self.backupPoolConfs:
@@ -77,58 +201,184 @@ class BackupSetConf(object):
 
     def getBackupPoolConf(self, backupPoolName):
         backupPoolConf = self.byBackupPoolName.get(backupPoolName)
-        if backupPoolName is None:
+        if backupPoolConf is None:
             raise BackupConfigError("backup pool {} not part of backup set {}".format(backupPoolName, self.name))
         return backupPoolConf
 
     def findSourceFileSystem(self, sourceFileSystemName):
         "find source file system, or None"
-        for fs in self.sourceFileSystemConfs:
-            if fs.name == sourceFileSystemName:
-                return fs
-        return None
+        return self.bySourceFileSystemName.get(sourceFileSystemName)
+
+    def getSendOptions(self, sourceFileSystemName, backupPoolName):
+        "zfs send options for a source file system to a backup pool"
+        fs = self.findSourceFileSystem(sourceFileSystemName)
+        if (fs is not None) and (fs.sendOptions is not None):
+            return fs.sendOptions
+        return self.getBackupPoolConf(backupPoolName).sendOptions
 
     def getSourceFileSystem(self, sourceFileSystemName):
         "get source file system, or error"
         fs = self.findSourceFileSystem(sourceFileSystemName)
         if fs is None:
-            raise BackupConfigError("can't find source file system: {} in BackupSet".format(sourceFileSystemName. self.name))
+            raise BackupConfigError("can't find source file system: {} in BackupSet {}".format(sourceFileSystemName, self.name))
         return fs
 
 class BackupConf(object):
-    "Configuration of backups"
+    """Configuration of backups.  Backup sets are indexed by name, source file
+    system and backup pool name when created and checked for consistency, so
+    the backup sets must not be modified afterwards."""
     def __init__(self, backupSets, lockFile="/var/run/zfszipper.lock", recordFilePattern=None,
-                 syslogFacility=None, syslogLevel="info", stderrLogging=False):
+                 syslogFacility=None, syslogLevel="info", stderrLogging=False,
+                 parallelSets=False, maxSourcePoolStreams=None, progressFile=None, spaceCheck=None, exportTimeout=300.0,
+                 rateLimit=None, rateControlFile=None, statusSocket="/var/run/zfszipper.sock", watchInterval=30.0,
+                 lockTimeout=0.0, poolDeviceCacheFile=None, fullImportScan=None):
         """
-        lockFile - lock file to use, defaults to /var/run/zfszipper.lock
+        lockFile - prefix of the lock files used to lock backup pools and source file systems, defaults
+          to /var/run/zfszipper.lock, giving files such as /var/run/zfszipper.lock.pool.zackup1a
         recordFilePattern - Pattern used to create TSV record file of backups.  Formatted with strftime with current GMT to make a file path
         syslogFacility - if specified, use log with syslog and log to this facility
         syslogLevel - use this syslog level is syslogFacility is specified, defaults to `info'.
+        parallelSets - backup all backup sets with available pools concurrently, sets sharing a backup pool are run one after another
+        maxSourcePoolStreams - if not None, the maximum number of concurrent sends from a source pool across all backup sets
+        progressFile - if not None, JSON file that is updated with the progress of running sends
+        spaceCheck - estimate the size of sends before starting and check against the space on the backup pool,
+          one of "warn", "refuse", or "trim", defaults to None, which doesn't check
+        exportTimeout - seconds to wait for an imported backup pool to become idle, so it can be exported
+          cleanly, before forcing the export
+        rateLimit - if not None, limit on the combined rate of all sends, see parseRateLimit()
+        rateControlFile - if not None, file used to change rate limits while backups are running,
+          with lines of `name rate', where name is `global' or a backup set name
+        statusSocket - Unix socket where the daemon reports it's status, None to disable
+        watchInterval - seconds between checks for attached backup pools when watching for them, each check
+          only lists the imported pools and runs the targeted searches of the backup pools
+        lockTimeout - seconds to wait for backup pools and source file systems used by another run to
+          become free, zero fails immediately
+        poolDeviceCacheFile - if not None, JSON file recording the devices of local backup pools when they are
+          imported, so they are found later by probing those devices
+        fullImportScan - if None, all local devices are scanned for exported pools only when a local backup
+          pool has no deviceDirs or cacheFile, True always scans them and False only searches the deviceDirs and
+          cacheFile of backup pools and the devices in poolDeviceCacheFile
         """
-        self.backupSets = backupSets
+        self.backupSets = tuple(backupSets)
+        self._buildIndexes()
         self.lockFile = lockFile
-        self.recordFile = time.strftime(recordFilePattern, time.gmtime()) if recordFilePattern is not None else None
+        self.recordFilePattern = recordFilePattern
+        self.updateRecordFile()
         self.syslogFacility = loggingOps.parseFacility(syslogFacility) if syslogFacility is not None else None
         self.syslogLevel = loggingOps.parseLevel(syslogLevel)
         self.stderrLogging = stderrLogging
+        self.parallelSets = parallelSets
+        if (maxSourcePoolStreams is not None) and (maxSourcePoolStreams < 1):
+            raise BackupConfigError("maxSourcePoolStreams must be at least 1, got {}".format(maxSourcePoolStreams))
+        self.maxSourcePoolStreams = maxSourcePoolStreams
+        self.progressFile = progressFile
+        if (spaceCheck is not None) and (spaceCheck not in spaceCheckPolicies):
+            raise BackupConfigError("spaceCheck must be None or one of {}, got '{}'".format(", ".join(spaceCheckPolicies), spaceCheck))
+        self.spaceCheck = spaceCheck
+        if exportTimeout < 0:
+            raise BackupConfigError("exportTimeout must not be negative, got {}".format(exportTimeout))
+        self.exportTimeout = exportTimeout
+        self.rateLimit = parseRateLimit(rateLimit)
+        self.rateControlFile = rateControlFile
+        self.statusSocket = statusSocket
+        if watchInterval <= 0:
+            raise BackupConfigError("watchInterval must be greater than zero, got {}".format(watchInterval))
+        self.watchInterval = watchInterval
+        if lockTimeout < 0:
+            raise BackupConfigError("lockTimeout must not be negative, got {}".format(lockTimeout))
+        self.lockTimeout = lockTimeout
+        self.poolDeviceCacheFile = poolDeviceCacheFile
+        self.fullImportScan = fullImportScan
 
-    def getBackupSet(self, backupSetName) -> BackupSetConf:
+    def updateRecordFile(self):
+        "set recordFile from the pattern and the current time, long running processes call this before each run"
+        self.recordFile = time.strftime(self.recordFilePattern, time.gmtime()) if self.recordFilePattern is not None else None
+
+    def _buildIndexes(self):
+        self.byBackupSetName = {}
+        self.backupSetsBySourceFileSystemName = {}
+        self.backupSetsByBackupPoolName = {}
         for backupSet in self.backupSets:
-            if backupSet.name == backupSetName:
-                return backupSet
-        raise BackupConfigError("unknown backup set: {}".format(backupSetName))
+            if not isinstance(backupSet, BackupSetConf):
+                raise BackupConfigError("backup set is not an instance of BackupSetConf: " + str(type(backupSet)))
+            if backupSet.name in self.byBackupSetName:
+                raise BackupConfigError("multiple backup sets named " + backupSet.name)
+            self.byBackupSetName[backupSet.name] = backupSet
+            for sourceFileSystemConf in backupSet.sourceFileSystemConfs:
+                self.backupSetsBySourceFileSystemName.setdefault(sourceFileSystemConf.name, []).append(backupSet)
+            for backupPoolName in backupSet.backupPoolNames:
+                self.backupSetsByBackupPoolName.setdefault(backupPoolName, []).append(backupSet)
+
+    def getBackupSet(self, backupSetName) -> BackupSetConf:
+        backupSet = self.byBackupSetName.get(backupSetName)
+        if backupSet is None:
+            raise BackupConfigError("unknown backup set: {}".format(backupSetName))
+        return backupSet
 
     def findSourceFileSystemBackupSets(self, sourceFileSystemName) -> list[BackupSetConf]:
         """return list of backupSets containing source file system or empty list"""
-        backupSets = []
-        for backupSet in self.backupSets:
-            fs = backupSets.findSourceFileSystem(sourceFileSystemName)
-            if fs is not None:
-                backupSets.append(fs)
-        return backupSets
+        return list(self.backupSetsBySourceFileSystemName.get(sourceFileSystemName, ()))
+
+    def findBackupPoolBackupSets(self, backupPoolName) -> list[BackupSetConf]:
+        """return list of backupSets containing backup pool or empty list"""
+        return list(self.backupSetsByBackupPoolName.get(backupPoolName, ()))
+
+# changed when the cached form of the configuration changes
+configCacheVersion = 2
+
+# modules defining the classes of the objects in the cached configuration
+_configCacheModules = (__name__, RateSchedule.__module__, CronSchedule.__module__)
+
+def _configCacheKey(configPyFile):
+    """key identifying a configuration file version, the modules of the cached
+    objects are included so changes to their classes invalidate the cache"""
+    confStat = os.stat(configPyFile)
+    moduleMtimes = tuple(os.stat(sys.modules[name].__file__).st_mtime_ns for name in _configCacheModules)
+    return (configCacheVersion, osp.realpath(configPyFile), confStat.st_mtime_ns, confStat.st_size, moduleMtimes)
+
+def _readConfigCache(cacheFile, key):
+    "read the cached configuration if it matches key, otherwise None"
+    try:
+        with open(cacheFile, "rb") as fh:
+            if pickle.load(fh) != key:
+                return None
+            config = pickle.load(fh)
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        logger.warning("ignoring invalid configuration cache {}: {}".format(cacheFile, ex))
+        return None
+    config.updateRecordFile()
+    return config
+
+def _writeConfigCache(cacheFile, key, config):
+    "atomically write cache, failures are logged and ignored"
+    tmpFile = cacheFile + ".tmp"
+    try:
+        with open(os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as fh:
+            pickle.dump(key, fh)
+            pickle.dump(config, fh)
+        os.replace(tmpFile, cacheFile)
+    except Exception as ex:
+        logger.warning("can't write configuration cache {}: {}".format(cacheFile, ex))
+
+def evalConfigFile(configPyFile, cacheFile=None):
+    """evaluate file and return BackupConf object.  If cacheFile is not None,
+    the checked and indexed configuration is cached in it, and used while the
+    configuration file is unchanged.  Only the modification time and size of
+    configPyFile are checked, not files it includes.  The cache is a pickle,
+    so it must be in a directory only writable by the user running backups."""
+    if cacheFile is not None:
+        key = _configCacheKey(configPyFile)
+        config = _readConfigCache(cacheFile, key)
+        if config is not None:
+            return config
+    config = _evalConfigFile(configPyFile)
+    if cacheFile is not None:
+        _writeConfigCache(cacheFile, key, config)
+    return config
 
-def evalConfigFile(configPyFile):
-    "evaluate file and return BackupConf object"
+def _evalConfigFile(configPyFile):
     configEnv = {}
     with open(configPyFile) as fh:
         exec(fh.read(), configEnv, configEnv)
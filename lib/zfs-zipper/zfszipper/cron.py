@@ -0,0 +1,103 @@
+"""
+Cron-like schedules for the backup daemon.
+"""
+import time
+
+class CronError(Exception):
+    "error in a schedule specification"
+    pass
+
+_dayNames = ("sun", "mon", "tue", "wed", "thu", "fri", "sat")
+_monthNames = ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec")
+
+
+class CronSchedule(object):
+    """Schedule in the five field crontab(5) form:
+        minute hour day-of-month month day-of-week
+    fields are `*', numbers, ranges (1-5), lists (1,3,5) and steps (*/15, 8-18/2);
+    months and days of the week maybe given as three letter names.  Day of
+    week 0 or 7 is Sunday.  As with cron, if both day of month and day of week
+    are restricted, that is they don't start with `*', a day matching either
+    is used, so `*/2' isn't a restriction.  The aliases @hourly,
+    @daily, @weekly and @monthly are also accepted.  Times are local time."""
+    # (name, min, max, names)
+    fields = (("minute", 0, 59, None),
+              ("hour", 0, 23, None),
+              ("day-of-month", 1, 31, None),
+              ("month", 1, 12, _monthNames),
+              ("day-of-week", 0, 7, _dayNames))
+    aliases = {"@hourly": "0 * * * *",
+               "@daily": "0 0 * * *",
+               "@weekly": "0 0 * * 0",
+               "@monthly": "0 0 1 * *"}
+
+    def __init__(self, spec):
+        self.spec = spec
+        words = self.aliases.get(spec.strip(), spec).split()
+        if len(words) != len(self.fields):
+            raise CronError("schedule must have {} fields: minute hour day-of-month month day-of-week, got '{}'"
+                            .format(len(self.fields), spec))
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [self._parseField(word, field) for word, field in zip(words, self.fields)]
+        if 7 in self.weekdays:
+            self.weekdays = self.weekdays | {0}
+        self.dayRestricted = not words[2].startswith("*")
+        self.weekdayRestricted = not words[4].startswith("*")
+
+    def __str__(self):
+        return self.spec
+
+    def _parseValue(self, value, field):
+        name, low, high, names = field
+        if (names is not None) and (value.lower() in names):
+            return names.index(value.lower()) + (low if name == "month" else 0)
+        if not value.isdigit():
+            raise CronError("invalid {} '{}' in schedule '{}'".format(name, value, self.spec))
+        value = int(value)
+        if not (low <= value <= high):
+            raise CronError("{} {} out of range {}-{} in schedule '{}'".format(name, value, low, high, self.spec))
+        return value
+
+    def _parseRange(self, part, field):
+        rangeSpec, step = part, 1
+        if "/" in part:
+            rangeSpec, stepSpec = part.split("/", 1)
+            if (not stepSpec.isdigit()) or (int(stepSpec) == 0):
+                raise CronError("invalid step '{}' in schedule '{}'".format(stepSpec, self.spec))
+            step = int(stepSpec)
+        if rangeSpec == "*":
+            start, end = field[1], field[2]
+        elif "-" in rangeSpec:
+            start, end = [self._parseValue(v, field) for v in rangeSpec.split("-", 1)]
+        else:
+            start = self._parseValue(rangeSpec, field)
+            end = field[2] if "/" in part else start
+        if start > end:
+            raise CronError("invalid range '{}' in schedule '{}'".format(rangeSpec, self.spec))
+        return set(range(start, end + 1, step))
+
+    def _parseField(self, word, field):
+        values = set()
+        for part in word.split(","):
+            values |= self._parseRange(part, field)
+        return frozenset(values)
+
+    def _dayMatches(self, localTime):
+        dayMatch = localTime.tm_mday in self.days
+        weekdayMatch = ((localTime.tm_wday + 1) % 7) in self.weekdays  # tm_wday is 0 for Monday
+        if self.dayRestricted and self.weekdayRestricted:
+            return dayMatch or weekdayMatch
+        return dayMatch and weekdayMatch
+
+    def matches(self, localTime):
+        "does a time.struct_time fall in a scheduled minute"
+        return ((localTime.tm_min in self.minutes) and (localTime.tm_hour in self.hours)
+                and (localTime.tm_mon in self.months) and self._dayMatches(localTime))
+
+    def nextTime(self, after, maxDays=31, localtime=time.localtime):
+        """return the start of the first scheduled minute after the time after,
+        in seconds since the epoch, or None if not within maxDays"""
+        minute = int(after // 60) + 1
+        for m in range(minute, minute + maxDays * 24 * 60):
+            if self.matches(localtime(m * 60)):
+                return m * 60
+        return None
@@ -0,0 +1,258 @@
+"""
+Long running backup daemon.  Backup sets are run on cron-like schedules by
+a single process, which keeps the configuration and ZFS state in memory
+between runs.  Status is available as JSON on a local Unix socket.
+"""
+import os
+import json
+import socket
+import time
+import threading
+import socketserver
+import logging
+logger = logging.getLogger()
+
+class DaemonError(Exception):
+    "error running the daemon"
+    pass
+
+def _formatTime(secs):
+    return time.strftime("%Y-%m-%dT%T", time.localtime(secs)) if secs is not None else None
+
+
+class DaemonJob(object):
+    """A scheduled run of a backup set.  The kind is "backup" or "snapOnly",
+    schedule is a cron.CronSchedule, or None for a job that is only run
+    on request.  The results of the last run are kept for status reporting.
+    The next scheduled run is computed when first asked for and again after
+    each run, as finding it searches the schedule minute by minute."""
+    kinds = ("backup", "snapOnly")
+
+    def __init__(self, backupSetName, kind, schedule):
+        if kind not in self.kinds:
+            raise ValueError("invalid job kind '{}', expected one of {}".format(kind, ", ".join(self.kinds)))
+        self.backupSetName = backupSetName
+        self.kind = kind
+        self.schedule = schedule
+        self.running = False
+        self.runs = 0
+        self.lastStart = None
+        self.lastEnd = None
+        self.lastResult = None
+        self.lastError = None
+        self._nextRun = None  # (time,) of the next scheduled run, None if not computed
+
+    @property
+    def key(self):
+        return (self.backupSetName, self.kind)
+
+    def __str__(self):
+        return "{} {}".format(self.kind, self.backupSetName)
+
+    def copyState(self, other):
+        "keep the run history of a job replaced when the configuration is reloaded"
+        self.runs = other.runs
+        self.lastStart = other.lastStart
+        self.lastEnd = other.lastEnd
+        self.lastResult = other.lastResult
+        self.lastError = other.lastError
+
+    def nextRunTime(self, now):
+        "time of the next scheduled run after now, or None if not scheduled"
+        if self.schedule is None:
+            return None
+        if self._nextRun is None:
+            self._nextRun = (self.schedule.nextTime(now),)
+        return self._nextRun[0]
+
+    def resetNextRun(self):
+        "recompute the next scheduled run when it's next asked for, called after running"
+        self._nextRun = None
+
+    def toDict(self, now):
+        return {"backupSet": self.backupSetName,
+                "kind": self.kind,
+                "schedule": str(self.schedule) if self.schedule is not None else None,
+                "running": self.running,
+                "runs": self.runs,
+                "lastStart": _formatTime(self.lastStart),
+                "lastEnd": _formatTime(self.lastEnd),
+                "lastResult": self.lastResult,
+                "lastError": self.lastError,
+                "nextRun": _formatTime(self.nextRunTime(now))}
+
+
+class _StatusHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write((json.dumps(self.server.daemon.status(), indent=2) + "\n").encode())
+
+
+class _StatusServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketPath, daemon):
+        self.daemon = daemon
+        super(_StatusServer, self).__init__(socketPath, _StatusHandler)
+
+
+class BackupDaemon(object):
+    """Run DaemonJobs when they are scheduled.  Jobs are checked at the start
+    of each minute and run one at a time by calling runJob(job), which returns
+    a result description or None for success, or raises an exception on
+    failure.  A job scheduled during minutes that were spent running other
+    jobs is run once when they finish.  Other threads may request a backup set
+    be run with requestRun(), requests are run ahead of scheduled jobs.  The
+    optional onTick function is called each minute before jobs are checked,
+    it may call setJobs().  If
+    statusSocket is not None, it is the path of a Unix socket that returns the
+    status as JSON to each connection.  The clock functions can be replaced for
+    testing."""
+    # maximum minutes back to look for missed jobs
+    maxCatchUpMinutes = 24 * 60
+
+    def __init__(self, jobs, runJob, *, onTick=None, statusSocket=None, clock=time.time, localtime=time.localtime):
+        self.jobs = list(jobs)
+        self.runJob = runJob
+        self.onTick = onTick
+        self.statusSocket = statusSocket
+        self.clock = clock
+        self.localtime = localtime
+        self.lock = threading.Lock()
+        self.wakeEvent = threading.Event()
+        self.stopping = False
+        self.requested = []
+        self.startTime = clock()
+        self._server = None
+
+    def setJobs(self, jobs):
+        "replace the jobs, keeping the history of jobs with the same backup set and kind"
+        with self.lock:
+            oldJobs = {job.key: job for job in self.jobs}
+            for job in jobs:
+                if job.key in oldJobs:
+                    job.copyState(oldJobs[job.key])
+            self.jobs = list(jobs)
+
+    def dueJobs(self, afterMinute, throughMinute):
+        """jobs scheduled in the minutes (since the epoch) after afterMinute up to
+        and including throughMinute, each job is returned once, in order"""
+        minutes = range(max(afterMinute + 1, throughMinute + 1 - self.maxCatchUpMinutes), throughMinute + 1)
+        localTimes = [self.localtime(m * 60) for m in minutes]
+        with self.lock:
+            return [job for job in self.jobs
+                    if (job.schedule is not None) and any([job.schedule.matches(lt) for lt in localTimes])]
+
+    def requestRun(self, backupSetName):
+        """backup a set as soon as the running job completes, a set that is
+        already requested is only run once"""
+        with self.lock:
+            job = None
+            for j in self.jobs:
+                if j.key == (backupSetName, "backup"):
+                    job = j
+            if job is None:
+                job = DaemonJob(backupSetName, "backup", None)
+                self.jobs.append(job)
+            if job not in self.requested:
+                logger.info("daemon: requested {}".format(job))
+                self.requested.append(job)
+        self.wakeEvent.set()
+
+    def runRequested(self):
+        "run requested jobs"
+        while not self.stopping:
+            with self.lock:
+                if len(self.requested) == 0:
+                    break
+                job = self.requested.pop(0)
+            self._runJob(job)
+
+    def _runJob(self, job):
+        logger.info("daemon: start {}".format(job))
+        with self.lock:
+            job.running = True
+            job.runs += 1
+            job.lastStart = self.clock()
+        try:
+            result = self.runJob(job)
+            job.lastResult = result if result is not None else "ok"
+            job.lastError = None
+        except Exception as ex:
+            logger.exception("daemon: {} failed".format(job))
+            job.lastResult = "failed"
+            job.lastError = str(ex)
+        finally:
+            with self.lock:
+                job.running = False
+                job.lastEnd = self.clock()
+                job.resetNextRun()
+        logger.info("daemon: finished {}: {}".format(job, job.lastResult))
+
+    def runDue(self, afterMinute, throughMinute):
+        "run jobs due in the range of minutes"
+        for job in self.dueJobs(afterMinute, throughMinute):
+            if self.stopping:
+                break
+            self._runJob(job)
+
+    def status(self):
+        "status as a dict that can be converted to JSON"
+        now = self.clock()
+        with self.lock:
+            return {"time": _formatTime(now),
+                    "pid": os.getpid(),
+                    "started": _formatTime(self.startTime),
+                    "jobs": [job.toDict(now) for job in self.jobs]}
+
+    def _socketInUse(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.statusSocket)
+                return True
+            except OSError:
+                return False
+
+    def _startStatusServer(self):
+        if self.statusSocket is None:
+            return
+        if os.path.exists(self.statusSocket):
+            if self._socketInUse():
+                raise DaemonError("status socket {} is in use, is another daemon running?".format(self.statusSocket))
+            os.unlink(self.statusSocket)  # left by a daemon that didn't exit cleanly
+        self._server = _StatusServer(self.statusSocket, self)
+        os.chmod(self.statusSocket, 0o600)
+        threading.Thread(target=self._server.serve_forever, name="statusServer", daemon=True).start()
+
+    def _stopStatusServer(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            os.unlink(self.statusSocket)
+            self._server = None
+
+    def run(self):
+        "run until stop() is called"
+        logger.info("daemon: started with {} scheduled jobs".format(len(self.jobs)))
+        self._startStatusServer()
+        try:
+            lastMinute = int(self.clock() // 60)
+            while True:
+                self.wakeEvent.wait(max(0.0, (lastMinute + 1) * 60 - self.clock()))
+                self.wakeEvent.clear()
+                if self.stopping:
+                    break
+                self.runRequested()
+                minute = int(self.clock() // 60)
+                if minute > lastMinute:
+                    if self.onTick is not None:
+                        self.onTick()
+                    self.runDue(lastMinute, minute)
+                    lastMinute = minute
+        finally:
+            self._stopStatusServer()
+        logger.info("daemon: stopped")
+
+    def stop(self):
+        "stop after the running job finishes, can be called from a signal handler"
+        self.stopping = True
+        self.wakeEvent.set()
@@ -0,0 +1,62 @@
+"""
+Locking of backup pools and source file systems, so that runs using
+different resources, such as backups of different backup sets or a
+snapshot-only run, can overlap.
+"""
+import fcntl
+import time
+from urllib.parse import quote
+from contextlib import contextmanager, ExitStack
+import logging
+logger = logging.getLogger()
+
+class LockError(Exception):
+    "a lock couldn't be obtained"
+    pass
+
+class ResourceLocks(object):
+    """Exclusive locks on backup pools and source file systems.  Each resource
+    has a lock file, named by appending the kind and quoted name to
+    lockFilePrefix, that is locked with flock().  These locks also exclude
+    other threads of this process, as each lock opens the file.  The locks
+    for a run are always acquired in sorted order, so runs waiting on each
+    other can't deadlock.  Locks are polled for, waiting up to timeout seconds
+    in total; a timeout of zero fails immediately if a resource is in use."""
+    def __init__(self, lockFilePrefix, timeout=0.0, pollInterval=0.25):
+        self.lockFilePrefix = lockFilePrefix
+        self.timeout = timeout
+        self.pollInterval = pollInterval
+
+    def lockFile(self, kind, name):
+        return "{}.{}.{}".format(self.lockFilePrefix, kind, quote(name, safe=""))
+
+    def _lockOne(self, kind, name, deadline):
+        "open and lock file, returning it, or raise LockError after the deadline"
+        lockFile = self.lockFile(kind, name)
+        fh = open(lockFile, "w")
+        waited = False
+        while True:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fh
+            except BlockingIOError:
+                pass
+            if time.monotonic() >= deadline:
+                fh.close()
+                raise LockError("can't lock {} {} with {}{}, is another backup using it?"
+                                .format(kind, name, lockFile, " after {} sec".format(self.timeout) if self.timeout > 0 else ""))
+            if not waited:
+                logger.info("waiting for lock on {} {}".format(kind, name))
+                waited = True
+            time.sleep(min(self.pollInterval, max(0.0, deadline - time.monotonic())))
+
+    @contextmanager
+    def hold(self, backupPoolNames=(), fileSystemNames=()):
+        """context manager that locks the backup pools and source file systems, releasing
+        them on exit"""
+        resources = sorted(set([("pool", n) for n in backupPoolNames] + [("fs", n) for n in fileSystemNames]))
+        deadline = time.monotonic() + self.timeout
+        with ExitStack() as stack:
+            for kind, name in resources:
+                stack.enter_context(self._lockOne(kind, name, deadline))
+            yield
@@ -0,0 +1,121 @@
+"""
+Serializable backup plans.  A plan records the transfer steps needed to bring
+the backup pools up to date, determined without moving any data.  It is
+written as JSON, so it can be reviewed, and later executed.
+"""
+import json
+from collections import namedtuple
+from .snapshots import BackupSnapshot
+from .typeOps import currentGmtTimeStr
+
+# version of the JSON format
+planFormatVersion = 1
+
+class PlanError(Exception):
+    "error in a saved plan"
+    pass
+
+
+class TransferStep(namedtuple("TransferStep", ("kind", "prevSourceSnapshot", "sourceSnapshot", "estimate"))):
+    """A send planned by FsBackup.  The kind is one of "full", "incr", "incrRange"
+    (a single send -I) or "resume".  The snapshots are BackupSnapshot objects,
+    prevSourceSnapshot is None for a full, sourceSnapshot is None for the new
+    snapshot created when the step is run.  The estimate is the stream size in
+    bytes, or None if not estimated."""
+    __slots__ = ()
+    kinds = ("full", "incr", "incrRange", "resume")
+
+    def sameTransfer(self, other):
+        "do the steps send the same snapshots, ignoring the estimate"
+        return self._replace(estimate=None) == other._replace(estimate=None)
+
+    def toDict(self):
+        return {"kind": self.kind,
+                "base": self.prevSourceSnapshot.getSnapshotName() if self.prevSourceSnapshot is not None else None,
+                "target": self.sourceSnapshot.getSnapshotName() if self.sourceSnapshot is not None else None,
+                "estimate": self.estimate}
+
+    @classmethod
+    def fromDict(cls, data):
+        if data["kind"] not in cls.kinds:
+            raise PlanError("invalid transfer step kind '{}', expected one of {}".format(data["kind"], ", ".join(cls.kinds)))
+
+        def parseSnapshot(name):
+            return BackupSnapshot.createFromSnapshotName(name, requireFileSystem=True) if name is not None else None
+
+        return cls(data["kind"], parseSnapshot(data["base"]), parseSnapshot(data["target"]), data["estimate"])
+
+
+class FsPlan(namedtuple("FsPlan", ("sourceFileSystemName", "backupFileSystemName", "steps"))):
+    "planned transfer steps for one file system"
+    __slots__ = ()
+
+    @property
+    def estimatedSize(self):
+        return sum([step.estimate for step in self.steps if step.estimate is not None])
+
+    def toDict(self):
+        return {"sourceFileSystem": self.sourceFileSystemName,
+                "backupFileSystem": self.backupFileSystemName,
+                "estimatedSize": self.estimatedSize,
+                "steps": [step.toDict() for step in self.steps]}
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls(data["sourceFileSystem"], data["backupFileSystem"],
+                   tuple([TransferStep.fromDict(s) for s in data["steps"]]))
+
+
+class BackupSetPlan(namedtuple("BackupSetPlan", ("backupSetName", "backupPoolName", "available", "fileSystems"))):
+    """planned transfers for a backup set to a backup pool, along with the space
+    available on the pool when planned"""
+    __slots__ = ()
+
+    @property
+    def estimatedSize(self):
+        return sum([fsPlan.estimatedSize for fsPlan in self.fileSystems])
+
+    def toDict(self):
+        return {"backupSet": self.backupSetName,
+                "backupPool": self.backupPoolName,
+                "available": self.available,
+                "estimatedSize": self.estimatedSize,
+                "fileSystems": [fsPlan.toDict() for fsPlan in self.fileSystems]}
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls(data["backupSet"], data["backupPool"], data["available"],
+                   tuple([FsPlan.fromDict(f) for f in data["fileSystems"]]))
+
+
+class BackupPlan(namedtuple("BackupPlan", ("created", "backupSets"))):
+    "plan for a run, created is the GMT time it was made"
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, backupSetPlans):
+        return cls(currentGmtTimeStr(), tuple(backupSetPlans))
+
+    def toDict(self):
+        return {"version": planFormatVersion,
+                "created": self.created,
+                "backupSets": [setPlan.toDict() for setPlan in self.backupSets]}
+
+    @classmethod
+    def fromDict(cls, data):
+        if data.get("version") != planFormatVersion:
+            raise PlanError("unsupported plan format version {}, expected {}".format(data.get("version"), planFormatVersion))
+        return cls(data["created"], tuple([BackupSetPlan.fromDict(s) for s in data["backupSets"]]))
+
+
+def writePlan(plan, planFile):
+    with open(planFile, "w") as fh:
+        json.dump(plan.toDict(), fh, indent=2)
+        fh.write("\n")
+
+def readPlan(planFile):
+    try:
+        with open(planFile) as fh:
+            return BackupPlan.fromDict(json.load(fh))
+    except (ValueError, KeyError, TypeError) as ex:
+        raise PlanError("invalid plan file {}: {}".format(planFile, ex)) from ex
@@ -0,0 +1,146 @@
+"""
+Progress reporting of running zfs send streams.  zfs send -P -v writes the
+estimated stream size, followed by a line per second with the number of bytes
+sent so far, these are parsed as they arrive and reported in the log and an
+optional machine-readable JSON progress file.
+"""
+import os
+import re
+import json
+import time
+import threading
+import logging
+logger = logging.getLogger()
+
+# 13:10:30	1234567	pool/fs@snap
+_progressTimeRe = re.compile("^[0-9]{2}:[0-9]{2}:[0-9]{2}$")
+
+def isSendProgressRow(row):
+    "is a row split from zfs send -P -v output a periodic progress row"
+    return (len(row) == 3) and (_progressTimeRe.match(row[0]) is not None)
+
+def isSendProgressLine(line):
+    "is a line of zfs send -P -v output a periodic progress line"
+    return isSendProgressRow(line.rstrip("\n").split("\t"))
+
+def formatDuration(secs):
+    secs = int(secs)
+    return "{}:{:02}:{:02}".format(secs // 3600, (secs // 60) % 60, secs % 60)
+
+
+class SendProgress(object):
+    """progress of one zfs send stream.  Streams with multiple snapshots
+    (send -I), report bytes per snapshot, these are accumulated.  The estimate
+    is from the size line of send -P."""
+    def __init__(self, reporter, name):
+        self.reporter = reporter
+        self.name = name
+        self.estimate = None
+        self.bytes = 0
+        self.startTime = reporter.clock()
+        self.lastLogTime = self.startTime
+        self._doneBytes = 0  # completed snapshots in stream
+        self._snapshotName = None
+
+    @property
+    def elapsed(self):
+        return self.reporter.clock() - self.startTime
+
+    @property
+    def rate(self):
+        "bytes/sec"
+        elapsed = self.elapsed
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def percent(self):
+        "percent of estimate, or None if unknown"
+        if not self.estimate:
+            return None
+        return min(100.0, 100.0 * self.bytes / self.estimate)
+
+    @property
+    def eta(self):
+        "estimated seconds remaining, or None if unknown"
+        rate = self.rate
+        if (self.estimate is None) or (rate <= 0):
+            return None
+        return max(0.0, (self.estimate - self.bytes) / rate)
+
+    def stderrLine(self, line):
+        "callback for each line of zfs send stderr"
+        row = line.rstrip("\n").split("\t")
+        if (row[0] == "size") and (len(row) == 2):
+            self.estimate = int(row[1])
+        elif isSendProgressRow(row):
+            if row[2] != self._snapshotName:
+                self._doneBytes = self.bytes
+                self._snapshotName = row[2]
+            self.bytes = self._doneBytes + int(row[1])
+            self.reporter.updated(self)
+
+    def toDict(self):
+        return {"name": self.name,
+                "bytes": self.bytes,
+                "estimate": self.estimate,
+                "percent": self.percent,
+                "rate": self.rate,
+                "eta": self.eta,
+                "elapsed": self.elapsed}
+
+    def __str__(self):
+        desc = "{}: {} bytes".format(self.name, self.bytes)
+        if self.estimate is not None:
+            desc += " of {} ({:.0f}%)".format(self.estimate, self.percent)
+        desc += ", {:.0f} bytes/sec".format(self.rate)
+        if self.eta is not None:
+            desc += ", ETA " + formatDuration(self.eta)
+        return desc
+
+
+class ProgressReporter(object):
+    """Report progress of all active sends, which maybe running in multiple threads.
+    Progress is logged every logInterval seconds per transfer.  If progressFile is
+    not None, it is rewritten as JSON with the state of all active transfers
+    on each update.  The clock can be replaced for testing."""
+    def __init__(self, progressFile=None, logInterval=60, clock=time.monotonic):
+        self.progressFile = progressFile
+        self.logInterval = logInterval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.active = []
+
+    def start(self, name):
+        "start tracking a transfer, returning a SendProgress"
+        progress = SendProgress(self, name)
+        with self.lock:
+            self.active.append(progress)
+            self._writeProgressFile()
+        return progress
+
+    def finish(self, progress):
+        "finish tracking a transfer"
+        logger.info("send complete {}".format(progress))
+        with self.lock:
+            self.active.remove(progress)
+            self._writeProgressFile()
+
+    def updated(self, progress):
+        "called by SendProgress when bytes sent has changed"
+        now = self.clock()
+        with self.lock:
+            if (now - progress.lastLogTime) >= self.logInterval:
+                progress.lastLogTime = now
+                logger.info("send progress {}".format(progress))
+            self._writeProgressFile()
+
+    def _writeProgressFile(self):
+        "atomically replace progress file, must hold lock"
+        if self.progressFile is None:
+            return
+        state = {"time": time.strftime("%Y-%m-%dT%T", time.gmtime()),
+                 "transfers": [p.toDict() for p in self.active]}
+        tmpFile = self.progressFile + ".tmp"
+        with open(tmpFile, "w") as fh:
+            json.dump(state, fh, indent=2)
+        os.replace(tmpFile, self.progressFile)
@@ -0,0 +1,215 @@
+"""
+In-process buffering relay between two processes in a pipeline.  This
+decouples a bursty zfs send from a zfs receive that stalls on transaction
+group syncs, without requiring mbuffer to be installed.
+"""
+import os
+import sys
+import threading
+import time
+import logging
+from collections import deque
+logger = logging.getLogger()
+
+# Linux fcntl to set the size of a pipe, not in the fcntl module of all Python versions
+F_SETPIPE_SZ = 1031
+
+def _setPipeSize(fd, size):
+    "try to increase the kernel pipe buffer on Linux, quietly ignored if not possible"
+    if sys.platform.startswith("linux"):
+        try:
+            import fcntl
+            fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+        except OSError:
+            pass
+
+def _fileno(fileSpec):
+    return fileSpec if isinstance(fileSpec, int) else fileSpec.fileno()
+
+def _close(fileSpec):
+    try:
+        if isinstance(fileSpec, int):
+            os.close(fileSpec)
+        else:
+            fileSpec.close()
+    except OSError:
+        pass
+
+
+class RelayStats(object):
+    """statistics on a relay.  The high-water mark is the most data that was
+    buffered, the low-water mark is the least that was buffered when the
+    writer went to take data once the stream had started, zero indicates the
+    reader was starved.  Stalls count the times the reader had to wait for
+    space (sender blocked) or the writer had to wait for data (receiver
+    blocked).  Throttle time is the time the writer waited on rate limits."""
+    def __init__(self, bufferSize):
+        self.bufferSize = bufferSize
+        self.bytes = 0
+        self.highWater = 0
+        self.lowWater = None
+        self.fullStalls = 0
+        self.emptyStalls = 0
+        self.throttleSecs = 0.0
+        self.startTime = time.time()
+        self.endTime = None
+
+    @property
+    def elapsed(self):
+        return (self.endTime if self.endTime is not None else time.time()) - self.startTime
+
+    @property
+    def rate(self):
+        "bytes/sec"
+        elapsed = self.elapsed
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return ("relayed {} bytes in {:.1f} sec ({:.0f} bytes/sec), buffer {} bytes, high-water {}, low-water {}, "
+                "full stalls {}, empty stalls {}, throttled {:.1f} sec".format(self.bytes, self.elapsed, self.rate, self.bufferSize, self.highWater,
+                                                                               self.lowWater if self.lowWater is not None else 0,
+                                                                               self.fullStalls, self.emptyStalls, self.throttleSecs))
+
+
+class BufferRelay(object):
+    """Copy data from an input to an output through a memory buffer of up to
+    bufferSize bytes.  A reader thread does large reads from the input and a
+    writer thread drains the buffer to the output.  Input and output can be
+    file objects or file descriptors, they are owned by the relay and closed
+    when it completes.  Data must pass through user space to be buffered, so
+    splice() is not used; instead kernel pipe buffers are enlarged where the
+    OS allows it.
+
+    If the output is closed by the consumer, the input is closed so the
+    producer gets SIGPIPE; this is not an error for the relay, as it is
+    reported by the processes.
+
+    The rateLimiters are throttle.RateLimiter objects that the writer waits on
+    before each write, slowing the receive.  Once the buffer fills, the reader
+    stops, so zfs send blocks and its reads from the source pool are throttled
+    too.  Writes are split into throttleChunkSize pieces to smooth the rate.
+    """
+    defaultChunkSize = 1024 * 1024
+    throttleChunkSize = 64 * 1024
+
+    def __init__(self, bufferSize, chunkSize=defaultChunkSize, rateLimiters=()):
+        if bufferSize < 1:
+            raise ValueError("relay bufferSize must be at least 1 byte, got {}".format(bufferSize))
+        self.bufferSize = bufferSize
+        self.chunkSize = min(chunkSize, bufferSize)
+        self.rateLimiters = tuple(rateLimiters)
+        self.stats = RelayStats(bufferSize)
+        self._chunks = deque()
+        self._buffered = 0
+        self._eof = False
+        self._aborted = False
+        self._cond = threading.Condition()
+        self._threads = []
+        self._errors = []
+
+    def start(self, inSpec, outSpec):
+        "start relaying in background threads"
+        _setPipeSize(_fileno(inSpec), self.chunkSize)
+        _setPipeSize(_fileno(outSpec), self.chunkSize)
+        self.stats.startTime = time.time()
+        self._threads = [threading.Thread(target=self._reader, args=(inSpec,), name="relayReader", daemon=True),
+                         threading.Thread(target=self._writer, args=(outSpec,), name="relayWriter", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def _readChunk(self, infd):
+        "wait for space and read the next chunk, returning None on EOF or abort"
+        with self._cond:
+            if self._buffered + self.chunkSize > self.bufferSize:
+                self.stats.fullStalls += 1
+            while (self._buffered + self.chunkSize > self.bufferSize) and not self._aborted:
+                self._cond.wait()
+            if self._aborted:
+                return None
+        data = os.read(infd, self.chunkSize)
+        return data if len(data) > 0 else None
+
+    def _reader(self, inSpec):
+        try:
+            infd = _fileno(inSpec)
+            while True:
+                data = self._readChunk(infd)
+                if data is None:
+                    break
+                with self._cond:
+                    self._chunks.append(data)
+                    self._buffered += len(data)
+                    self.stats.highWater = max(self.stats.highWater, self._buffered)
+                    self._cond.notify_all()
+        except Exception as ex:
+            self._errors.append(ex)
+            self._abort()
+        finally:
+            _close(inSpec)
+            with self._cond:
+                self._eof = True
+                self._cond.notify_all()
+
+    def _takeChunk(self):
+        "wait for data, None is returned on EOF or abort"
+        with self._cond:
+            if (len(self._chunks) == 0) and not self._eof:
+                self.stats.emptyStalls += 1
+            while (len(self._chunks) == 0) and not (self._eof or self._aborted):
+                self._cond.wait()
+            if self._aborted or (len(self._chunks) == 0):
+                return None
+            if self.stats.bytes > 0:
+                self.stats.lowWater = self._buffered if self.stats.lowWater is None else min(self.stats.lowWater, self._buffered)
+            data = self._chunks.popleft()
+            self._buffered -= len(data)
+            self._cond.notify_all()
+            return data
+
+    def _writeAll(self, outfd, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(outfd, view):]
+
+    def _throttledWrite(self, outfd, data):
+        for start in range(0, len(data), self.throttleChunkSize):
+            piece = data[start:start + self.throttleChunkSize]
+            for rateLimiter in self.rateLimiters:
+                self.stats.throttleSecs += rateLimiter.consume(len(piece))
+            self._writeAll(outfd, piece)
+
+    def _writer(self, outSpec):
+        try:
+            outfd = _fileno(outSpec)
+            while True:
+                data = self._takeChunk()
+                if data is None:
+                    break
+                if len(self.rateLimiters) > 0:
+                    self._throttledWrite(outfd, data)
+                else:
+                    self._writeAll(outfd, data)
+                self.stats.bytes += len(data)
+        except BrokenPipeError:
+            self._abort()  # consumer exited, will be reported by it
+        except Exception as ex:
+            self._errors.append(ex)
+            self._abort()
+        finally:
+            _close(outSpec)
+
+    def _abort(self):
+        with self._cond:
+            self._aborted = True
+            self._chunks.clear()
+            self._buffered = 0
+            self._cond.notify_all()
+
+    def wait(self):
+        "wait for relay to complete, raising an exception if the relay failed"
+        for thread in self._threads:
+            thread.join()
+        self.stats.endTime = time.time()
+        logger.debug("buffer relay: " + str(self.stats))
+        if len(self._errors) > 0:
+            raise self._errors[0]
@@ -2,7 +2,6 @@
 Code to parse and represent snapshots
 """
 import os.path as osp
-import time
 import re
 import logging
 from .typeOps import asNameStrOrNone, currentGmtTimeStr
@@ -30,7 +29,9 @@ class BackupSnapshot(namedtuple("BackupSnapshot",
     # re group:             1       2        3
 
     prefix = "zipper_"
-    gmt = "[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}"
+    # optional tie-break suffix when the second was already used, fixed width so it sorts
+    tieBreakDigits = 3
+    gmt = "[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}(?:\\.[0-9]{%d})?" % tieBreakDigits
     snapshotNameRe = re.compile("^{prefix}({gmt})_([^.]+)(_incr|_full)?$".format(prefix=prefix, gmt=gmt))
 
     @property
@@ -71,15 +72,26 @@ class BackupSnapshot(namedtuple("BackupSnapshot",
                               timestamp=self.timestamp, backupsetName=self.backupsetName, oldSuffix=self.oldSuffix)
 
     @classmethod
-    def createCurrent(cls, backupsetName, fileSystem=None):
-        "create using current timestamp."
-        # Ouch, had the problem that the test cases ran so quickly that
-        # the one second resoltion of the time can result in snapname
-        # collision. To address this, just sleep to force them to be unique.
-        time.sleep(2)
-        return cls(timestamp=currentGmtTimeStr(), backupsetName=backupsetName, oldSuffix=None,
+    def createCurrent(cls, backupsetName, fileSystem=None, after=None):
+        """create using current timestamp.  The timestamp has a one second
+        resolution, so to avoid name collisions, after is the timestamp of the
+        newest existing snapshot.  If the current time isn't later, a tie-break
+        suffix is added to after, so the new name sorts immediately following it."""
+        timestamp = currentGmtTimeStr()
+        if (after is not None) and (timestamp <= after):
+            timestamp = cls._nextTieBreak(after)
+        return cls(timestamp=timestamp, backupsetName=backupsetName, oldSuffix=None,
                    fileSystemName=asNameStrOrNone(fileSystem))
 
+    @classmethod
+    def _nextTieBreak(cls, timestamp):
+        "add or increment the tie-break suffix of a timestamp"
+        base, sep, tieBreak = timestamp.partition(".")
+        count = int(tieBreak) + 1 if len(tieBreak) > 0 else 1
+        if count >= 10 ** cls.tieBreakDigits:
+            raise ValueError("too many snapshots created in the same second: {}".format(base))
+        return "{}.{:0{}}".format(base, count, cls.tieBreakDigits)
+
     def __str__(self):
         return self.getSnapshotName()
 
@@ -118,10 +130,14 @@ def asSnapshotName(snapshotSpec):
     return snapshotSpec if isinstance(snapshotSpec, str) else snapshotSpec.getSnapName()
 
 class BackupSnapshots(list):
-    "list of snapshots objects from a file system, ordered from newest to oldest by default"
+    """list of snapshots objects from a file system, ordered from newest to
+    oldest by default.  The zfs argument may be a Zfs or ZfsInventory object,
+    the later avoids listing each file system separately.  The list is empty
+    if fileSystem is None, as it does not exist yet."""
     def __init__(self, zfs, fileSystem, *, reverse=True):
-        for zfsSnapshot in zfs.listSnapshots(fileSystem.name):
-            self._loadSnapshot(zfs, zfsSnapshot)
+        if fileSystem is not None:
+            for zfsSnapshot in zfs.listSnapshots(fileSystem.name):
+                self._loadSnapshot(zfs, zfsSnapshot)
         self.sort(key=lambda s: s.timestamp, reverse=reverse)
 
     def _loadSnapshot(self, zfs, zfsSnapshot):
@@ -129,6 +145,11 @@ class BackupSnapshots(list):
             snapshot = BackupSnapshot.createFromSnapshotName(zfsSnapshot.name)
             self.append(snapshot)
 
+    def newestTimestamp(self):
+        "timestamp of newest snapshot, or None if there are no snapshots"
+        timestamps = [s.timestamp for s in self]
+        return max(timestamps) if len(timestamps) > 0 else None
+
     def findNewestCommon(self, otherSnapshots):
         "return newest command snapshot in self that is also in otherSnapshots"
         for snapshot in self:
@@ -0,0 +1,99 @@
+"""
+Running commands on a remote host over ssh, used for backup pools on
+other hosts.  All commands to a host share one persistent ssh connection,
+using OpenSSH connection multiplexing, so the authentication and key exchange
+is only done once per run.
+"""
+import os
+import stat
+import shlex
+import logging
+from .cmdrunner import CmdRunner, ProcessError
+logger = logging.getLogger()
+
+class SshError(Exception):
+    "error setting up an ssh connection"
+    pass
+
+def defaultControlDir():
+    "private directory for control sockets, $XDG_RUNTIME_DIR if set, otherwise ~/.ssh"
+    runtimeDir = os.environ.get("XDG_RUNTIME_DIR")
+    return runtimeDir if runtimeDir else os.path.expanduser("~/.ssh")
+
+class SshTransport(object):
+    """Run commands on host through a multiplexed ssh connection.  The first
+    command starts a master connection that is kept in the background, later
+    commands connect through it's control socket, in controlDir, until
+    close() is called.  As the send streams go through the control socket,
+    controlDir must be a directory only accessible by the user, it is created
+    if needed and checked before use.  It defaults to defaultControlDir().
+    If compression is True, the connection, including zfs send streams, is
+    compressed.  The sshCommand is the command to run
+    in place of ssh, as a string or sequence, it is passed the ssh options,
+    host and a single string with the quoted remote command.  It can be
+    replaced by a wrapper that runs the command locally for testing."""
+    def __init__(self, host, *, user=None, port=None, compression=False, sshCommand="ssh",
+                 controlDir=None, controlPersist=300, cmdRunner=None):
+        self.host = host
+        self.user = user
+        self.port = port
+        self.compression = compression
+        self.sshCommand = tuple(shlex.split(sshCommand) if isinstance(sshCommand, str) else sshCommand)
+        self.controlDir = controlDir if controlDir is not None else defaultControlDir()
+        self.controlPersist = controlPersist
+        self.cmdRunner = cmdRunner if cmdRunner is not None else CmdRunner()
+        self.used = False
+        self.controlDirChecked = False
+
+    def __str__(self):
+        return self.destination
+
+    @property
+    def destination(self):
+        return self.host if self.user is None else self.user + "@" + self.host
+
+    @property
+    def controlPath(self):
+        # ssh expands %C to a hash of the local host, remote host, port and user, keeping the path short
+        return os.path.join(self.controlDir, "zfszipper-ssh-%C")
+
+    def _sshOptions(self):
+        opts = ["-o", "ControlMaster=auto", "-o", "ControlPath=" + self.controlPath,
+                "-o", "ControlPersist={}".format(self.controlPersist), "-o", "BatchMode=yes"]
+        if self.port is not None:
+            opts.extend(["-p", str(self.port)])
+        if self.compression:
+            opts.append("-C")
+        return opts
+
+    def _checkControlDir(self):
+        """create controlDir if needed and check it's private, otherwise another user
+        could create the control socket and intercept the connection"""
+        if self.controlDirChecked:
+            return
+        os.makedirs(self.controlDir, mode=0o700, exist_ok=True)
+        dirStat = os.stat(self.controlDir)
+        if not stat.S_ISDIR(dirStat.st_mode):
+            raise SshError("ssh control directory {} is not a directory".format(self.controlDir))
+        if dirStat.st_uid != os.geteuid():
+            raise SshError("ssh control directory {} is not owned by uid {}".format(self.controlDir, os.geteuid()))
+        if (dirStat.st_mode & 0o077) != 0:
+            raise SshError("ssh control directory {} must only be accessible by it's owner, mode is {:o}"
+                           .format(self.controlDir, stat.S_IMODE(dirStat.st_mode)))
+        self.controlDirChecked = True
+
+    def wrapCmd(self, cmd):
+        "return a command that runs cmd, a list of arguments, on the remote host"
+        self._checkControlDir()
+        self.used = True
+        return list(self.sshCommand) + self._sshOptions() + [self.destination, shlex.join(cmd)]
+
+    def close(self):
+        """stop the master connection, if it's running.  The same options are used as for
+        the commands, as the port and user are part of the control socket name"""
+        if not self.used:
+            return
+        try:
+            self.cmdRunner.call(list(self.sshCommand) + self._sshOptions() + ["-O", "exit", self.destination])
+        except (ProcessError, OSError) as ex:
+            logger.debug("ssh master connection to {} not stopped: {}".format(self, ex))
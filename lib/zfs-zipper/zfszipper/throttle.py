@@ -0,0 +1,285 @@
+"""
+Rate limiting of send streams, so backups can run during production hours
+without saturating the source pool.  Limits are applied in the buffer relay
+between zfs send and zfs receive.  A limit can vary by time of day and be
+changed while backups are running with a control file.
+"""
+import os
+import re
+import time
+import threading
+import logging
+from .typeOps import parseByteSize
+logger = logging.getLogger()
+
+class RateLimitError(Exception):
+    "error in a rate limit specification or control file"
+    pass
+
+_windowRe = re.compile("^([0-9]{1,2}):([0-9]{2})-([0-9]{1,2}):([0-9]{2})=(.+)$")
+
+def _parseClock(hours, minutes, spec):
+    hours, minutes = int(hours), int(minutes)
+    if (hours > 24) or (minutes > 59) or ((hours == 24) and (minutes != 0)):
+        raise RateLimitError("invalid time of day in rate limit window '{}'".format(spec))
+    return 60 * hours + minutes
+
+def parseRate(rate):
+    "parse a rate in bytes/sec, as an int or string such as 20M, or none for unlimited, which returns None"
+    if (rate is None) or (isinstance(rate, str) and (rate.lower() == "none")):
+        return None
+    try:
+        rate = parseByteSize(rate)
+    except ValueError:
+        raise RateLimitError("invalid rate limit '{}', expected bytes/sec such as 20M, or none".format(rate))
+    if rate < 1:
+        raise RateLimitError("rate limit must be at least 1 byte/sec, got {}".format(rate))
+    return rate
+
+
+class RateSchedule(object):
+    """Rate limit in bytes/sec that may vary by local time of day.  It
+    is a list of windows of (startMinute, endMinute, rate), with minutes
+    after midnight.  A window that ends before it starts wraps past midnight,
+    the first matching window is used.  Outside of all windows, the rate is
+    unlimited (None)."""
+    def __init__(self, windows):
+        self.windows = tuple(windows)
+
+    @classmethod
+    def constant(cls, rate):
+        return cls([(0, 24 * 60, rate)])
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse a rate limit.  The spec is a constant rate, given as an int or
+        string such as "20M", or time of day windows, either as a string
+        "08:00-18:00=20M,18:00-22:00=100M" or a list of ("08:00", "18:00", "20M")
+        tuples."""
+        if isinstance(spec, int) or (isinstance(spec, str) and ("=" not in spec)):
+            return cls.constant(parseRate(spec))
+        if isinstance(spec, str):
+            spec = [cls._splitWindow(w.strip()) for w in spec.split(",")]
+        windows = []
+        for start, end, rate in spec:
+            windows.append((cls._parseTime(start), cls._parseTime(end), parseRate(rate)))
+        return cls(windows)
+
+    @staticmethod
+    def _splitWindow(window):
+        match = _windowRe.match(window)
+        if match is None:
+            raise RateLimitError("invalid rate limit window '{}', expected HH:MM-HH:MM=rate".format(window))
+        return ("{}:{}".format(match.group(1), match.group(2)), "{}:{}".format(match.group(3), match.group(4)), match.group(5))
+
+    @staticmethod
+    def _parseTime(spec):
+        parts = spec.split(":")
+        if (len(parts) != 2) or not (parts[0].isdigit() and parts[1].isdigit()):
+            raise RateLimitError("invalid time of day '{}', expected HH:MM".format(spec))
+        return _parseClock(parts[0], parts[1], spec)
+
+    def rateAt(self, localTime):
+        "rate for a time.struct_time, or None if unlimited"
+        minute = 60 * localTime.tm_hour + localTime.tm_min
+        for start, end, rate in self.windows:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif (minute >= start) or (minute < end):
+                return rate
+        return None
+
+    def __str__(self):
+        return ",".join(["{:02}:{:02}-{:02}:{:02}={}".format(start // 60, start % 60, end // 60, end % 60,
+                                                             rate if rate is not None else "none")
+                         for start, end, rate in self.windows])
+
+
+class RateLimiter(object):
+    """Token bucket limiting the combined rate of all streams that use it.
+    One object is shared by all relays of a backup set, or by all backup sets
+    for the global limit.  The allowed rate comes from schedule, a
+    RateSchedule or None for no limit, unless overridden with setOverride().
+    Idle time earns up to burstSecs of credit.  If control is not None, the
+    limiter is registered with it, so it can be adjusted at runtime.  The clock,
+    sleep and localtime functions can be replaced for testing."""
+    burstSecs = 1.0
+
+    def __init__(self, name, schedule=None, control=None, *, clock=time.monotonic, sleep=time.sleep, localtime=time.localtime):
+        self.name = name
+        self.schedule = schedule
+        self.control = control
+        self.clock = clock
+        self.sleep = sleep
+        self.localtime = localtime
+        self.lock = threading.Lock()
+        self.overridden = False
+        self.overrideRate = None
+        self.bytes = 0
+        self.throttleSecs = 0.0
+        self.startTime = None
+        self._nextFree = None  # clock time when the bytes consumed so far are allowed
+        if control is not None:
+            control.register(self)
+
+    @property
+    def enabled(self):
+        "can this limiter ever throttle"
+        return (self.schedule is not None) or (self.control is not None)
+
+    @property
+    def allowedRate(self):
+        "current rate in bytes/sec, or None if unlimited"
+        if self.overridden:
+            return self.overrideRate
+        elif self.schedule is not None:
+            return self.schedule.rateAt(self.localtime())
+        else:
+            return None
+
+    @property
+    def actualRate(self):
+        "average bytes/sec since first used"
+        if self.startTime is None:
+            return 0.0
+        elapsed = self.clock() - self.startTime
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def setOverride(self, rate):
+        "override the schedule with rate, None is unlimited"
+        with self.lock:
+            self.overridden = True
+            self.overrideRate = rate
+
+    def clearOverride(self):
+        "go back to using the schedule"
+        with self.lock:
+            self.overridden = False
+            self.overrideRate = None
+
+    def _reserve(self, nbytes):
+        "account for nbytes, returning the seconds to wait before sending them"
+        if self.control is not None:
+            self.control.poll()
+        with self.lock:
+            now = self.clock()
+            if self.startTime is None:
+                self.startTime = now
+            self.bytes += nbytes
+            rate = self.allowedRate
+            if rate is None:
+                self._nextFree = None
+                return 0.0
+            if self._nextFree is None:
+                self._nextFree = now - self.burstSecs
+            self._nextFree = max(self._nextFree, now - self.burstSecs) + (nbytes / rate)
+            return max(0.0, self._nextFree - now)
+
+    def consume(self, nbytes):
+        "wait until nbytes may be sent, returning the seconds waited"
+        waitSecs = self._reserve(nbytes)
+        if waitSecs > 0:
+            self.sleep(waitSecs)
+            with self.lock:
+                self.throttleSecs += waitSecs
+        return waitSecs
+
+    def __str__(self):
+        rate = self.allowedRate
+        return "rate limit {}: allowed {}, actual {:.0f} bytes/sec, {} bytes, throttled {:.1f} sec".format(
+            self.name, "{} bytes/sec".format(rate) if rate is not None else "unlimited",
+            self.actualRate, self.bytes, self.throttleSecs)
+
+
+class RateControl(object):
+    """Runtime adjustment of rate limits from a control file.  Each non-blank,
+    non-comment line of the file is:
+        name rate
+    where name is "global" or a backup set name and rate is bytes/sec such as
+    20M, or none for unlimited.  These override the configured limits, which
+    are used again for names that are removed from the file.  The file is
+    re-read when it's modification time changes, checked at most every
+    pollInterval seconds while data is being sent, or on the next check after
+    requestReload() is called, which is safe to call from a signal handler.
+    """
+    def __init__(self, controlFile, pollInterval=1.0, clock=time.monotonic):
+        self.controlFile = controlFile
+        self.pollInterval = pollInterval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.limiters = {}  # by name
+        self.overrides = {}
+        self.mtime = None
+        self.lastPoll = None
+        self.reloadRequested = False
+
+    def register(self, limiter):
+        "add a limiter, applying any override for it"
+        with self.lock:
+            self.limiters[limiter.name] = limiter
+            self._apply(limiter)
+
+    def requestReload(self):
+        self.reloadRequested = True
+
+    def _getMtime(self):
+        try:
+            return os.stat(self.controlFile).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def poll(self):
+        "reload if requested or the file has changed and pollInterval has passed since the last check"
+        now = self.clock()
+        with self.lock:
+            if (not self.reloadRequested) and (self.lastPoll is not None) and ((now - self.lastPoll) < self.pollInterval):
+                return
+            self.lastPoll = now
+            mtime = self._getMtime()
+            if self.reloadRequested or (mtime != self.mtime):
+                self.reloadRequested = False
+                self.mtime = mtime
+                self._load()
+
+    def reload(self):
+        "read the control file now"
+        with self.lock:
+            self.reloadRequested = False
+            self.mtime = self._getMtime()
+            self._load()
+
+    def _parse(self):
+        overrides = {}
+        if self.mtime is None:
+            return overrides  # no file, use configured limits
+        with open(self.controlFile) as fh:
+            for lineNum, line in enumerate(fh, 1):
+                line = line.split("#", 1)[0].strip()
+                if len(line) == 0:
+                    continue
+                words = line.split()
+                if len(words) != 2:
+                    raise RateLimitError("{}:{}: expected `name rate', got '{}'".format(self.controlFile, lineNum, line))
+                overrides[words[0]] = parseRate(words[1])
+        return overrides
+
+    def _load(self):
+        "load file and update limiters, must hold lock.  An invalid file is logged and the previous settings kept"
+        try:
+            overrides = self._parse()
+        except (OSError, RateLimitError) as ex:
+            logger.error("rate control file {} ignored: {}".format(self.controlFile, ex))
+            return
+        for name in overrides.keys() - self.limiters.keys():
+            logger.warning("rate control file {}: no rate limit named '{}'".format(self.controlFile, name))
+        self.overrides = overrides
+        for limiter in self.limiters.values():
+            self._apply(limiter)
+            logger.info("rate control: " + str(limiter))
+
+    def _apply(self, limiter):
+        if limiter.name in self.overrides:
+            limiter.setOverride(self.overrides[limiter.name])
+        else:
+            limiter.clearOverride()
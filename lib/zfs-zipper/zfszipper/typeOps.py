@@ -25,6 +25,17 @@ def asStrOrEmpty(s):
     "return str(s) if it's not None, else empty"
     return str(s) if s is not None else ""
 
+_byteSizeSuffixes = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+def parseByteSize(size):
+    "parse an int or a string in the form 64M, 1G, etc into a number of bytes"
+    if isinstance(size, int):
+        return size
+    suffix = size[-1:].upper()
+    if suffix in _byteSizeSuffixes:
+        return int(size[0:-1]) * _byteSizeSuffixes[suffix]
+    return int(size)
+
 def splitLinesToRows(lines):
     "split newline separate lines into tuple of lines"
     end = -1 if lines.endswith('\n') else len(lines)  # handle partial line
@@ -0,0 +1,67 @@
+"""
+Watch for backup pools being attached, so a rotation disk can be backed up
+as soon as it's plugged in.  Pools are found by polling, which works on any
+OS.  To react immediately, a udev rule or devd action can wake the watcher,
+for instance by sending the daemon SIGUSR1.
+"""
+import threading
+import logging
+logger = logging.getLogger()
+
+class PoolWatcher(object):
+    """Poll for configured backup pools becoming available.  listPoolNames is a
+    function returning the names of the pools that are imported or can be
+    imported, and poolNames are the configured backup pools to watch.  A pool
+    is only seen if listPoolNames finds it, see Zfs.canPollPool().  Each
+    time one of these pools appears, onAppear(poolName) is called from the
+    watcher thread.  Pools that are available when watching starts count as
+    appearing.  A pool must disappear, such as the disk being unplugged, and
+    come back to be reported again.  The listing is done every interval
+    seconds, or immediately when wake() is called."""
+    def __init__(self, listPoolNames, poolNames, onAppear, *, interval=30.0):
+        self.listPoolNames = listPoolNames
+        self.poolNames = frozenset(poolNames)
+        self.onAppear = onAppear
+        self.interval = interval
+        self.present = frozenset()
+        self.wakeEvent = threading.Event()
+        self.stopping = False
+        self._thread = None
+
+    def poll(self):
+        "list pools and report those that have appeared since the last poll, returning them"
+        try:
+            available = self.poolNames & frozenset(self.listPoolNames())
+        except Exception:
+            logger.exception("watcher: listing pools failed")
+            return []
+        appeared = sorted(available - self.present)
+        for poolName in sorted(self.present - available):
+            logger.info("watcher: backup pool {} removed".format(poolName))
+        self.present = available
+        for poolName in appeared:
+            logger.info("watcher: backup pool {} available".format(poolName))
+            self.onAppear(poolName)
+        return appeared
+
+    def _run(self):
+        while not self.stopping:
+            self.poll()
+            self.wakeEvent.wait(self.interval)
+            self.wakeEvent.clear()
+
+    def start(self):
+        "start watching in a background thread"
+        logger.info("watcher: watching for backup pools {}".format(", ".join(sorted(self.poolNames))))
+        self._thread = threading.Thread(target=self._run, name="poolWatcher", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        "poll now, can be called from a signal handler"
+        self.wakeEvent.set()
+
+    def stop(self):
+        self.stopping = True
+        self.wakeEvent.set()
+        if self._thread is not None:
+            self._thread.join()
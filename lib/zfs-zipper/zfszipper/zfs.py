@@ -2,64 +2,364 @@
 Support for ZFS interface.  Objects are dynamically constructed from zpool/zfs commands and
 not contain the hierarchy.
 """
+import os
 import re
-from collections import namedtuple
+import json
+import asyncio
+import threading
+import logging
+from collections import namedtuple, defaultdict
 from enum import Enum
 from .typeOps import asNameOrStr, splitTabLinesToRows
-from .cmdrunner import CmdRunner
+from .cmdrunner import CmdRunner, Pipeline, ProcessError
+from .progress import isSendProgressLine
+logger = logging.getLogger()
 
 class ZfsError(Exception):
     "exception related to ZFS"
     pass
 
 class Zfs(object):
-    "object to handle all calls to ZFS commands."
-    def __init__(self):
-        self.cmdRunner = CmdRunner()
+    """object to handle all calls to ZFS commands.  Query results are cached,
+    changes made outside of this object require a call to invalidateCache().
+    The caches are locked, so the object maybe shared by threads.  Pools on
+    other hosts are added with addRemotePool()."""
+    fileSystemListCols = "name,mountpoint,mounted"
+    poolListCmd = ("zpool", "list", "-H", "-o", "name,health,guid")
+    fileSystemListCmd = ("zfs", "list", "-H", "-t", "filesystem", "-o", fileSystemListCols)
+
+    def __init__(self, cmdRunner=None):
+        self.cmdRunner = cmdRunner if cmdRunner is not None else CmdRunner()
+        self._cacheLock = threading.RLock()
+        self.remotePools = {}  # pool name -> transport
+        self.importHints = {}  # pool name -> ZfsImportHints
+        self.fullImportScan = None  # scan all local devices for exported pools, None if only when needed
+        self.deviceCache = None
+        self._importSearchArgs = {}  # pool name -> zpool import arguments that found it
+        self.invalidateCache()
+
+    def addRemotePool(self, poolName, transport):
+        """pool poolName is on another host, transport is an ssh.SshTransport, or
+        other object with a wrapCmd() method, used to run commands on it.  All
+        commands on a remote pool, including the zfs receive of a send from a
+        local pool, are run through its transport.  Remote hosts that can't be
+        reached when listing pools are logged and their pools treated as unavailable"""
+        with self._cacheLock:
+            self.remotePools[poolName] = transport
+            self.invalidateCache()
+
+    def setImportHints(self, poolName, hints):
+        """set the ZfsImportHints used to find and import the exported pool poolName, a pool
+        with a GUID in its hints is only reported and imported if the GUID matches, so a
+        disk with a pool of the same name isn't used"""
+        with self._cacheLock:
+            self.importHints[poolName] = hints
+
+    def _hostCmd(self, cmd, name):
+        "wrap cmd to run on the remote host if the pool of name (pool, file system or snapshot) is remote"
+        transport = self.remotePools.get(re.split("[/@]", name, maxsplit=1)[0])
+        return transport.wrapCmd(cmd) if transport is not None else cmd
+
+    def _call(self, cmd, name):
+        return self.cmdRunner.call(self._hostCmd(cmd, name))
+
+    def _callTabSplit(self, cmd, name):
+        return self.cmdRunner.callTabSplit(self._hostCmd(cmd, name))
+
+    def _remotePoolsByTransport(self):
+        byTransport = defaultdict(list)
+        for poolName, transport in self.remotePools.items():
+            byTransport[transport].append(poolName)
+        return byTransport
+
+    def _callRemoteHosts(self, cmd, callFunc):
+        """run a pool listing cmd on each remote host with callFunc, returning
+        list of (poolNames, output) for the hosts that could be reached"""
+        results = []
+        for transport, poolNames in self._remotePoolsByTransport().items():
+            try:
+                results.append((poolNames, callFunc(transport.wrapCmd(cmd))))
+            except ProcessError as ex:
+                logger.warning("can't list pools {} on {}, treating them as unavailable: {}".format(", ".join(poolNames), transport, ex))
+        return results
+
+    def invalidateCache(self):
+        """drop all cached query results.  Imported pools, file systems and per-file system
+        snapshot lists are cached in dict indexes built from a single listing, which the
+        mutating methods patch or invalidate"""
+        with self._cacheLock:
+            self.invalidateListings()
+            self._snapshotsByFileSystemName = {}  # name -> [ZfsSnapshot]
+
+    def invalidateListings(self):
+        """drop the cached pool and file system listings, which are cheap to reload,
+        keeping the snapshot lists"""
+        with self._cacheLock:
+            self._poolsByName = None   # name -> ZfsPool
+            self._fileSystemsByName = None  # name -> ZfsFileSystem
+            self._exportedPools = None  # [ZfsPool] available for import
+
+    @staticmethod
+    def _parsePoolRows(rows, keepPool):
+        return {name: ZfsPool(name, True, getZfsPoolHealth(health), guid)
+                for name, health, guid in rows if keepPool(name)}
+
+    @staticmethod
+    def _parseFileSystemRows(rows):
+        return {row[0]: ZfsFileSystem(row[0], row[1], row[2]) for row in rows}
+
+    def _isLocalPool(self, poolName):
+        return poolName not in self.remotePools
+
+    def _obtainPoolsByName(self):
+        with self._cacheLock:
+            if self._poolsByName is None:
+                cmd = list(self.poolListCmd)
+                self._poolsByName = self._parsePoolRows(self.cmdRunner.callTabSplit(cmd), self._isLocalPool)
+                for poolNames, rows in self._callRemoteHosts(cmd, self.cmdRunner.callTabSplit):
+                    self._poolsByName.update(self._parsePoolRows(rows, poolNames.__contains__))
+            return self._poolsByName
+
+    def _obtainFileSystemsByName(self):
+        with self._cacheLock:
+            if self._fileSystemsByName is None:
+                cmd = list(self.fileSystemListCmd)
+                self._fileSystemsByName = self._parseFileSystemRows([row for row in self.cmdRunner.callTabSplit(cmd)
+                                                                     if self._isLocalPool(ZfsName(row[0]).pool)])
+                for transport, poolNames in self._remotePoolsByTransport().items():
+                    importedNames = [n for n in poolNames if n in self._obtainPoolsByName()]
+                    if len(importedNames) > 0:
+                        self._fileSystemsByName.update(self._parseFileSystemRows(
+                            self.cmdRunner.callTabSplit(transport.wrapCmd(cmd + ["-r"] + importedNames))))
+            return self._fileSystemsByName
+
+    async def _probeExportedAsync(self, transport, searchArgs):
+        "asyncio version of _probeExported"
+        cmd = ["zpool", "import"] + list(searchArgs)
+        try:
+            return await self.cmdRunner.callAsync(transport.wrapCmd(cmd) if transport is not None else cmd)
+        except ProcessError:
+            if len(searchArgs) == 0:
+                raise
+            return []
+
+    async def _discoverLocalAsync(self):
+        "list the local exported pools, imported pools and file systems concurrently"
+        searches = self._exportedSearches(None)
+        results = await asyncio.gather(
+            self.cmdRunner.callTabSplitAsync(list(self.poolListCmd)),
+            self.cmdRunner.callTabSplitAsync(list(self.fileSystemListCmd)),
+            *[self._probeExportedAsync(None, searchArgs) for searchArgs in searches])
+        poolRows, fileSystemRows = results[0:2]
+        return (self._collectExported(zip(searches, results[2:]), self._isLocalPool),
+                self._parsePoolRows(poolRows, self._isLocalPool),
+                self._parseFileSystemRows([row for row in fileSystemRows if self._isLocalPool(ZfsName(row[0]).pool)]))
+
+    async def _discoverRemoteAsync(self, transport, poolNames):
+        """list the exported and imported pools on a remote host concurrently, followed
+        by the file systems of the imported pools.  A host that can't be reached
+        has no pools"""
+        searches = self._exportedSearches(transport)
+        try:
+            results = await asyncio.gather(
+                self.cmdRunner.callTabSplitAsync(transport.wrapCmd(list(self.poolListCmd))),
+                *[self._probeExportedAsync(transport, searchArgs) for searchArgs in searches])
+            poolsByName = self._parsePoolRows(results[0], poolNames.__contains__)
+            fileSystemRows = []
+            if len(poolsByName) > 0:
+                fileSystemRows = await self.cmdRunner.callTabSplitAsync(transport.wrapCmd(list(self.fileSystemListCmd) + ["-r"] + list(poolsByName.keys())))
+        except ProcessError as ex:
+            logger.warning("can't list pools {} on {}, treating them as unavailable: {}".format(", ".join(poolNames), transport, ex))
+            return ([], {}, {})
+        return (self._collectExported(zip(searches, results[1:]), poolNames.__contains__),
+                poolsByName, self._parseFileSystemRows(fileSystemRows))
+
+    async def discoverAsync(self):
+        "asyncio version of discover"
+        hostResults = await asyncio.gather(self._discoverLocalAsync(),
+                                           *[self._discoverRemoteAsync(transport, poolNames)
+                                             for transport, poolNames in self._remotePoolsByTransport().items()])
+        exported, poolsByName, fileSystemsByName = [], {}, {}
+        for hostExported, hostPoolsByName, hostFileSystemsByName in hostResults:
+            exported.extend(hostExported)
+            poolsByName.update(hostPoolsByName)
+            fileSystemsByName.update(hostFileSystemsByName)
+        with self._cacheLock:
+            self._poolsByName = poolsByName
+            self._fileSystemsByName = fileSystemsByName
+            self._exportedPools = exported
+        return exported + list(poolsByName.values())
+
+    def discover(self):
+        """list exported pools available for import, imported pools and file systems,
+        on this and the remote hosts, filling the pool and file system caches.  All the
+        listings are run concurrently, except the remote file system listings
+        that follow the pool listing of their host, so this takes as long as
+        the slowest listing rather than the total.  The exported pools are
+        cached for listExportedPools().  Returns the list of ZfsPool for exported
+        and imported pools."""
+        return asyncio.run(self.discoverAsync())
+
+    def _dropPoolFromCache(self, poolName):
+        with self._cacheLock:
+            if self._poolsByName is not None:
+                self._poolsByName.pop(poolName, None)
+            for cache in (self._fileSystemsByName, self._snapshotsByFileSystemName):
+                if cache is not None:
+                    for fileSystemName in [n for n in cache.keys() if ZfsName(n).pool == poolName]:
+                        del cache[fileSystemName]
+
+    def _addFileSystemsToCache(self, fileSystemNames):
+        "add newly created file systems, with a targeted listing"
+        with self._cacheLock:
+            if (self._fileSystemsByName is not None) and (len(fileSystemNames) > 0):
+                for row in self._callTabSplit(["zfs", "list", "-H", "-t", "filesystem", "-o", self.fileSystemListCols] + fileSystemNames,
+                                              fileSystemNames[0]):
+                    self._fileSystemsByName[row[0]] = ZfsFileSystem(row[0], row[1], row[2])
+
+    def _dropSnapshotsFromCache(self, fileSystemName):
+        with self._cacheLock:
+            self._snapshotsByFileSystemName.pop(fileSystemName, None)
+
+    def _receivedIntoFileSystem(self, backupSnapshotName):
+        "update cache for snapshot received into a file system, which maybe created"
+        fileSystemName = ZfsSnapshot(backupSnapshotName).fileSystem
+        with self._cacheLock:
+            self._snapshotsByFileSystemName.pop(fileSystemName, None)
+            if (self._fileSystemsByName is not None) and (fileSystemName not in self._fileSystemsByName):
+                self._fileSystemsByName = None
 
     def listPools(self):
         "returns list of ZfsPool for imported pools"
-        return [ZfsPool(name, True, getZfsPoolHealth(health))
-                for name, health in self.cmdRunner.callTabSplit(["zpool", "list", "-H", "-o", "name,health"])]
-
-    def _listExportedParsePool(self, poolName, lineIter):
-        "parse next pool out of lines from zpool import"
-        for line in lineIter:
-            m = re.match("^ *state: (.*)$", line)
-            if m is not None:
-                return ZfsPool(poolName, False, getZfsPoolHealth(m.group(1)))
-        raise ZfsError("zpool export parsing error: `state:' not found")
+        return list(self._obtainPoolsByName().values())
+
+    def _exportedSearches(self, transport):
+        """zpool import search arguments to find the exported pools on the local
+        host, if transport is None, or the remote host of transport.  Pools with
+        ZfsImportHints are searched for only in their device directories or cache
+        file, and pools in the deviceCache are probed on the devices they were
+        last imported from.  These targeted searches are first, followed by the
+        scan of all devices, an empty tuple, if a pool has no hints or none are
+        configured, unless overridden locally by fullImportScan"""
+        if transport is None:
+            poolNames = [n for n in self.importHints.keys() if self._isLocalPool(n)]
+        else:
+            poolNames = [n for n, t in self.remotePools.items() if t is transport]
+        searches = []
+        # with nothing configured, all local pools are looked for
+        unhinted = (transport is None) and (len(self.importHints) == 0)
+        for poolName in poolNames:
+            hints = self.importHints.get(poolName)
+            searchArgs = hints.searchArgs if hints is not None else ()
+            if len(searchArgs) == 0:
+                unhinted = True
+            elif searchArgs not in searches:
+                searches.append(searchArgs)
+        fullScan = unhinted
+        if (transport is None) and (self.fullImportScan is not None):
+            fullScan = self.fullImportScan
+        if (transport is None) and (self.deviceCache is not None):
+            searches.extend([s for s in self.deviceCache.searches() if s not in searches])
+        return searches + ([()] if fullScan else [])
+
+    def _probeExported(self, transport, searchArgs):
+        """run zpool import with searchArgs on the host of transport, or locally.  As
+        zpool import fails if it doesn't find any pools, a failed targeted search
+        finds nothing, while a failure of a full scan is an error"""
+        cmd = ["zpool", "import"] + list(searchArgs)
+        try:
+            return self.cmdRunner.call(transport.wrapCmd(cmd) if transport is not None else cmd)
+        except ProcessError:
+            if len(searchArgs) == 0:
+                raise
+            return []
+
+    def _hintsAllow(self, pool):
+        hints = self.importHints.get(pool.name)
+        if (hints is None) or (hints.guid is None) or (hints.guid == pool.guid):
+            return True
+        logger.info("ignoring exported pool {} with GUID {}, expected GUID {}".format(pool.name, pool.guid, hints.guid))
+        return False
+
+    def _collectExported(self, searchResults, keepPool):
+        """combine the exported pools found by the searches, (searchArgs, lines) pairs, each pool,
+        identified by GUID, is included once, recording the search that found it to use on import"""
+        exported = {}
+        for searchArgs, lines in searchResults:
+            for pool in parseExportedPools(lines):
+                key = pool.guid if pool.guid is not None else pool.name
+                if (key not in exported) and keepPool(pool.name) and self._hintsAllow(pool):
+                    exported[key] = pool
+                    with self._cacheLock:
+                        self._importSearchArgs[pool.name] = searchArgs
+        return list(exported.values())
+
+    def pollPoolNames(self):
+        """names of imported pools and of exported pools found by the targeted
+        searches, on this and the remote hosts, for polling for attached backup
+        pools.  The listings aren't cached and all devices are never scanned, so
+        this is cheap enough to run often.  An exported pool is only found if
+        it has deviceDirs or a cacheFile in its ZfsImportHints, or is in the
+        deviceCache, see canPollPool()"""
+        found = set()
+        hosts = [(None, self._isLocalPool)] + [(transport, poolNames.__contains__)
+                                               for transport, poolNames in self._remotePoolsByTransport().items()]
+        for transport, keepPool in hosts:
+            cmd = list(self.poolListCmd)
+            try:
+                rows = self.cmdRunner.callTabSplit(transport.wrapCmd(cmd) if transport is not None else cmd)
+                found.update(self._parsePoolRows(rows, keepPool).keys())
+                searches = [searchArgs for searchArgs in self._exportedSearches(transport) if len(searchArgs) > 0]
+                exported = self._collectExported([(searchArgs, self._probeExported(transport, searchArgs)) for searchArgs in searches], keepPool)
+                found.update([pool.name for pool in exported])
+            except ProcessError as ex:
+                if transport is None:
+                    raise
+                logger.warning("can't list pools on {}, treating them as unavailable: {}".format(transport, ex))
+        return sorted(found)
+
+    def canPollPool(self, poolName):
+        """can pollPoolNames() find the pool poolName while it's exported, that is
+        it has deviceDirs or a cacheFile, or it's local and in the deviceCache"""
+        hints = self.importHints.get(poolName)
+        if (hints is not None) and (len(hints.searchArgs) > 0):
+            return True
+        return self._isLocalPool(poolName) and (self.deviceCache is not None) and self.deviceCache.hasPool(poolName)
 
     def listExportedPools(self):
-        "list exported pools available for import"
-        exported = []
-        lineIter = iter(self.cmdRunner.call(["zpool", "import"]))
-        for line in lineIter:
-            m = re.match("^ *pool: (.*)$", line)
-            if m is not None:
-                exported.append(self._listExportedParsePool(m.group(1), lineIter))
+        """list exported pools available for import, including remote pools.  The
+        result is cached until a pool is imported or exported"""
+        with self._cacheLock:
+            if self._exportedPools is None:
+                self._exportedPools = self._searchExportedPools()
+            return list(self._exportedPools)
+
+    def _searchExportedPools(self):
+        searches = self._exportedSearches(None)
+        exported = self._collectExported([(searchArgs, self._probeExported(None, searchArgs)) for searchArgs in searches],
+                                         self._isLocalPool)
+        for transport, poolNames in self._remotePoolsByTransport().items():
+            try:
+                searchResults = [(searchArgs, self._probeExported(transport, searchArgs)) for searchArgs in self._exportedSearches(transport)]
+            except ProcessError as ex:
+                logger.warning("can't list pools {} on {}, treating them as unavailable: {}".format(", ".join(poolNames), transport, ex))
+                continue
+            exported.extend(self._collectExported(searchResults, poolNames.__contains__))
         return exported
 
     def findPool(self, poolName):
         "returns ZfsPool or None"
-        for result in self.cmdRunner.callTabSplit(["zpool", "list", "-H", "-o", "name,health"]):
-            if result[0] == poolName:
-                return ZfsPool(result[0], True, getZfsPoolHealth(result[1]))
-        return None
+        return self._obtainPoolsByName().get(poolName)
 
     def listFileSystems(self, poolSpec):
         "returns list of ZfsFileSystem, Pool can be name or object"
         poolName = asNameOrStr(poolSpec)
         return [ZfsFileSystem(row[0], row[1], row[2])
-                for row in self.cmdRunner.callTabSplit(["zfs", "list", "-Hr", "-t", "filesystem", "-o", "name,mountpoint,mounted", poolName])]
+                for row in self._callTabSplit(["zfs", "list", "-Hr", "-t", "filesystem", "-o", self.fileSystemListCols, poolName], poolName)]
 
     def findFileSystem(self, fileSystemName):
         "returns a ZfsFileSystem or None"
-        results = self.cmdRunner.callTabSplit(["zfs", "list", "-H", "-t", "filesystem", "-o", "name,mountpoint,mounted"])
-        for row in results:
-            if row[0] == fileSystemName:
-                return ZfsFileSystem(row[0], row[1], row[2])
-        return None
+        return self._obtainFileSystemsByName().get(fileSystemName)
 
     def getFileSystem(self, fileSystemName):
         "returns a ZfsFileSystem or error"
@@ -69,65 +369,303 @@ class Zfs(object):
         return fileSystem
 
     def createFileSystem(self, fileSystemName):
-        "create a new file system"
-        self.cmdRunner.call(["zfs", "create", "-p", fileSystemName])
+        "create a new file system, along with any missing parents"
+        with self._cacheLock:
+            fileSystemsByName = self._obtainFileSystemsByName()
+            newFileSystemNames = []
+            parts = fileSystemName.split("/")
+            for i in range(2, len(parts) + 1):
+                name = "/".join(parts[0:i])
+                if name not in fileSystemsByName:
+                    newFileSystemNames.append(name)
+            self._call(["zfs", "create", "-p", fileSystemName], fileSystemName)
+            self._addFileSystemsToCache(newFileSystemNames)
         return self.getFileSystem(fileSystemName)
 
     def listSnapshots(self, fileSystemSpec):
         "returns list of snapshot names, ordered oldest to newest.  fileSystemSpec can be a name or a FileSystem object"
-        return [ZfsSnapshot(name)
-                for name in self.cmdRunner.call(["zfs", "list", "-Hd", "1", "-t", "snapshot", "-o", "name", "-s", "creation", asNameOrStr(fileSystemSpec)])]
+        fileSystemName = asNameOrStr(fileSystemSpec)
+        with self._cacheLock:
+            snapshots = self._snapshotsByFileSystemName.get(fileSystemName)
+            if snapshots is None:
+                snapshots = self._snapshotsByFileSystemName[fileSystemName] = [
+                    ZfsSnapshot(name)
+                    for name in self._call(["zfs", "list", "-Hd", "1", "-t", "snapshot", "-o", "name", "-s", "creation", fileSystemName], fileSystemName)]
+            return list(snapshots)
+
+    def listPoolSnapshots(self, poolSpec):
+        """returns list of ZfsSnapshotInfo for all snapshots in a pool, ordered
+        oldest to newest, using a single recursive listing. Pool can be name or object"""
+        poolName = asNameOrStr(poolSpec)
+        cmd = ["zfs", "list", "-Hpr", "-t", "snapshot", "-o", "name,guid,creation,used,written", "-s", "creation", poolName]
+        return [ZfsSnapshotInfo(ZfsSnapshot(row[0]), row[1], parseZfsInt(row[2]), parseZfsInt(row[3]), parseZfsInt(row[4]))
+                for row in self._callTabSplit(cmd, poolName)]
 
     def importPool(self, poolSpec):
-        "import specified pool"
-        self.cmdRunner.call(["zpool", "import", asNameOrStr(poolSpec)])
+        """import specified pool, searching the devices where listExportedPools found
+        it.  A pool with a known GUID is imported by GUID, so another pool with the
+        same name can't be imported in it's place"""
+        poolName = asNameOrStr(poolSpec)
+        hints = self.importHints.get(poolName)
+        guid = poolSpec.guid if isinstance(poolSpec, ZfsPool) else None
+        if (guid is None) and (hints is not None):
+            guid = hints.guid
+        searchArgs = self._importSearchArgs.get(poolName)
+        if searchArgs is None:
+            searchArgs = hints.searchArgs if hints is not None else ()
+        self._call(["zpool", "import"] + list(searchArgs) + ([guid, poolName] if guid is not None else [poolName]), poolName)
+        # pool and all of it's file systems are new
+        with self._cacheLock:
+            self._poolsByName = self._fileSystemsByName = self._exportedPools = None
+        self._recordPoolDevices(poolName)
+
+    def _recordPoolDevices(self, poolName):
+        "save the devices of an imported local pool in the device cache, failures are only logged"
+        if (self.deviceCache is None) or not self._isLocalPool(poolName):
+            return
+        try:
+            pool = self.findPool(poolName)
+            devices = parsePoolStatusDevices(self.cmdRunner.call(["zpool", "status", "-P", poolName]))
+        except ProcessError as ex:
+            logger.warning("can't get devices of pool {} for device cache: {}".format(poolName, ex))
+            return
+        if (pool is not None) and (pool.guid is not None) and (len(devices) > 0):
+            self.deviceCache.record(pool.guid, poolName, devices)
 
     def exportPool(self, poolSpec, *, force=False):
         "export specified pool"
-        self.cmdRunner.call(["zpool", "export"] + (["-f"] if force else []) + [asNameOrStr(poolSpec)])
+        self._call(["zpool", "export"] + (["-f"] if force else []) + [asNameOrStr(poolSpec)], asNameOrStr(poolSpec))
+        self._dropPoolFromCache(asNameOrStr(poolSpec))
+        with self._cacheLock:
+            self._exportedPools = None
 
     def createSnapshot(self, snapshotSpec):
-        self.cmdRunner.call(["zfs", "snapshot", asNameOrStr(snapshotSpec)])
+        self.createSnapshots([snapshotSpec])
+
+    def createSnapshots(self, snapshotSpecs):
+        """create snapshots, with one zfs snapshot command per pool, so that all
+        snapshots in a pool are created atomically at the same point in time"""
+        snapshotsByPool = defaultdict(list)
+        for snapshotSpec in snapshotSpecs:
+            snapshot = ZfsSnapshot(asNameOrStr(snapshotSpec))
+            snapshotsByPool[ZfsName(snapshot.fileSystem).pool].append(snapshot)
+        for snapshots in snapshotsByPool.values():
+            self._call(["zfs", "snapshot"] + [snapshot.name for snapshot in snapshots], snapshots[0].name)
+            with self._cacheLock:
+                for snapshot in snapshots:
+                    fsSnapshots = self._snapshotsByFileSystemName.get(snapshot.fileSystem)
+                    if fsSnapshots is not None:
+                        fsSnapshots.append(snapshot)
 
     def destroySnapshot(self, snapshotSpec):
-        return self.cmdRunner.callTabSplit(["zfs", "destroy", "-fp", asNameOrStr(snapshotSpec)])
+        snapshotName = asNameOrStr(snapshotSpec)
+        self._dropSnapshotsFromCache(ZfsSnapshot(snapshotName).fileSystem)
+        return self._callTabSplit(["zfs", "destroy", "-fp", snapshotName], snapshotName)
 
     def renameSnapshot(self, oldSnapshotSpec, newSnapshotSpec):
-        self.cmdRunner.call(["zfs", "rename", asNameOrStr(oldSnapshotSpec), asNameOrStr(newSnapshotSpec)])
-
-    def sendRecvFull(self, sourceSnapshotSpec, backupSnapshotSpec):
-        "return results of send -P parsed into rows of columns"
+        oldSnapshotName = asNameOrStr(oldSnapshotSpec)
+        self._dropSnapshotsFromCache(ZfsSnapshot(oldSnapshotName).fileSystem)
+        self._call(["zfs", "rename", oldSnapshotName, asNameOrStr(newSnapshotSpec)], oldSnapshotName)
+
+    def _sendRecv(self, sendArgs, recvCmd, relay, progress):
+        """run zfs send -P sendArgs | recvCmd, returning send output parsed into rows of
+        columns.  The send is always local, the receive is run on the host of the
+        pool it's last argument names.  If progress is specified, it is a progress.SendProgress object, send -v
+        is used and the progress is passed each line as it is written.  The periodic
+        progress lines are not kept."""
+        sendCmd = ["zfs", "send", "-P"] + (["-v"] if progress is not None else []) + sendArgs
+        pipeline = Pipeline()
+        send = pipeline.add(sendCmd, stderrLineCallback=progress.stderrLine if progress is not None else None,
+                            stderrLineFilter=lambda line: not isSendProgressLine(line))
+        pipeline.add(self._hostCmd(recvCmd, recvCmd[-1]), relay=relay)
+        self.cmdRunner.runPipeline(pipeline)
+        return splitTabLinesToRows(send.stderr)
+
+    def sendRecvFull(self, sourceSnapshotSpec, backupSnapshotSpec, *, sendOptions=(), relay=None, progress=None):
+        """return results of send -P parsed into rows of columns.  sendOptions are additional
+        zfs send options.  If relay is specified, it is an unstarted relay.BufferRelay used
+        between send and receive.  If progress is specified, it is a progress.SendProgress
+        that is updated as data is sent"""
         sourceSnapshotName = asNameOrStr(sourceSnapshotSpec)
         backupSnapshotName = asNameOrStr(backupSnapshotSpec)
 
-        # FIXME: should try have option to use receive -s and then be able to restart
-        sendCmd = ["zfs", "send", "-P", sourceSnapshotName]
-        recvCmd = ["zfs", "receive", '-F']
+        # receive -s saves state so an interrupted receive can be resumed with sendRecvResume
+        recvCmd = ["zfs", "receive", "-s", "-F"]
         recvCmd.append(backupSnapshotName)
-        stderr1, ignored = self.cmdRunner.pipeline2(sendCmd, recvCmd)
-        return splitTabLinesToRows(stderr1)
-
-    def sendRecvIncr(self, sourceBaseSnapshotName, sourceSnapshotName, backupSnapshotName):
-        "return results of send -P parsed into rows of columns"
+        try:
+            return self._sendRecv(list(sendOptions) + [sourceSnapshotName], recvCmd, relay, progress)
+        finally:
+            self._receivedIntoFileSystem(backupSnapshotName)
+
+    def sendRecvIncr(self, sourceBaseSnapshotName, sourceSnapshotName, backupSnapshotName, *, sendOptions=(), relay=None, progress=None):
+        """return results of send -P parsed into rows of columns.  sendOptions are additional
+        zfs send options.  If relay is specified, it is an unstarted relay.BufferRelay used
+        between send and receive.  If progress is specified, it is a progress.SendProgress
+        that is updated as data is sent"""
         # receive -F is require to prevent "destination X has been modified" error
-        sendCmd = ["zfs", "send", "-P", "-i", sourceBaseSnapshotName, sourceSnapshotName]
-        recvCmd = ["zfs", "receive", "-F", backupSnapshotName]
-        stderr1, ignored = self.cmdRunner.pipeline2(sendCmd, recvCmd)
-        return splitTabLinesToRows(stderr1)
+        recvCmd = ["zfs", "receive", "-s", "-F", backupSnapshotName]
+        try:
+            return self._sendRecv(list(sendOptions) + ["-i", sourceBaseSnapshotName, sourceSnapshotName], recvCmd, relay, progress)
+        finally:
+            self._receivedIntoFileSystem(backupSnapshotName)
+
+    def sendRecvIncrRange(self, sourceBaseSnapshotName, sourceSnapshotName, backupFileSystemSpec, *, sendOptions=(), relay=None, progress=None):
+        """send all snapshots after sourceBaseSnapshotName up to sourceSnapshotName as
+        a single send -I stream, received into backupFileSystemSpec.  Return results
+        of send -P parsed into rows of columns, which has an incremental row for each
+        snapshot in the stream.  sendOptions are additional zfs send options.
+        If relay is specified, it is an unstarted relay.BufferRelay used between
+        send and receive.  If progress is specified, it is a progress.SendProgress
+        that is updated as data is sent"""
+        backupFileSystemName = asNameOrStr(backupFileSystemSpec)
+        recvCmd = ["zfs", "receive", "-s", "-F", backupFileSystemName]
+        try:
+            return self._sendRecv(list(sendOptions) + ["-I", sourceBaseSnapshotName, sourceSnapshotName], recvCmd, relay, progress)
+        finally:
+            self._receivedIntoFileSystem(ZfsSnapshot.factory(backupFileSystemName, ZfsSnapshot(sourceSnapshotName).snapName).name)
+
+    def _sendDryRun(self, sendArgs):
+        "run zfs send -nP, returning the output parsed into rows of columns"
+        return self.cmdRunner.callTabSplit(["zfs", "send", "-nP"] + sendArgs)
+
+    @staticmethod
+    def _parseSendSize(rows):
+        for row in rows:
+            if (row[0] == "size") and (len(row) == 2):
+                return int(row[1])
+        raise ZfsError("expected size line from zfs send -nP, got: " + str(rows))
+
+    def estimateSendFull(self, sourceSnapshotName, *, sendOptions=()):
+        "estimated size in bytes of a full send stream, without sending"
+        return self._parseSendSize(self._sendDryRun(list(sendOptions) + [sourceSnapshotName]))
+
+    def estimateSendIncr(self, sourceBaseSnapshotName, sourceSnapshotName, *, sendOptions=(), intermediate=False):
+        """estimated size in bytes of an incremental send stream, without sending.
+        If intermediate is True, this is a send -I stream"""
+        return self._parseSendSize(self._sendDryRun(list(sendOptions) + ["-I" if intermediate else "-i",
+                                                                         sourceBaseSnapshotName, sourceSnapshotName]))
+
+    def getResumeTokenInfo(self, resumeToken):
+        """dry-run resuming a send, returning send -nP output parsed into rows of
+        columns, which is the same as sendRecvResume returns"""
+        return self._sendDryRun(["-t", resumeToken])
+
+    def getResumeToken(self, fileSystemSpec):
+        "get the receive_resume_token of an interrupted receive -s, or None if there isn't one"
+        fileSystemName = asNameOrStr(fileSystemSpec)
+        token = self._call(["zfs", "get", "-H", "-o", "value", "receive_resume_token", fileSystemName], fileSystemName)[0]
+        return None if token in ("-", "") else token
+
+    def sendRecvResume(self, resumeToken, backupFileSystemSpec, *, relay=None, progress=None):
+        """resume an interrupted receive into backupFileSystemSpec, return results
+        of send -P parsed into rows of columns.  This includes the contents of the
+        token, in addition to the normal full or incremental rows.  The send options
+        of the interrupted send are stored in the token.  Progress is as with sendRecvFull"""
+        backupFileSystemName = asNameOrStr(backupFileSystemSpec)
+        recvCmd = ["zfs", "receive", "-s", backupFileSystemName]
+        try:
+            return self._sendRecv(["-t", resumeToken], recvCmd, relay, progress)
+        finally:
+            self._dropSnapshotsFromCache(backupFileSystemName)
+
+    def abortResume(self, backupFileSystemSpec):
+        "discard the saved state of an interrupted receive -s"
+        self._call(["zfs", "receive", "-A", asNameOrStr(backupFileSystemSpec)], asNameOrStr(backupFileSystemSpec))
+
+    def getIntProp(self, spec, name):
+        "get an integer property of a pool, file system or snapshot, None if not set"
+        value = self._call(["zfs", "get", "-Hp", "-o", "value", name, asNameOrStr(spec)], asNameOrStr(spec))[0]
+        return parseZfsInt(value)
 
     def setProp(self, fileSystemName, name, value):
         "set a property"
-        self.cmdRunner.call(["zfs", "set", name + "=" + str(value), fileSystemName])
+        self._call(["zfs", "set", name + "=" + str(value), fileSystemName], fileSystemName)
 
     def diffSnapshot(self, prevSnapshotSpec, snapshotSpec):
         cmd = ["zfs", "diff", "-HF", asNameOrStr(prevSnapshotSpec), asNameOrStr(snapshotSpec)]
-        return self.cmdRunner.callTabSplit(cmd)
+        return self._callTabSplit(cmd, asNameOrStr(snapshotSpec))
+
+
+class ZfsInventory(object):
+    """Snapshots of pools, obtained with one recursive listing per pool and
+    indexed by file system.  A pool is loaded the first time one of its file
+    systems is referenced.  Snapshots created after loading are added with
+    addSnapshot(), so the inventory can be used for the whole run.  The zfs
+    argument only needs to implement listPoolSnapshots().  Access is locked,
+    so the object maybe shared by threads."""
+    def __init__(self, zfs):
+        self.zfs = zfs
+        self.lock = threading.RLock()
+        self.byPoolName = {}   # pool name -> dict of file system name -> [ZfsSnapshotInfo]
+        self.bySnapshotName = {}  # snapshot name -> ZfsSnapshotInfo
+
+    def _obtainPool(self, poolName):
+        with self.lock:
+            byFileSystemName = self.byPoolName.get(poolName)
+            if byFileSystemName is None:
+                byFileSystemName = {}
+                for snapshotInfo in self.zfs.listPoolSnapshots(poolName):
+                    self._addSnapshotInfo(byFileSystemName, snapshotInfo)
+                self.byPoolName[poolName] = byFileSystemName
+            return byFileSystemName
+
+    def _addSnapshotInfo(self, byFileSystemName, snapshotInfo):
+        byFileSystemName.setdefault(snapshotInfo.snapshot.fileSystem, []).append(snapshotInfo)
+        self.bySnapshotName[snapshotInfo.name] = snapshotInfo
+
+    def loadPool(self, poolSpec):
+        "force loading of a pool, does nothing if already loaded"
+        self._obtainPool(asNameOrStr(poolSpec))
+
+    def invalidate(self, poolSpec=None):
+        "drop a pool, or all pools if None, so they are reloaded on next reference"
+        with self.lock:
+            if poolSpec is None:
+                self.byPoolName.clear()
+                self.bySnapshotName.clear()
+            else:
+                byFileSystemName = self.byPoolName.pop(asNameOrStr(poolSpec), {})
+                for snapshotInfos in byFileSystemName.values():
+                    for snapshotInfo in snapshotInfos:
+                        self.bySnapshotName.pop(snapshotInfo.name, None)
+
+    def listSnapshotInfos(self, fileSystemSpec):
+        "returns list of ZfsSnapshotInfo, ordered oldest to newest"
+        fileSystemName = asNameOrStr(fileSystemSpec)
+        with self.lock:
+            return list(self._obtainPool(ZfsName(fileSystemName).pool).get(fileSystemName, ()))
+
+    def listSnapshots(self, fileSystemSpec):
+        """returns list of ZfsSnapshot, ordered oldest to newest, same as
+        Zfs.listSnapshots().  fileSystemSpec can be a name or a FileSystem object"""
+        return [si.snapshot for si in self.listSnapshotInfos(fileSystemSpec)]
+
+    def findSnapshotInfo(self, snapshotSpec):
+        "returns ZfsSnapshotInfo or None"
+        snapshot = ZfsSnapshot(asNameOrStr(snapshotSpec))
+        with self.lock:
+            self._obtainPool(ZfsName(snapshot.fileSystem).pool)
+            return self.bySnapshotName.get(snapshot.name)
+
+    def addSnapshot(self, snapshotSpec):
+        """record a snapshot that was created or received after the pool was
+        loaded.  Properties are not known and are set to None.  Nothing is done
+        if the pool hasn't been loaded, as it will be in the listing"""
+        snapshot = ZfsSnapshot(asNameOrStr(snapshotSpec))
+        with self.lock:
+            byFileSystemName = self.byPoolName.get(ZfsName(snapshot.fileSystem).pool)
+            if (byFileSystemName is not None) and (snapshot.name not in self.bySnapshotName):
+                self._addSnapshotInfo(byFileSystemName, ZfsSnapshotInfo(snapshot, None, None, None, None))
 
 
 ZfsPoolHealth = Enum("ZfsPoolHealth", ("ONLINE", "DEGRADED", "FAULTED", "OFFLINE", "REMOVED", "UNAVAIL"))
 def getZfsPoolHealth(strVal):
     return getattr(ZfsPoolHealth, strVal)
 
+def parseZfsInt(strVal):
+    "parse an integer property from zfs -p output, `-' becomes None"
+    return None if strVal == "-" else int(strVal)
+
 class ZfsName(namedtuple("ZfsName",
                          ("name", "pool", "fileSystem", "fsName", "snapName"))):
     "parse a pool, file system name, or snapshot name into it's parts"
@@ -160,6 +698,15 @@ class ZfsSnapshot(namedtuple("ZfsSnapshot", ("name", "fileSystem", "snapName")))
     def factory(fileSystem, snapName):
         return ZfsSnapshot(fileSystem + "@" + snapName)
 
+class ZfsSnapshotInfo(namedtuple("ZfsSnapshotInfo", ("snapshot", "guid", "creation", "used", "written"))):
+    """ZfsSnapshot with properties from a recursive listing.  Numeric properties
+    are int, guid is a string.  Properties are None if not known."""
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return self.snapshot.name
+
 class ZfsFileSystem(object):
     def __init__(self, name, mountpoint, mounted):
         "mounted can be string yes/no or bool"
@@ -182,5 +729,115 @@ class ZfsFileSystem(object):
         else:
             raise ValueError("invalid value for mounted: " + str(mounted))
 
-class ZfsPool(namedtuple("ZfsPool", ("name", "imported", "health"))):
+class ZfsPool(namedtuple("ZfsPool", ("name", "imported", "health", "guid"))):
+    """pool, guid is the pool GUID as a string, or None if not known"""
     __slots__ = ()
+
+    def __new__(cls, name, imported, health, guid=None):
+        return super(ZfsPool, cls).__new__(cls, name, imported, health, guid)
+
+def isPoolBusyError(ex):
+    """is ex a ProcessError from zpool export failing because the pool or one
+    of it's file systems is in use, which can be retried"""
+    return isinstance(ex, ProcessError) and (ex.stderr is not None) and (re.search("busy", ex.stderr, re.IGNORECASE) is not None)
+
+def parseExportedPools(lines):
+    """parse zpool import output into a list of ZfsPool.  Each pool is a block
+    of `field: value' lines starting with `pool:', of which the id (GUID) and
+    state are used"""
+    blocks = []
+    for line in lines:
+        m = re.match("^ *([a-z]+): ?(.*)$", line)
+        if m is None:
+            continue
+        if m.group(1) == "pool":
+            blocks.append({})
+        if len(blocks) > 0:
+            blocks[-1].setdefault(m.group(1), m.group(2).strip())
+    exported = []
+    for fields in blocks:
+        if "state" not in fields:
+            raise ZfsError("zpool import parsing error: `state:' not found for pool " + fields["pool"])
+        exported.append(ZfsPool(fields["pool"], False, getZfsPoolHealth(fields["state"].split()[0]), fields.get("id")))
+    return exported
+
+def parsePoolStatusDevices(lines):
+    "parse zpool status -P output into the list of device paths of the pool"
+    return [line.split()[0] for line in lines if line.strip().startswith("/")]
+
+class ZfsImportHints(namedtuple("ZfsImportHints", ("deviceDirs", "cacheFile", "guid"))):
+    """Where to search for an exported pool.  deviceDirs are directories of
+    devices, or devices, searched with zpool import -d, cacheFile is a pool
+    cache file read with zpool import -c, and guid is the pool's GUID, if
+    known, used to identify it"""
+    __slots__ = ()
+
+    def __new__(cls, deviceDirs=(), cacheFile=None, guid=None):
+        return super(ZfsImportHints, cls).__new__(cls, tuple(deviceDirs), cacheFile, str(guid) if guid is not None else None)
+
+    @property
+    def searchArgs(self):
+        "zpool import arguments to search for the pool, empty for a scan of all devices"
+        searchArgs = ("-c", self.cacheFile) if self.cacheFile is not None else ()
+        for deviceDir in self.deviceDirs:
+            searchArgs += ("-d", deviceDir)
+        return searchArgs
+
+class ZfsPoolDeviceCache(object):
+    """Persistent map of pool GUIDs to the devices the pool was last imported
+    from, saved as JSON in cacheFile.  When any of the devices of a known pool
+    exist, such as when a rotation disk is attached, the pool is found by
+    probing just those devices, rather than scanning every device.  A missing
+    or unreadable cache file is treated as empty."""
+    def __init__(self, cacheFile):
+        self.cacheFile = cacheFile
+        self.lock = threading.Lock()
+        self.pools = self._load()  # guid -> {"name": poolName, "devices": [path, ...]}
+
+    def _load(self):
+        try:
+            with open(self.cacheFile) as fh:
+                return dict(json.load(fh)["pools"])
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            logger.warning("ignoring invalid pool device cache {}: {}".format(self.cacheFile, ex))
+            return {}
+
+    def _save(self):
+        "atomically replace cache file, must hold lock"
+        tmpFile = self.cacheFile + ".tmp"
+        with open(tmpFile, "w") as fh:
+            json.dump({"pools": self.pools}, fh, indent=2, sort_keys=True)
+        os.replace(tmpFile, self.cacheFile)
+
+    def record(self, guid, poolName, devices):
+        "save the devices of a pool, failures to write the cache are logged"
+        entry = {"name": poolName, "devices": list(devices)}
+        with self.lock:
+            if self.pools.get(guid) == entry:
+                return
+            self.pools[guid] = entry
+            try:
+                self._save()
+            except OSError as ex:
+                logger.warning("can't write pool device cache {}: {}".format(self.cacheFile, ex))
+
+    def hasPool(self, poolName):
+        "are the devices of a pool named poolName recorded"
+        with self.lock:
+            return any(entry["name"] == poolName for entry in self.pools.values())
+
+    def searches(self):
+        "zpool import search arguments for each known pool that has devices present"
+        with self.lock:
+            entries = [self.pools[guid] for guid in sorted(self.pools.keys())]
+        searches = []
+        for entry in entries:
+            present = [device for device in entry["devices"] if os.path.exists(device)]
+            if len(present) > 0:
+                searchArgs = ()
+                for device in present:
+                    searchArgs += ("-d", device)
+                searches.append(searchArgs)
+        return searches
@@ -3,18 +3,38 @@ Test of zfs-zipper tests of library functions.
 """
 
 import os
+import re
 import sys
 import unittest
 import tempfile
+import subprocess
+import signal
+import threading
+import time
+import asyncio
 from io import StringIO
+from contextlib import contextmanager
 sys.path.insert(0, "../lib/zfs-zipper")
 from zfszipper import typeOps
 from zfszipper import loggingOps
-from zfszipper.backup import BackupSnapshot, FsBackup, BackupSetBackup, BackupRecorder
-from zfszipper.zfs import ZfsPool, ZfsSnapshot, ZfsPoolHealth, ZfsError, ZfsName
-from zfszipper.config import BackupPoolConf, BackupSetConf, SourceFileSystemConf
+from zfszipper.backup import BackupSnapshot, FsBackup, BackupSetBackup, BackupRecorder, BackupSetFailures, StreamLimiter, BackupError
+from zfszipper.zfs import Zfs, ZfsPool, ZfsSnapshot, ZfsPoolHealth, ZfsError, ZfsName, ZfsInventory, ZfsImportHints, ZfsPoolDeviceCache, parseExportedPools
+from zfszipper.config import BackupPoolConf, BackupSetConf, SourceFileSystemConf, BackupConfigError, BackupConf, evalConfigFile
 from zfsMock import ZfsMock, fakeZfsFileSystem
+from zfszipper.cmdrunner import CmdRunner, Pipeline, PipelineException, StderrCollector, ProcessError
+from zfszipper.relay import BufferRelay
+from zfszipper.throttle import RateSchedule, RateLimiter, RateControl
+from zfszipper.ssh import SshTransport, SshError
+from zfszipper.cron import CronSchedule, CronError
+from zfszipper.daemon import BackupDaemon, DaemonJob
+from zfszipper.watcher import PoolWatcher
+from zfszipper.locks import ResourceLocks, LockError
+import socket
+from zfszipper.progress import ProgressReporter, isSendProgressLine
+from zfszipper.plan import BackupPlan, writePlan, readPlan
+from cmdRunnerMock import CmdRunnerMock
 from zfszipper.typeOps import splitLinesToRows
+import json
 import logging
 logging.basicConfig(filename="/dev/null")
 
@@ -106,7 +126,6 @@ class ZfsParseTests(unittest.TestCase):
         with self.assertRaisesRegex(ZfsError, "^invaliid ZFS name, should be <pool>, <pool>/<filesys> or <pool>>/<filesys>@<snapName>: '/markd_a'$"):
             ZfsName("/markd_a")
 
-
 class BackupSnapshotTests(unittest.TestCase):
     testPool = "swimming"
     testFs1 = "zztop/opt"
@@ -148,6 +167,19 @@ class BackupSnapshotTests(unittest.TestCase):
         ss = BackupSnapshot.createFromSnapshotName(fsSSName)
         self.assertEqual(fsSSName, str(ss))
 
+    def testCreateTieBreak(self):
+        GmtTimeFaker.setTime("1979-01-20", 16, 14, 5)
+        ss1 = BackupSnapshot.createCurrent("funbackset", self.testFs1, after="1979-01-20T16:14:05")
+        self.assertEqual(str(ss1), "zztop/opt@zipper_1979-01-20T16:14:05.001_funbackset")
+        GmtTimeFaker.setTime("1979-01-20", 16, 14, 5)
+        ss2 = BackupSnapshot.createCurrent("funbackset", self.testFs1, after=ss1.timestamp)
+        self.assertEqual(str(ss2), "zztop/opt@zipper_1979-01-20T16:14:05.002_funbackset")
+        self.assertEqual(BackupSnapshot.createFromSnapshotName(str(ss2)), ss2)
+        self.assertEqual(sorted(["1979-01-20T16:14:08", ss2.timestamp, ss1.timestamp, "1979-01-20T16:14:05"]),
+                         ["1979-01-20T16:14:05", ss1.timestamp, ss2.timestamp, "1979-01-20T16:14:08"])
+        ss3 = BackupSnapshot.createCurrent("funbackset", self.testFs1, after=ss2.timestamp)
+        self.assertEqual(ss3.timestamp, "1979-01-20T16:14:06")
+
     def testDropFsParse(self):
         fsSSName = self._mkFsSnapshot(self.testFs1, self.testName)
         ss = BackupSnapshot.createFromSnapshotName(fsSSName, dropFileSystem=True)
@@ -273,8 +305,9 @@ class BackuperTests(unittest.TestCase):
     def _assertRecorded(self, recorder, expected):
         "expected should not include header line"
         self.maxDiff = None
-        header = 'time	backupSet	backupPool	action	src1Snap	src2Snap	backupSnap	size	exception	info'
-        got = recorder.readLines()
+        header = 'time	backupSet	backupPool	action	src1Snap	src2Snap	backupSnap	size	exception	info	sendOpts	estSize	secs'
+        # times vary, so just check they are there
+        got = [re.sub("\t[0-9]+\\.[0-9]$", "\t", line) for line in recorder.readLines()]
         self._assertLineLists("recorder", got, [header] + list(expected))
 
     def _assertZfs(self, zfs, expected):
@@ -293,13 +326,13 @@ class BackuperTests(unittest.TestCase):
         self._assertActions(zfs,
                             ['zfs create backupPool1/srcPool1/srcPool1Fs1',
                              'zfs snapshot srcPool1/srcPool1Fs1@zipper_2001-01-01T00:00:00_testBackupSet',
-                             'zfs send -P srcPool1/srcPool1Fs1@zipper_2001-01-01T00:00:00_testBackupSet | zfs receive -F backupPool1/srcPool1/srcPool1Fs1@zipper_2001-01-01T00:00:00_testBackupSet',
+                             'zfs send -P srcPool1/srcPool1Fs1@zipper_2001-01-01T00:00:00_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs1@zipper_2001-01-01T00:00:00_testBackupSet',
                              'zfs create backupPool1/srcPool1/srcPool1Fs2',
                              'zfs snapshot srcPool1/srcPool1Fs2@zipper_2001-01-01T00:00:02_testBackupSet',
-                             'zfs send -P srcPool1/srcPool1Fs2@zipper_2001-01-01T00:00:02_testBackupSet | zfs receive -F backupPool1/srcPool1/srcPool1Fs2@zipper_2001-01-01T00:00:02_testBackupSet'])
+                             'zfs send -P srcPool1/srcPool1Fs2@zipper_2001-01-01T00:00:02_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs2@zipper_2001-01-01T00:00:02_testBackupSet'])
         self._assertRecorded(recorder,
-                             ['2001-01-01T00:00:01	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs1@zipper_2001-01-01T00:00:00_testBackupSet		backupPool1/srcPool1/srcPool1Fs1@zipper_2001-01-01T00:00:00_testBackupSet	50000		',
-                              '2001-01-01T00:00:03	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs2@zipper_2001-01-01T00:00:02_testBackupSet		backupPool1/srcPool1/srcPool1Fs2@zipper_2001-01-01T00:00:02_testBackupSet	50000		'])
+                             ['2001-01-01T00:00:01	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs1@zipper_2001-01-01T00:00:00_testBackupSet		backupPool1/srcPool1/srcPool1Fs1@zipper_2001-01-01T00:00:00_testBackupSet	50000					',
+                              '2001-01-01T00:00:03	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs2@zipper_2001-01-01T00:00:02_testBackupSet		backupPool1/srcPool1/srcPool1Fs2@zipper_2001-01-01T00:00:02_testBackupSet	50000					'])
         self._assertZfs(zfs,
                         ['pool: srcPool1',
                          '  filesystem: srcPool1/srcPool1Fs1',
@@ -323,18 +356,18 @@ class BackuperTests(unittest.TestCase):
         self._twoFsBackup(zfs, recorder)
         self._assertActions(zfs,
                             ['zfs create backupPool1/srcPool1/srcPool1Fs1',
-                             'zfs send -P srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet | zfs receive -F backupPool1/srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet',
+                             'zfs send -P srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet',
                              'zfs snapshot srcPool1/srcPool1Fs1@zipper_2001-01-02T00:00:01_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_2001-01-02T00:00:01_testBackupSet | zfs receive backupPool1/srcPool1/srcPool1Fs1@zipper_2001-01-02T00:00:01_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_2001-01-02T00:00:01_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs1@zipper_2001-01-02T00:00:01_testBackupSet',
                              'zfs create backupPool1/srcPool1/srcPool1Fs2',
-                             'zfs send -P srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet | zfs receive -F backupPool1/srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet',
+                             'zfs send -P srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet',
                              'zfs snapshot srcPool1/srcPool1Fs2@zipper_2001-01-02T00:00:04_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_2001-01-02T00:00:04_testBackupSet | zfs receive backupPool1/srcPool1/srcPool1Fs2@zipper_2001-01-02T00:00:04_testBackupSet'])
+                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_2001-01-02T00:00:04_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs2@zipper_2001-01-02T00:00:04_testBackupSet'])
         self._assertRecorded(recorder,
-                             ['2001-01-02T00:00:00	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet		backupPool1/srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	50000		',
-                              '2001-01-02T00:00:02	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_2001-01-02T00:00:01_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_2001-01-02T00:00:01_testBackupSet	50000		',
-                              '2001-01-02T00:00:03	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet		backupPool1/srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	50000		',
-                              '2001-01-02T00:00:05	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_2001-01-02T00:00:04_testBackupSet	backupPool1/srcPool1/srcPool1Fs2@zipper_2001-01-02T00:00:04_testBackupSet	50000		'])
+                             ['2001-01-02T00:00:00	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet		backupPool1/srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	50000					',
+                              '2001-01-02T00:00:02	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_2001-01-02T00:00:01_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_2001-01-02T00:00:01_testBackupSet	50000					',
+                              '2001-01-02T00:00:03	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet		backupPool1/srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	50000					',
+                              '2001-01-02T00:00:05	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_2001-01-02T00:00:04_testBackupSet	backupPool1/srcPool1/srcPool1Fs2@zipper_2001-01-02T00:00:04_testBackupSet	50000					'])
         self._assertZfs(zfs,
                         ['pool: srcPool1',
                          '  filesystem: srcPool1/srcPool1Fs1',
@@ -363,12 +396,12 @@ class BackuperTests(unittest.TestCase):
         self._twoFsBackup(zfs, recorder)
         self._assertActions(zfs,
                             ['zfs snapshot srcPool1/srcPool1Fs1@zipper_1999-02-01T00:00:00_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1999-02-01T00:00:00_testBackupSet | zfs receive backupPool1/srcPool1/srcPool1Fs1@zipper_1999-02-01T00:00:00_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1999-02-01T00:00:00_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs1@zipper_1999-02-01T00:00:00_testBackupSet',
                              'zfs snapshot srcPool1/srcPool1Fs2@zipper_1999-02-01T00:00:02_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1999-02-01T00:00:02_testBackupSet | zfs receive backupPool1/srcPool1/srcPool1Fs2@zipper_1999-02-01T00:00:02_testBackupSet'])
+                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1999-02-01T00:00:02_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs2@zipper_1999-02-01T00:00:02_testBackupSet'])
         self._assertRecorded(recorder,
-                             ['1999-02-01T00:00:01	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1999-02-01T00:00:00_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1999-02-01T00:00:00_testBackupSet	50000		',
-                              '1999-02-01T00:00:03	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1999-02-01T00:00:02_testBackupSet	backupPool1/srcPool1/srcPool1Fs2@zipper_1999-02-01T00:00:02_testBackupSet	50000		'])
+                             ['1999-02-01T00:00:01	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1999-02-01T00:00:00_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1999-02-01T00:00:00_testBackupSet	50000					',
+                              '1999-02-01T00:00:03	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1999-02-01T00:00:02_testBackupSet	backupPool1/srcPool1/srcPool1Fs2@zipper_1999-02-01T00:00:02_testBackupSet	50000					'])
         self._assertZfs(zfs,
                         ['pool: srcPool1',
                          '  filesystem: srcPool1/srcPool1Fs1',
@@ -400,26 +433,26 @@ class BackuperTests(unittest.TestCase):
         self._twoFsBackup(zfs, recorder)
         self._assertActions(zfs,
                             ['zfs create backupPool1/srcPool1/srcPool1Fs1',
-                             'zfs send -P srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet | zfs receive -F backupPool1/srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet | zfs receive backupPool1/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet | zfs receive backupPool1/srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet',
+                             'zfs send -P srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet',
                              'zfs snapshot srcPool1/srcPool1Fs1@zipper_1969-02-01T00:00:03_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1969-02-01T00:00:03_testBackupSet | zfs receive backupPool1/srcPool1/srcPool1Fs1@zipper_1969-02-01T00:00:03_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1969-02-01T00:00:03_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs1@zipper_1969-02-01T00:00:03_testBackupSet',
                              'zfs create backupPool1/srcPool1/srcPool1Fs2',
-                             'zfs send -P srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet | zfs receive -F backupPool1/srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet | zfs receive backupPool1/srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet | zfs receive backupPool1/srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet',
+                             'zfs send -P srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet',
                              'zfs snapshot srcPool1/srcPool1Fs2@zipper_1969-02-01T00:00:08_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1969-02-01T00:00:08_testBackupSet | zfs receive backupPool1/srcPool1/srcPool1Fs2@zipper_1969-02-01T00:00:08_testBackupSet'])
+                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1969-02-01T00:00:08_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs2@zipper_1969-02-01T00:00:08_testBackupSet'])
         self._assertRecorded(recorder,
-                             ['1969-02-01T00:00:00	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet		backupPool1/srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	50000		',
-                              '1969-02-01T00:00:01	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	50000		',
-                              '1969-02-01T00:00:02	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	50000		',
-                              '1969-02-01T00:00:04	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1969-02-01T00:00:03_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1969-02-01T00:00:03_testBackupSet	50000		',
-                              '1969-02-01T00:00:05	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet		backupPool1/srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	50000		',
-                              '1969-02-01T00:00:06	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	backupPool1/srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	50000		',
-                              '1969-02-01T00:00:07	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet	backupPool1/srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet	50000		',
-                              '1969-02-01T00:00:09	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1969-02-01T00:00:08_testBackupSet	backupPool1/srcPool1/srcPool1Fs2@zipper_1969-02-01T00:00:08_testBackupSet	50000		'])
+                             ['1969-02-01T00:00:00	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet		backupPool1/srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	50000					',
+                              '1969-02-01T00:00:01	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	50000					',
+                              '1969-02-01T00:00:02	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	50000					',
+                              '1969-02-01T00:00:04	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1969-02-01T00:00:03_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1969-02-01T00:00:03_testBackupSet	50000					',
+                              '1969-02-01T00:00:05	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet		backupPool1/srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	50000					',
+                              '1969-02-01T00:00:06	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	backupPool1/srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	50000					',
+                              '1969-02-01T00:00:07	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet	backupPool1/srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet	50000					',
+                              '1969-02-01T00:00:09	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1969-02-01T00:00:08_testBackupSet	backupPool1/srcPool1/srcPool1Fs2@zipper_1969-02-01T00:00:08_testBackupSet	50000					'])
         self._assertZfs(zfs,
                         ['pool: srcPool1',
                          '  filesystem: srcPool1/srcPool1Fs1',
@@ -456,21 +489,21 @@ class BackuperTests(unittest.TestCase):
         recorder = TestBackupRecorder(self.id())
         self._twoFsBackup(zfs, recorder, backupPool=self.backupPool2)
         self._assertActions(zfs,
-                            ['zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet | zfs receive backupPool2/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet | zfs receive backupPool2/srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet',
+                            ['zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet | zfs receive -s backupPool2/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet | zfs receive -s backupPool2/srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet',
                              'zfs snapshot srcPool1/srcPool1Fs1@zipper_2022-02-01T00:00:02_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_2022-02-01T00:00:02_testBackupSet | zfs receive backupPool2/srcPool1/srcPool1Fs1@zipper_2022-02-01T00:00:02_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet | zfs receive backupPool2/srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet | zfs receive backupPool2/srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_2022-02-01T00:00:02_testBackupSet | zfs receive -s backupPool2/srcPool1/srcPool1Fs1@zipper_2022-02-01T00:00:02_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet | zfs receive -s backupPool2/srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet | zfs receive -s backupPool2/srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet',
                              'zfs snapshot srcPool1/srcPool1Fs2@zipper_2022-02-01T00:00:06_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_2022-02-01T00:00:06_testBackupSet | zfs receive backupPool2/srcPool1/srcPool1Fs2@zipper_2022-02-01T00:00:06_testBackupSet'])
+                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_2022-02-01T00:00:06_testBackupSet | zfs receive -s backupPool2/srcPool1/srcPool1Fs2@zipper_2022-02-01T00:00:06_testBackupSet'])
         self._assertRecorded(recorder,
-                             ['2022-02-01T00:00:00	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	backupPool2/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	50000		',
-                              '2022-02-01T00:00:01	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	backupPool2/srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	50000		',
-                              '2022-02-01T00:00:03	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_2022-02-01T00:00:02_testBackupSet	backupPool2/srcPool1/srcPool1Fs1@zipper_2022-02-01T00:00:02_testBackupSet	50000		',
-                              '2022-02-01T00:00:04	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	backupPool2/srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	50000		',
-                              '2022-02-01T00:00:05	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet	backupPool2/srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet	50000		',
-                              '2022-02-01T00:00:07	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_2022-02-01T00:00:06_testBackupSet	backupPool2/srcPool1/srcPool1Fs2@zipper_2022-02-01T00:00:06_testBackupSet	50000		'])
+                             ['2022-02-01T00:00:00	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	backupPool2/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	50000					',
+                              '2022-02-01T00:00:01	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	backupPool2/srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	50000					',
+                              '2022-02-01T00:00:03	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_2022-02-01T00:00:02_testBackupSet	backupPool2/srcPool1/srcPool1Fs1@zipper_2022-02-01T00:00:02_testBackupSet	50000					',
+                              '2022-02-01T00:00:04	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	backupPool2/srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	50000					',
+                              '2022-02-01T00:00:05	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs2@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet	backupPool2/srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet	50000					',
+                              '2022-02-01T00:00:07	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs2@zipper_1932-03-02T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_2022-02-01T00:00:06_testBackupSet	backupPool2/srcPool1/srcPool1Fs2@zipper_2022-02-01T00:00:06_testBackupSet	50000					'])
         self._assertZfs(zfs,
                         ['pool: srcPool1',
                          '  filesystem: srcPool1/srcPool1Fs1',
@@ -508,18 +541,18 @@ class BackuperTests(unittest.TestCase):
         self._twoFsBackup(zfs, recorder, backupPool=self.backupPool2)
         self._assertActions(zfs,
                             ['zfs create backupPool2/srcPool1/srcPool1Fs1',
-                             'zfs send -P srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet | zfs receive -F backupPool2/srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet',
+                             'zfs send -P srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet | zfs receive -s -F backupPool2/srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet',
                              'zfs snapshot srcPool1/srcPool1Fs1@zipper_1977-02-01T00:00:01_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1977-02-01T00:00:01_testBackupSet | zfs receive backupPool2/srcPool1/srcPool1Fs1@zipper_1977-02-01T00:00:01_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1977-02-01T00:00:01_testBackupSet | zfs receive -s backupPool2/srcPool1/srcPool1Fs1@zipper_1977-02-01T00:00:01_testBackupSet',
                              'zfs create backupPool2/srcPool1/srcPool1Fs2',
-                             'zfs send -P srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet | zfs receive -F backupPool2/srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet',
+                             'zfs send -P srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet | zfs receive -s -F backupPool2/srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet',
                              'zfs snapshot srcPool1/srcPool1Fs2@zipper_1977-02-01T00:00:04_testBackupSet',
-                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1977-02-01T00:00:04_testBackupSet | zfs receive backupPool2/srcPool1/srcPool1Fs2@zipper_1977-02-01T00:00:04_testBackupSet'])
+                             'zfs send -P -i srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs2@zipper_1977-02-01T00:00:04_testBackupSet | zfs receive -s backupPool2/srcPool1/srcPool1Fs2@zipper_1977-02-01T00:00:04_testBackupSet'])
         self._assertRecorded(recorder,
-                             ['1977-02-01T00:00:00	testBackupSet	backupPool2	full	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet		backupPool2/srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	50000		',
-                              '1977-02-01T00:00:02	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1977-02-01T00:00:01_testBackupSet	backupPool2/srcPool1/srcPool1Fs1@zipper_1977-02-01T00:00:01_testBackupSet	50000		',
-                              '1977-02-01T00:00:03	testBackupSet	backupPool2	full	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet		backupPool2/srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	50000		',
-                              '1977-02-01T00:00:05	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1977-02-01T00:00:04_testBackupSet	backupPool2/srcPool1/srcPool1Fs2@zipper_1977-02-01T00:00:04_testBackupSet	50000		'])
+                             ['1977-02-01T00:00:00	testBackupSet	backupPool2	full	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet		backupPool2/srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	50000					',
+                              '1977-02-01T00:00:02	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1977-02-01T00:00:01_testBackupSet	backupPool2/srcPool1/srcPool1Fs1@zipper_1977-02-01T00:00:01_testBackupSet	50000					',
+                              '1977-02-01T00:00:03	testBackupSet	backupPool2	full	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet		backupPool2/srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	50000					',
+                              '1977-02-01T00:00:05	testBackupSet	backupPool2	incr	srcPool1/srcPool1Fs2@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs2@zipper_1977-02-01T00:00:04_testBackupSet	backupPool2/srcPool1/srcPool1Fs2@zipper_1977-02-01T00:00:04_testBackupSet	50000					'])
         self._assertZfs(zfs,
                         ['pool: srcPool1',
                          '  filesystem: srcPool1/srcPool1Fs1',
@@ -550,34 +583,1338 @@ class BackuperTests(unittest.TestCase):
         bsb = BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False)
         bsb.backup()
         self._assertActions(zfs,
-                            ['zfs create backupPool1/srcPool1/srcPool1Fs1',
-                             'zfs snapshot srcPool1/srcPool1Fs1@zipper_1982-02-01T00:00:00_testBackupSet',
-                             'zfs send -P srcPool1/srcPool1Fs1@zipper_1982-02-01T00:00:00_testBackupSet | zfs receive -F backupPool1/srcPool1/srcPool1Fs1@zipper_1982-02-01T00:00:00_testBackupSet',
+                            ['zfs snapshot srcPool1/srcPool1Fs1@zipper_1982-02-01T00:00:00_testBackupSet srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:00_testBackupSet',
+                             'zfs create backupPool1/srcPool1/srcPool1Fs1',
+                             'zfs send -P srcPool1/srcPool1Fs1@zipper_1982-02-01T00:00:00_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs1@zipper_1982-02-01T00:00:00_testBackupSet',
                              'zfs create backupPool1/srcPool1/srcPool1Fs2',
-                             'zfs snapshot srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:02_testBackupSet',
-                             'zfs send -P srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:02_testBackupSet | zfs receive -F backupPool1/srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:02_testBackupSet'])
+                             'zfs send -P srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:00_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:00_testBackupSet'])
         self._assertRecorded(recorder,
-                             ['1982-02-01T00:00:01	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs1@zipper_1982-02-01T00:00:00_testBackupSet		backupPool1/srcPool1/srcPool1Fs1@zipper_1982-02-01T00:00:00_testBackupSet	50000		',
-                              '1982-02-01T00:00:03	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:02_testBackupSet		backupPool1/srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:02_testBackupSet	50000		'])
+                             ['1982-02-01T00:00:01	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs1@zipper_1982-02-01T00:00:00_testBackupSet		backupPool1/srcPool1/srcPool1Fs1@zipper_1982-02-01T00:00:00_testBackupSet	50000					',
+                              '1982-02-01T00:00:02	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:00_testBackupSet		backupPool1/srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:00_testBackupSet	50000					'])
         self._assertZfs(zfs,
                         ['pool: srcPool1',
                          '  filesystem: srcPool1/srcPool1Fs1',
                          '    snapshot: srcPool1/srcPool1Fs1@zipper_1982-02-01T00:00:00_testBackupSet',
                          '  filesystem: srcPool1/srcPool1Fs2',
-                         '    snapshot: srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:02_testBackupSet',
+                         '    snapshot: srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:00_testBackupSet',
                          'pool: backupPool1',
                          '  filesystem: backupPool1/srcPool1/srcPool1Fs1',
                          '    snapshot: backupPool1/srcPool1/srcPool1Fs1@zipper_1982-02-01T00:00:00_testBackupSet',
                          '  filesystem: backupPool1/srcPool1/srcPool1Fs2',
-                         '    snapshot: backupPool1/srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:02_testBackupSet',
+                         '    snapshot: backupPool1/srcPool1/srcPool1Fs2@zipper_1982-02-01T00:00:00_testBackupSet',
                          'pool: backupPool2'])
+        # only one snapshot listing per pool, backup file systems don't exist, so
+        # backup pool is not listed
+        self.assertEqual(zfs.queries, ["zfs list -Hpr -t snapshot srcPool1"])
+        del recorder
+
+    def _resumeFs1Backup(self, zfs, recorder, abortIncomplete=False):
+        fsBackup = FsBackup(zfs, recorder, self.backupConf1, zfs.getFileSystem("srcPool1/srcPool1Fs1"),
+                            self.backupPool1, abortIncomplete=abortIncomplete)
+        fsBackup.backup()
+
+    def testResumeIncr(self):
+        GmtTimeFaker.setTime("1985-02-01")
+        zfs = self._mkBackupPool1Zfs(self.pool1Fs1SnapNames[0:2], (), self.pool1Fs1SnapNames[0:1])
+        zfs.addResumeToken("backupPool1/srcPool1/srcPool1Fs1", "1-e604ea4bf-e0-789c63a2",
+                           "srcPool1/srcPool1Fs1@" + self.pool1Fs1SnapNames[1],
+                           "srcPool1/srcPool1Fs1@" + self.pool1Fs1SnapNames[0])
+        recorder = TestBackupRecorder(self.id())
+        self._resumeFs1Backup(zfs, recorder)
+        self._assertActions(zfs,
+                            ['zfs send -P -t 1-e604ea4bf-e0-789c63a2 | zfs receive -s backupPool1/srcPool1/srcPool1Fs1',
+                             'zfs snapshot srcPool1/srcPool1Fs1@zipper_1985-02-01T00:00:01_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1985-02-01T00:00:01_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs1@zipper_1985-02-01T00:00:01_testBackupSet'])
+        self._assertRecorded(recorder,
+                             ['1985-02-01T00:00:00	testBackupSet	backupPool1	resume	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	20000				20000	',
+                              '1985-02-01T00:00:02	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1985-02-01T00:00:01_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1985-02-01T00:00:01_testBackupSet	50000					'])
+        del recorder
+
+    def testAbortIncomplete(self):
+        GmtTimeFaker.setTime("1985-03-01")
+        zfs = self._mkBackupPool1Zfs(self.pool1Fs1SnapNames[0:2], (), self.pool1Fs1SnapNames[0:1])
+        zfs.addResumeToken("backupPool1/srcPool1/srcPool1Fs1", "1-e604ea4bf-e0-789c63a2",
+                           "srcPool1/srcPool1Fs1@" + self.pool1Fs1SnapNames[1],
+                           "srcPool1/srcPool1Fs1@" + self.pool1Fs1SnapNames[0])
+        recorder = TestBackupRecorder(self.id())
+        self._resumeFs1Backup(zfs, recorder, abortIncomplete=True)
+        self._assertActions(zfs,
+                            ['zfs receive -A backupPool1/srcPool1/srcPool1Fs1',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet',
+                             'zfs snapshot srcPool1/srcPool1Fs1@zipper_1985-03-01T00:00:02_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1985-03-01T00:00:02_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs1@zipper_1985-03-01T00:00:02_testBackupSet'])
+        self._assertRecorded(recorder,
+                             ['1985-03-01T00:00:00	testBackupSet	backupPool1	abort						backupPool1/srcPool1/srcPool1Fs1			',
+                              '1985-03-01T00:00:01	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	50000					',
+                              '1985-03-01T00:00:03	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1985-03-01T00:00:02_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1985-03-01T00:00:02_testBackupSet	50000					'])
+        del recorder
+
+    def testResumeStale(self):
+        GmtTimeFaker.setTime("1985-04-01")
+        zfs = self._mkBackupPool1Zfs(self.pool1Fs1SnapNames[0:2], (), self.pool1Fs1SnapNames[0:1])
+        # interrupted receive of a snapshot that is already on the backup
+        zfs.addResumeToken("backupPool1/srcPool1/srcPool1Fs1", "1-e604ea4bf-e0-789c63a2",
+                           "srcPool1/srcPool1Fs1@" + self.pool1Fs1SnapNames[0])
+        recorder = TestBackupRecorder(self.id())
+        self._resumeFs1Backup(zfs, recorder)
+        self._assertActions(zfs,
+                            ['zfs receive -A backupPool1/srcPool1/srcPool1Fs1',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet',
+                             'zfs snapshot srcPool1/srcPool1Fs1@zipper_1985-04-01T00:00:02_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1985-04-01T00:00:02_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs1@zipper_1985-04-01T00:00:02_testBackupSet'])
+        del recorder
+
+    def testResumeDestroyed(self):
+        GmtTimeFaker.setTime("1985-05-01")
+        zfs = self._mkBackupPool1Zfs(self.pool1Fs1SnapNames[0:2], (), self.pool1Fs1SnapNames[0:1])
+        # interrupted receive of a source snapshot that has since been destroyed
+        zfs.addResumeToken("backupPool1/srcPool1/srcPool1Fs1", "1-e604ea4bf-e0-789c63a2",
+                           "srcPool1/srcPool1Fs1@zipper_1933-01-01T00:00:00_testBackupSet",
+                           "srcPool1/srcPool1Fs1@" + self.pool1Fs1SnapNames[0])
+        recorder = TestBackupRecorder(self.id())
+        self._resumeFs1Backup(zfs, recorder)
+        self.assertEqual(zfs.actions[0], 'zfs receive -A backupPool1/srcPool1/srcPool1Fs1')
+        self.assertEqual(len(zfs.actions), 4)
+        del recorder
+
+    def testCollapseIncr(self):
+        GmtTimeFaker.setTime("1986-02-01")
+        zfs = self._mkBackupPool1Zfs(self.pool1Fs1SnapNames, (), self.pool1Fs1SnapNames[0:1])
+        recorder = TestBackupRecorder(self.id())
+        backupConf = BackupSetConf("testBackupSet", ["srcPool1/srcPool1Fs1"],
+                                   [BackupPoolConf("backupPool1")], collapseIncrementals=True)
+        fsBackup = FsBackup(zfs, recorder, backupConf, zfs.getFileSystem("srcPool1/srcPool1Fs1"), self.backupPool1)
+        fsBackup.backup()
+        self._assertActions(zfs,
+                            ['zfs snapshot srcPool1/srcPool1Fs1@zipper_1986-02-01T00:00:00_testBackupSet',
+                             'zfs send -P -I srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1986-02-01T00:00:00_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs1'])
+        self._assertRecorded(recorder,
+                             ['1986-02-01T00:00:01	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	30000					',
+                              '1986-02-01T00:00:02	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	30000					',
+                              '1986-02-01T00:00:03	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-03-02T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1986-02-01T00:00:00_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1986-02-01T00:00:00_testBackupSet	30000					'])
+        del recorder
+
+    def testSendOptions(self):
+        GmtTimeFaker.setTime("1987-02-01")
+        zfs = self._mkInitialZfs()
+        recorder = TestBackupRecorder(self.id())
+        backupConf = BackupSetConf("testBackupSet",
+                                   [SourceFileSystemConf("srcPool1/srcPool1Fs1", sendOptions="-c -L"),
+                                    "srcPool1/srcPool1Fs2"],
+                                   [BackupPoolConf("backupPool1", sendOptions=["-w"])])
+        for fsName in ("srcPool1/srcPool1Fs1", "srcPool1/srcPool1Fs2"):
+            FsBackup(zfs, recorder, backupConf, zfs.getFileSystem(fsName), self.backupPool1).backup()
+        self._assertActions(zfs,
+                            ['zfs create backupPool1/srcPool1/srcPool1Fs1',
+                             'zfs snapshot srcPool1/srcPool1Fs1@zipper_1987-02-01T00:00:00_testBackupSet',
+                             'zfs send -P -c -L srcPool1/srcPool1Fs1@zipper_1987-02-01T00:00:00_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs1@zipper_1987-02-01T00:00:00_testBackupSet',
+                             'zfs create backupPool1/srcPool1/srcPool1Fs2',
+                             'zfs snapshot srcPool1/srcPool1Fs2@zipper_1987-02-01T00:00:02_testBackupSet',
+                             'zfs send -P -w srcPool1/srcPool1Fs2@zipper_1987-02-01T00:00:02_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs2@zipper_1987-02-01T00:00:02_testBackupSet'])
+        self._assertRecorded(recorder,
+                             ['1987-02-01T00:00:01	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs1@zipper_1987-02-01T00:00:00_testBackupSet		backupPool1/srcPool1/srcPool1Fs1@zipper_1987-02-01T00:00:00_testBackupSet	50000			-c -L		',
+                              '1987-02-01T00:00:03	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs2@zipper_1987-02-01T00:00:02_testBackupSet		backupPool1/srcPool1/srcPool1Fs2@zipper_1987-02-01T00:00:02_testBackupSet	50000			-w		'])
         del recorder
 
+    def testBadSendOptions(self):
+        with self.assertRaisesRegex(BackupConfigError, "^invalid zfs send option '-R'"):
+            SourceFileSystemConf("srcPool1/srcPool1Fs1", sendOptions="-c -R")
+
+    def _mkBackupSetZfs(self):
+        zfs = ZfsMock()
+        zfs.add(self.srcPool1, self.srcPool1Fs1)
+        zfs.add(self.srcPool1, self.srcPool1Fs2)
+        zfs.add(self.backupPool1)
+        return zfs
+
+    def _assertBackupFileSystemSnapshotCounts(self, zfs, expected):
+        "expected is dict of backup file system name to count"
+        got = {fs.name: len(zfs.listSnapshots(fs)) for fs in zfs.root.getChildNode("backupPool1").getChildEntries()}
+        self.assertEqual(got, expected)
+
+    def testBackupSetParallel(self):
+        GmtTimeFaker.setTime("1983-02-01")
+        zfs = self._mkBackupSetZfs()
+        recorder = TestBackupRecorder(self.id())
+        bsb = BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False, jobs=2)
+        bsb.backup()
+        # order is not predictable
+        self.assertEqual(len(recorder.readLines()), 3)
+        self._assertBackupFileSystemSnapshotCounts(zfs, {"backupPool1/srcPool1/srcPool1Fs1": 1,
+                                                         "backupPool1/srcPool1/srcPool1Fs2": 1})
+        del recorder
+
+    def testBackupSetPoolLock(self):
+        GmtTimeFaker.setTime("1983-03-01")
+        with tempfile.TemporaryDirectory() as tmpDir:
+            locks = ResourceLocks(os.path.join(tmpDir, "zfszipper.lock"))
+            recorder = TestBackupRecorder(self.id())
+            with locks.hold(["backupPool1"]):
+                bsb = BackupSetBackup(self._mkBackupSetZfs(), recorder, self.backupConf1, allowDegraded=False,
+                                      poolLock=lambda poolName: locks.hold([poolName]))
+                with self.assertRaisesRegex(LockError, "^can't lock pool backupPool1 "):
+                    bsb.backup()
+            with locks.hold(["backupPool2"]):  # unused pool doesn't block
+                zfs = self._mkBackupSetZfs()
+                BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False,
+                                poolLock=lambda poolName: locks.hold([poolName])).backup()
+                self._assertBackupFileSystemSnapshotCounts(zfs, {"backupPool1/srcPool1/srcPool1Fs1": 1,
+                                                                 "backupPool1/srcPool1/srcPool1Fs2": 1})
+        del recorder
+
+    def testBackupSetPoolExportedWhileWaiting(self):
+        GmtTimeFaker.setTime("1983-04-01")
+        zfs = self._mkBackupSetZfs()
+        recorder = TestBackupRecorder(self.id())
+
+        @contextmanager
+        def exportWhileWaiting(poolName):
+            zfs.exportPool(poolName)  # run holding the lock exports the pool it imported
+            yield
+
+        BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False, poolLock=exportWhileWaiting).backup()
+        self.assertEqual(zfs.actions[0:2], ["zpool export backupPool1", "zpool import backupPool1"])
+        self.assertEqual(zfs.actions[-1], "zpool export backupPool1")
+        got = {name: len(fsNode.children) for name, fsNode in zfs.exported["backupPool1"].children.items()}
+        self.assertEqual(got, {"backupPool1/srcPool1/srcPool1Fs1": 1, "backupPool1/srcPool1/srcPool1Fs2": 1})
+        del recorder
+
+    def testSpaceCheckEstimates(self):
+        GmtTimeFaker.setTime("1989-02-01")
+        zfs = self._mkBackupPool1Zfs(self.pool1Fs1SnapNames[0:2], (), self.pool1Fs1SnapNames[0:1])
+        recorder = TestBackupRecorder(self.id())
+        bsb = BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False, spaceCheck="refuse")
+        bsb.backup([self.backupConf1.getSourceFileSystem("srcPool1/srcPool1Fs1")])
+        self.assertEqual(zfs.queries,
+                         ['zfs list -Hpr -t snapshot srcPool1',
+                          'zfs list -Hpr -t snapshot backupPool1',
+                          'zfs send -nP -i srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet',
+                          'zfs get -Hp -o value written@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1',
+                          'zfs get -Hp -o value available backupPool1'])
+        self._assertRecorded(recorder,
+                             ['1989-02-01T00:00:01	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	50000				40000	',
+                              '1989-02-01T00:00:02	testBackupSet	backupPool1	incr	srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet	srcPool1/srcPool1Fs1@zipper_1989-02-01T00:00:00_testBackupSet	backupPool1/srcPool1/srcPool1Fs1@zipper_1989-02-01T00:00:00_testBackupSet	50000				10000	'])
+        del recorder
+
+    def testSpaceCheckRefuse(self):
+        GmtTimeFaker.setTime("1989-03-01")
+        zfs = self._mkBackupSetZfs()
+        zfs.intProps[("backupPool1", "available")] = 15000
+        recorder = TestBackupRecorder(self.id())
+        bsb = BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False, spaceCheck="refuse")
+        with self.assertRaisesRegex(BackupError, "^estimated size of sends for backup set testBackupSet \\(20000 bytes\\) exceeds space available on backupPool1 \\(15000 bytes\\)$"):
+            bsb.backup()
+        self._assertActions(zfs, [])
+        self._assertRecorded(recorder,
+                             ['1989-03-01T00:00:00	testBackupSet	backupPool1	error				BackupError	estimated size of sends for backup set testBackupSet (20000 bytes) exceeds space available on backupPool1 (15000 bytes)				'])
+        del recorder
+
+    def testSpaceCheckTrim(self):
+        GmtTimeFaker.setTime("1989-04-01")
+        zfs = self._mkBackupSetZfs()
+        zfs.intProps[("backupPool1", "available")] = 15000
+        zfs.intProps[("srcPool1/srcPool1Fs1", "referenced")] = 12000
+        zfs.intProps[("srcPool1/srcPool1Fs2", "referenced")] = 5000
+        recorder = TestBackupRecorder(self.id())
+        bsb = BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False, spaceCheck="trim")
+        bsb.backup()
+        # smaller srcPool1Fs2 is admitted
+        self._assertActions(zfs,
+                            ['zfs snapshot srcPool1/srcPool1Fs2@zipper_1989-04-01T00:00:01_testBackupSet',
+                             'zfs create backupPool1/srcPool1/srcPool1Fs2',
+                             'zfs send -P srcPool1/srcPool1Fs2@zipper_1989-04-01T00:00:01_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs2@zipper_1989-04-01T00:00:01_testBackupSet'])
+        self._assertRecorded(recorder,
+                             ['1989-04-01T00:00:00	testBackupSet	backupPool1	skip						insufficient space on backup pool for srcPool1/srcPool1Fs1		12000	',
+                              '1989-04-01T00:00:02	testBackupSet	backupPool1	full	srcPool1/srcPool1Fs2@zipper_1989-04-01T00:00:01_testBackupSet		backupPool1/srcPool1/srcPool1Fs2@zipper_1989-04-01T00:00:01_testBackupSet	50000				5000	'])
+        del recorder
+
+    def testBackupSetSnapOnly(self):
+        GmtTimeFaker.setTime("1989-05-01")
+        zfs = self._mkBackupSetZfs()
+        recorder = TestBackupRecorder(self.id())
+        bsb = BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False)
+        bsb.snapOnly()
+        self._assertActions(zfs,
+                            ['zfs snapshot srcPool1/srcPool1Fs1@zipper_1989-05-01T00:00:00_testBackupSet srcPool1/srcPool1Fs2@zipper_1989-05-01T00:00:00_testBackupSet'])
+        del recorder
+
+    def _transferOrderBackup(self, transferOrder):
+        zfs = self._mkBackupSetZfs()
+        zfs.intProps[("srcPool1/srcPool1Fs1", "referenced")] = 5000
+        zfs.intProps[("srcPool1/srcPool1Fs2", "referenced")] = 12000
+        recorder = TestBackupRecorder(self.id())
+        bsb = BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False, transferOrder=transferOrder)
+        bsb.backup()
+        recorded = [line.split("\t") for line in recorder.readLines()[1:]]
+        del recorder
+        for row in recorded:
+            self.assertGreaterEqual(float(row[12]), 0.0)  # secs
+        return [zfs.actions[i] for i in (1, 3)]
+
+    def testTransferOrderLargest(self):
+        GmtTimeFaker.setTime("1989-08-01")
+        self.assertEqual(self._transferOrderBackup("largest"),
+                         ['zfs create backupPool1/srcPool1/srcPool1Fs2',
+                          'zfs create backupPool1/srcPool1/srcPool1Fs1'])
+
+    def testTransferOrderSmallest(self):
+        GmtTimeFaker.setTime("1989-08-01")
+        self.assertEqual(self._transferOrderBackup("smallest"),
+                         ['zfs create backupPool1/srcPool1/srcPool1Fs1',
+                          'zfs create backupPool1/srcPool1/srcPool1Fs2'])
+
+    def _writeReadPlan(self, setPlan):
+        fd, planFile = tempfile.mkstemp(".json", "backup-test." + self.id())
+        os.close(fd)
+        self.addCleanup(os.unlink, planFile)
+        writePlan(BackupPlan.create([setPlan]), planFile)
+        return readPlan(planFile).backupSets[0]
+
+    def testPlanExecute(self):
+        GmtTimeFaker.setTime("1989-06-01")
+        zfs = self._mkBackupPool1Zfs(self.pool1Fs1SnapNames[0:2], (), self.pool1Fs1SnapNames[0:1])
+        recorder = TestBackupRecorder(self.id())
+        bsb = BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False)
+        setPlan = self._writeReadPlan(bsb.plan())
+        self._assertActions(zfs, [])
+        self.assertEqual((setPlan.backupSetName, setPlan.backupPoolName, setPlan.available), ("testBackupSet", "backupPool1", 1 << 40))
+        self.assertEqual([s.toDict() for s in setPlan.fileSystems[0].steps],
+                         [{"kind": "incr", "base": "srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet",
+                           "target": "srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet", "estimate": 40000},
+                          {"kind": "incr", "base": "srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet",
+                           "target": None, "estimate": 10000}])
+        self.assertEqual([s.toDict() for s in setPlan.fileSystems[1].steps],
+                         [{"kind": "full", "base": None, "target": None, "estimate": 10000}])
+        self.assertEqual(setPlan.estimatedSize, 60000)
+        BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False).executePlan(setPlan)
+        self._assertActions(zfs,
+                            ['zfs snapshot srcPool1/srcPool1Fs1@zipper_1989-06-01T00:00:01_testBackupSet srcPool1/srcPool1Fs2@zipper_1989-06-01T00:00:01_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-01-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet',
+                             'zfs send -P -i srcPool1/srcPool1Fs1@zipper_1932-02-01T17:30:34_testBackupSet srcPool1/srcPool1Fs1@zipper_1989-06-01T00:00:01_testBackupSet | zfs receive -s backupPool1/srcPool1/srcPool1Fs1@zipper_1989-06-01T00:00:01_testBackupSet',
+                             'zfs create backupPool1/srcPool1/srcPool1Fs2',
+                             'zfs send -P srcPool1/srcPool1Fs2@zipper_1989-06-01T00:00:01_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs2@zipper_1989-06-01T00:00:01_testBackupSet'])
+        del recorder
+
+    def testPlanOutOfDate(self):
+        GmtTimeFaker.setTime("1989-07-01")
+        zfs = self._mkBackupPool1Zfs(self.pool1Fs1SnapNames[0:2], (), self.pool1Fs1SnapNames[0:1])
+        recorder = TestBackupRecorder(self.id())
+        setPlan = self._writeReadPlan(BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False).plan())
+        zfs.createSnapshot("srcPool1/srcPool1Fs1@zipper_1989-07-01T00:00:00_testBackupSet")
+        with self.assertRaisesRegex(BackupSetFailures, "saved plan for srcPool1/srcPool1Fs1 is out of date"):
+            BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False).executePlan(setPlan)
+        del recorder
+
+    def _exportBackupPool1(self, exportBusyCount, exportTimeout):
+        zfs = self._mkBackupSetZfs()
+        zfs.exportBusyCount = exportBusyCount
+        recorder = TestBackupRecorder(self.id())
+        bsb = BackupSetBackup(zfs, recorder, self.backupConf1, allowDegraded=False, exportTimeout=exportTimeout)
+        bsb.exportInitialDelay = 0.001
+        bsb._exportBackupPool(self.backupPool1)
+        recorded = [line.split("\t") for line in recorder.readLines()[1:]]
+        del recorder
+        self.assertEqual(len(recorded), 1)
+        self.assertEqual(recorded[0][3], "export")
+        return zfs, recorded[0][9]
+
+    def testExportClean(self):
+        zfs, info = self._exportBackupPool1(0, 60.0)
+        self._assertActions(zfs, ['zpool export backupPool1'])
+        self.assertRegex(info, "^clean export after 1 attempts in [0-9.]+ sec$")
+
+    def testExportBusy(self):
+        zfs, info = self._exportBackupPool1(2, 60.0)
+        self._assertActions(zfs, ['zpool export backupPool1'])
+        self.assertEqual(zfs.queries, ['zpool export backupPool1', 'zpool export backupPool1'])
+        self.assertRegex(info, "^clean export after 3 attempts in [0-9.]+ sec$")
+
+    def testExportForced(self):
+        zfs, info = self._exportBackupPool1(1000, 0.02)
+        self._assertActions(zfs, ['zpool export -f backupPool1'])
+        self.assertRegex(info, "^forced export after [0-9]+ attempts in [0-9.]+ sec$")
+
+    def testExportError(self):
+        zfs = self._mkBackupSetZfs()
+        zfs.exportError = "cannot open 'backupPool1': no such pool"
+        bsb = BackupSetBackup(zfs, TestBackupRecorder(self.id()), self.backupConf1, allowDegraded=False, exportTimeout=60.0)
+        with self.assertRaisesRegex(ProcessError, "no such pool$"):
+            bsb._exportBackupPool(self.backupPool1)
+        self.assertEqual(zfs.queries, ['zpool export backupPool1'])
+        self._assertActions(zfs, [])
+
+    def testBackupSetFailureIsolation(self):
+        GmtTimeFaker.setTime("1984-02-01")
+        zfs = self._mkBackupSetZfs()
+        recorder = TestBackupRecorder(self.id())
+        backupConf = BackupSetConf("testBackupSet",
+                                   ["srcPool1/srcPool1Fs1", "srcPool1/missingFs", "srcPool1/srcPool1Fs2"],
+                                   [BackupPoolConf("backupPool1")], jobs=2)
+        bsb = BackupSetBackup(zfs, recorder, backupConf, allowDegraded=False)
+        with self.assertRaises(BackupSetFailures) as cm:
+            bsb.backup()
+        self.assertEqual([f[0] for f in cm.exception.failures], ["srcPool1/missingFs"])
+        self.assertRegex(str(cm.exception), "^backup of 1 of 3 file systems in backup set testBackupSet failed:\n    srcPool1/missingFs: configured file system not in ZFS: srcPool1/missingFs$")
+        self._assertBackupFileSystemSnapshotCounts(zfs, {"backupPool1/srcPool1/srcPool1Fs1": 1,
+                                                         "backupPool1/srcPool1/srcPool1Fs2": 1})
+        del recorder
+
+    def testRecorderHeaderChanged(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            recordFile = os.path.join(tmpDir, "record.tsv")
+            oldHeader = "\t".join(BackupRecorder.header[0:10]) + "\n"
+            for recordPath in (recordFile, recordFile + ".1"):
+                with open(recordPath, "w") as fh:
+                    fh.write(oldHeader)
+            recorder = BackupRecorder(recordFile)
+            recorder.close()
+            recorder = BackupRecorder(recordFile)  # same header, appended to
+            recorder.record(self.backupConf1, self.backupPool1, "export")
+            recorder.close()
+            with open(recordFile + ".2") as fh:
+                self.assertEqual(fh.read(), oldHeader)
+            with open(recordFile) as fh:
+                lines = fh.readlines()
+            self.assertEqual(lines[0], "\t".join(BackupRecorder.header) + "\n")
+            self.assertEqual([line.split("\t")[3] for line in lines[1:]], ["export"])
+
+class ZfsCacheTests(unittest.TestCase):
+    zpoolListCmd = ["zpool", "list", "-H", "-o", "name,health,guid"]
+    zfsListCmd = ["zfs", "list", "-H", "-t", "filesystem", "-o", "name,mountpoint,mounted"]
+
+    def _mkZfs(self):
+        cmdRunner = CmdRunnerMock()
+        cmdRunner.addResponse(self.zpoolListCmd, ["pool1\tONLINE\t101", "backup1\tONLINE\t102"])
+        cmdRunner.addResponse(self.zfsListCmd, ["pool1\t/pool1\tyes", "pool1/fs1\t/pool1/fs1\tyes",
+                                                "backup1\t/backup1\tyes"])
+        return Zfs(cmdRunner)
+
+    def testLookups(self):
+        zfs = self._mkZfs()
+        self.assertEqual(zfs.findPool("pool1").name, "pool1")
+        self.assertIsNone(zfs.findPool("pool2"))
+        self.assertEqual(zfs.findFileSystem("pool1/fs1").mountpoint, "/pool1/fs1")
+        self.assertIsNone(zfs.findFileSystem("pool1/fs2"))
+        self.assertEqual(zfs.cmdRunner.cmds, [" ".join(self.zpoolListCmd), " ".join(self.zfsListCmd)])
+
+    def testCreateFileSystem(self):
+        zfs = self._mkZfs()
+        zfs.cmdRunner.addResponse(self.zfsListCmd + ["backup1/pool1", "backup1/pool1/fs1"],
+                                  ["backup1/pool1\t/backup1/pool1\tyes", "backup1/pool1/fs1\t/backup1/pool1/fs1\tyes"])
+        fs = zfs.createFileSystem("backup1/pool1/fs1")
+        self.assertEqual(fs.name, "backup1/pool1/fs1")
+        self.assertEqual(zfs.findFileSystem("backup1/pool1").name, "backup1/pool1")
+        self.assertEqual(zfs.cmdRunner.cmds, [" ".join(self.zfsListCmd),
+                                              "zfs create -p backup1/pool1/fs1",
+                                              " ".join(self.zfsListCmd + ["backup1/pool1", "backup1/pool1/fs1"])])
+
+    def testImportExport(self):
+        zfs = self._mkZfs()
+        self.assertIsNotNone(zfs.findPool("backup1"))
+        self.assertIsNotNone(zfs.findFileSystem("backup1"))
+        zfs.exportPool("backup1")
+        self.assertIsNone(zfs.findPool("backup1"))
+        self.assertIsNone(zfs.findFileSystem("backup1"))
+        self.assertEqual(zfs.cmdRunner.cmds[2:], ["zpool export backup1"])
+        zfs.importPool("backup1")
+        self.assertIsNotNone(zfs.findPool("backup1"))
+        self.assertIsNotNone(zfs.findFileSystem("backup1"))
+        self.assertEqual(zfs.cmdRunner.cmds[3:], ["zpool import backup1", " ".join(self.zpoolListCmd), " ".join(self.zfsListCmd)])
+
+    def testCreateSnapshot(self):
+        zfs = self._mkZfs()
+        listCmd = ["zfs", "list", "-Hd", "1", "-t", "snapshot", "-o", "name", "-s", "creation", "pool1/fs1"]
+        zfs.cmdRunner.addResponse(listCmd, ["pool1/fs1@snap1"])
+        self.assertEqual(zfs.listSnapshots("pool1/fs1"), [ZfsSnapshot("pool1/fs1@snap1")])
+        zfs.createSnapshot("pool1/fs1@snap2")
+        self.assertEqual(zfs.listSnapshots("pool1/fs1"), [ZfsSnapshot("pool1/fs1@snap1"), ZfsSnapshot("pool1/fs1@snap2")])
+        self.assertEqual(zfs.cmdRunner.cmds, [" ".join(listCmd), "zfs snapshot pool1/fs1@snap2"])
+
+    def testDiscover(self):
+        zfs = self._mkZfs()
+        zfs.cmdRunner.addResponse(["zpool", "import"], ["   pool: backup2", "     id: 1234", "  state: ONLINE"])
+        self.assertEqual([(p.name, p.imported) for p in zfs.discover()],
+                         [("backup2", False), ("pool1", True), ("backup1", True)])
+        self.assertEqual(zfs.findPool("backup1").name, "backup1")
+        self.assertEqual(zfs.findFileSystem("pool1/fs1").mountpoint, "/pool1/fs1")
+        self.assertEqual(sorted(zfs.cmdRunner.cmds), sorted(["zpool import", " ".join(self.zpoolListCmd), " ".join(self.zfsListCmd)]))
+
+        # exported pools found by discover are reused until a pool is imported
+        self.assertEqual([p.name for p in zfs.listExportedPools()], ["backup2"])
+        self.assertEqual(len(zfs.cmdRunner.cmds), 3)
+        zfs.importPool("backup2")
+        self.assertEqual([p.name for p in zfs.listExportedPools()], ["backup2"])
+        self.assertEqual(zfs.cmdRunner.cmds[3:], ["zpool import backup2", "zpool import"])
+
+    def testCreateSnapshots(self):
+        zfs = self._mkZfs()
+        zfs.createSnapshots(["pool1/fs1@snap2", "backup1@snap2", "pool1@snap2"])
+        self.assertEqual(zfs.cmdRunner.cmds, ["zfs snapshot pool1/fs1@snap2 pool1@snap2",
+                                              "zfs snapshot backup1@snap2"])
+
+class PoolImportTests(unittest.TestCase):
+    zpoolImportOutput = ["   pool: backup1",
+                         "     id: 1111",
+                         "  state: ONLINE",
+                         " action: The pool can be imported using its name or numeric identifier.",
+                         " config:",
+                         "",
+                         "        backup1     ONLINE",
+                         "          ada1      ONLINE",
+                         "",
+                         "   pool: backup1",
+                         "     id: 2222",
+                         "  state: DEGRADED",
+                         " status: One or more devices are missing from the system.",
+                         " action: The pool can be imported despite missing or damaged devices.",
+                         "    see: http://illumos.org/msg/ZFS-8000-2Q",
+                         " config:",
+                         "",
+                         "        backup1     DEGRADED",
+                         "          mirror-0  DEGRADED",
+                         "            ada2    ONLINE",
+                         "            ada3    UNAVAIL  cannot open"]
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def _mkDevice(self, name):
+        device = os.path.join(self.tmpDir.name, name)
+        open(device, "w").close()
+        return device
+
+    def testParse(self):
+        self.assertEqual(parseExportedPools(self.zpoolImportOutput),
+                         [ZfsPool("backup1", False, ZfsPoolHealth.ONLINE, "1111"),
+                          ZfsPool("backup1", False, ZfsPoolHealth.DEGRADED, "2222")])
+        with self.assertRaisesRegex(ZfsError, "`state:' not found for pool backup1"):
+            parseExportedPools(["   pool: backup1", "     id: 1111"])
+
+    def testHints(self):
+        self.assertEqual(ZfsImportHints(["/dev/disk/by-id", "/dev/gpt"], "/etc/zfs/rotation.cache").searchArgs,
+                         ("-c", "/etc/zfs/rotation.cache", "-d", "/dev/disk/by-id", "-d", "/dev/gpt"))
+        self.assertEqual(ZfsImportHints().searchArgs, ())
+        poolConf = BackupPoolConf("backup1", deviceDirs="/dev/gpt", guid=2222)
+        self.assertEqual((poolConf.deviceDirs, poolConf.guid), (("/dev/gpt",), "2222"))
+        with self.assertRaisesRegex(BackupConfigError, "^guid of backup pool backup1 must be a decimal number"):
+            BackupPoolConf("backup1", guid="backup1")
+
+    def testTargetedSearch(self):
+        zfs = Zfs(CmdRunnerMock())
+        zfs.setImportHints("backup1", ZfsImportHints(["/dev/gpt"], guid="2222"))
+        zfs.setImportHints("backup2", ZfsImportHints(["/dev/gpt"]))
+        zfs.cmdRunner.addResponse(["zpool", "import", "-d", "/dev/gpt"], self.zpoolImportOutput)
+        pools = zfs.listExportedPools()
+        self.assertEqual(pools, [ZfsPool("backup1", False, ZfsPoolHealth.DEGRADED, "2222")])
+        zfs.importPool(pools[0])
+        self.assertEqual(zfs.cmdRunner.cmds, ["zpool import -d /dev/gpt", "zpool import -d /dev/gpt 2222 backup1"])
+
+    def testFullScan(self):
+        zfs = Zfs(CmdRunnerMock())
+        zfs.setImportHints("backup1", ZfsImportHints(cacheFile="/etc/zfs/rotation.cache"))
+        zfs.setImportHints("backup2", ZfsImportHints())
+        zfs.cmdRunner.addError(["zpool", "import", "-c", "/etc/zfs/rotation.cache"], "no pools available to import")
+        zfs.cmdRunner.addResponse(["zpool", "import"], self.zpoolImportOutput[0:9])
+        self.assertEqual(zfs.listExportedPools(), [ZfsPool("backup1", False, ZfsPoolHealth.ONLINE, "1111")])
+        zfs.importPool("backup1")
+        self.assertEqual(zfs.cmdRunner.cmds, ["zpool import -c /etc/zfs/rotation.cache", "zpool import", "zpool import backup1"])
+
+        # pools with hints only scan all devices when asked to
+        del zfs.importHints["backup2"]
+        self.assertEqual(zfs._exportedSearches(None), [("-c", "/etc/zfs/rotation.cache")])
+        zfs.fullImportScan = True
+        self.assertEqual(zfs._exportedSearches(None), [("-c", "/etc/zfs/rotation.cache"), ()])
+
+    def testPollPoolNames(self):
+        zfs = Zfs(CmdRunnerMock())
+        zfs.setImportHints("backup1", ZfsImportHints(["/dev/gpt"]))
+        zfs.setImportHints("backup2", ZfsImportHints())
+        zfs.cmdRunner.addResponse(["zpool", "list", "-H", "-o", "name,health,guid"], ["pool1\tONLINE\t101"])
+        zfs.cmdRunner.addResponse(["zpool", "import", "-d", "/dev/gpt"], self.zpoolImportOutput[0:9])
+        self.assertEqual(zfs.pollPoolNames(), ["backup1", "pool1"])
+        self.assertEqual(zfs.pollPoolNames(), ["backup1", "pool1"])
+        self.assertEqual(zfs.cmdRunner.cmds, 2 * ["zpool list -H -o name,health,guid", "zpool import -d /dev/gpt"])
+
+    def testCanPollPool(self):
+        zfs = Zfs(CmdRunnerMock())
+        zfs.setImportHints("backup1", ZfsImportHints(["/dev/gpt"]))
+        zfs.setImportHints("backup2", ZfsImportHints(guid=2222))
+        self.assertTrue(zfs.canPollPool("backup1"))
+        self.assertFalse(zfs.canPollPool("backup2"))
+        self.assertFalse(zfs.canPollPool("backup3"))
+        zfs.deviceCache = ZfsPoolDeviceCache(os.path.join(self.tmpDir.name, "devices.json"))
+        zfs.deviceCache.record("2222", "backup2", [self._mkDevice("ada2")])
+        self.assertTrue(zfs.canPollPool("backup2"))
+        self.assertFalse(zfs.canPollPool("backup3"))
+
+    def testDeviceCache(self):
+        cacheFile = os.path.join(self.tmpDir.name, "devices.json")
+        device1, device2 = self._mkDevice("ada2"), self._mkDevice("ada3")
+        zfs = Zfs(CmdRunnerMock())
+        zfs.fullImportScan = False
+        zfs.deviceCache = ZfsPoolDeviceCache(cacheFile)
+        zfs.cmdRunner.addResponse(["zpool", "list", "-H", "-o", "name,health,guid"], ["backup1\tONLINE\t2222"])
+        zfs.cmdRunner.addResponse(["zpool", "status", "-P", "backup1"],
+                                  ["  pool: backup1", " state: ONLINE", "config:", "",
+                                   "\tNAME            STATE     READ WRITE CKSUM",
+                                   "\tbackup1         ONLINE       0     0     0",
+                                   "\t  mirror-0      ONLINE       0     0     0",
+                                   "\t    {}  ONLINE       0     0     0".format(device1),
+                                   "\t    {}  ONLINE       0     0     0".format(device2)])
+        self.assertEqual(zfs.listExportedPools(), [])
+        zfs.importPool("backup1")
+        self.assertEqual(zfs.cmdRunner.cmds, ["zpool import backup1", "zpool list -H -o name,health,guid", "zpool status -P backup1"])
+
+        deviceCache = ZfsPoolDeviceCache(cacheFile)
+        self.assertEqual(deviceCache.pools, {"2222": {"name": "backup1", "devices": [device1, device2]}})
+        self.assertEqual(deviceCache.searches(), [("-d", device1, "-d", device2)])
+        os.unlink(device1)
+        self.assertEqual(deviceCache.searches(), [("-d", device2)])
+        os.unlink(device2)
+        self.assertEqual(deviceCache.searches(), [])
+
+        with open(cacheFile, "w") as fh:
+            fh.write("junk")
+        self.assertEqual(ZfsPoolDeviceCache(cacheFile).pools, {})
+
+class SshTransportTests(unittest.TestCase):
+    zpoolListCmd = ["zpool", "list", "-H", "-o", "name,health,guid"]
+    zfsListCmd = ["zfs", "list", "-H", "-t", "filesystem", "-o", "name,mountpoint,mounted"]
+    fakeSsh = os.path.abspath("fakeSsh")
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.controlDir = os.path.join(self.tmpDir.name, "ctl")
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def _mkTransport(self, **kwargs):
+        return SshTransport("backuphost", controlDir=self.controlDir, **kwargs)
+
+    def _mkZfs(self, transport):
+        cmdRunner = CmdRunnerMock()
+        cmdRunner.addResponse(self.zpoolListCmd, ["pool1\tONLINE\t101"])
+        cmdRunner.addResponse(self.zfsListCmd, ["pool1\t/pool1\tyes", "pool1/fs1\t/pool1/fs1\tyes"])
+        zfs = Zfs(cmdRunner)
+        zfs.addRemotePool("backup2", transport)
+        return zfs
+
+    def testWrapCmd(self):
+        transport = self._mkTransport(user="zipper", port=2222, compression=True, sshCommand="ssh -q")
+        self.assertEqual(transport.wrapCmd(["zfs", "list", "pool/a b"]),
+                         ["ssh", "-q", "-o", "ControlMaster=auto", "-o", "ControlPath=" + self.controlDir + "/zfszipper-ssh-%C",
+                          "-o", "ControlPersist=300", "-o", "BatchMode=yes", "-p", "2222", "-C",
+                          "zipper@backuphost", "zfs list 'pool/a b'"])
+        transport.cmdRunner = CmdRunnerMock()
+        transport.close()
+        self.assertEqual(transport.cmdRunner.cmds,
+                         ["ssh -q -o ControlMaster=auto -o ControlPath=" + self.controlDir + "/zfszipper-ssh-%C -o ControlPersist=300"
+                          " -o BatchMode=yes -p 2222 -C -O exit zipper@backuphost"])
+
+    def testControlDir(self):
+        self._mkTransport().wrapCmd(["true"])
+        self.assertEqual(os.stat(self.controlDir).st_mode & 0o777, 0o700)
+        os.chmod(self.controlDir, 0o1777)
+        with self.assertRaisesRegex(SshError, "must only be accessible by it's owner, mode is 1777$"):
+            self._mkTransport().wrapCmd(["true"])
+
+    def testRemotePool(self):
+        transport = self._mkTransport()
+        zfs = self._mkZfs(transport)
+        zfs.cmdRunner.addResponse(transport.wrapCmd(self.zpoolListCmd), ["backup2\tONLINE\t201", "other\tONLINE\t202"])
+        zfs.cmdRunner.addResponse(transport.wrapCmd(self.zfsListCmd + ["-r", "backup2"]),
+                                  ["backup2\t/backup2\tyes", "backup2/pool1\t/backup2/pool1\tyes"])
+        zfs.cmdRunner.addResponse(transport.wrapCmd(["zfs", "get", "-Hp", "-o", "value", "available", "backup2"]), ["1000"])
+        self.assertEqual(zfs.findPool("backup2").name, "backup2")
+        self.assertIsNone(zfs.findPool("other"))
+        self.assertIsNotNone(zfs.findFileSystem("pool1/fs1"))
+        self.assertIsNotNone(zfs.findFileSystem("backup2/pool1"))
+        self.assertEqual(zfs.getIntProp("backup2", "available"), 1000)
+        self.assertEqual([cmd.split(" ")[-1] for cmd in zfs.cmdRunner.cmds if cmd.startswith("ssh ")],
+                         ["name,health,guid", "backup2", "backup2"])
+
+    def testUnreachableHost(self):
+        transport = self._mkTransport()
+        zfs = self._mkZfs(transport)
+        zfs.cmdRunner.addError(transport.wrapCmd(self.zpoolListCmd), "ssh: connect to host backuphost port 22: Connection refused")
+        self.assertIsNone(zfs.findPool("backup2"))
+        self.assertEqual(zfs.findPool("pool1").name, "pool1")
+
+    def testDiscover(self):
+        transport = self._mkTransport()
+        unreachable = SshTransport("downhost", controlDir=self.controlDir)
+        zfs = self._mkZfs(transport)
+        zfs.addRemotePool("backup3", unreachable)
+        zfs.cmdRunner.addResponse(transport.wrapCmd(["zpool", "import"]), ["   pool: backup2b", "  state: ONLINE"])
+        zfs.cmdRunner.addResponse(transport.wrapCmd(self.zpoolListCmd), ["backup2\tONLINE\t201", "other\tONLINE\t202"])
+        zfs.cmdRunner.addResponse(transport.wrapCmd(self.zfsListCmd + ["-r", "backup2"]), ["backup2\t/backup2\tyes"])
+        zfs.cmdRunner.addError(unreachable.wrapCmd(self.zpoolListCmd), "ssh: connect to host downhost port 22: Connection refused")
+        zfs.addRemotePool("backup2b", transport)
+        self.assertEqual(sorted([p.name for p in zfs.discover()]), ["backup2", "backup2b", "pool1"])
+        self.assertIsNotNone(zfs.findFileSystem("backup2"))
+        self.assertIsNone(zfs.findPool("backup3"))
+        self.assertEqual(len(zfs.cmdRunner.cmds), 8)  # no further listings
+
+    def testLocalWrapper(self):
+        transport = self._mkTransport(compression=True, sshCommand=self.fakeSsh)
+        self.assertEqual(CmdRunner().call(transport.wrapCmd(["echo", "a  b"])), ["a  b"])
+        pipeline = Pipeline()
+        pipeline.add(["echo", "hello"])
+        pipeline.add(transport.wrapCmd(["sh", "-c", "wc -c >&2"]))
+        self.assertEqual(int(CmdRunner().runPipeline(pipeline)[1].stderr.strip()), 6)
+        transport.close()
+
+class DaemonTests(unittest.TestCase):
+    @staticmethod
+    def _localTime(ymdhm):
+        return time.strptime(ymdhm, "%Y-%m-%d %H:%M")
+
+    @staticmethod
+    def _minute(ymdhm):
+        return int(time.mktime(time.strptime(ymdhm, "%Y-%m-%d %H:%M")) // 60)
+
+    def testCronSchedule(self):
+        schedule = CronSchedule("*/15 8-18 * * mon-fri")
+        self.assertTrue(schedule.matches(self._localTime("2024-03-04 08:45")))  # Monday
+        self.assertFalse(schedule.matches(self._localTime("2024-03-04 08:46")))
+        self.assertFalse(schedule.matches(self._localTime("2024-03-04 19:00")))
+        self.assertFalse(schedule.matches(self._localTime("2024-03-03 08:45")))  # Sunday
+        # day of month or day of week
+        schedule = CronSchedule("0 2 1 * 7")
+        self.assertTrue(schedule.matches(self._localTime("2024-03-01 02:00")))  # Friday
+        self.assertTrue(schedule.matches(self._localTime("2024-03-03 02:00")))  # Sunday
+        self.assertFalse(schedule.matches(self._localTime("2024-03-02 02:00")))
+        # a field starting with * isn't a restriction, so both must match
+        schedule = CronSchedule("0 2 */2 * mon")
+        self.assertTrue(schedule.matches(self._localTime("2024-03-11 02:00")))  # Monday, odd day
+        self.assertFalse(schedule.matches(self._localTime("2024-03-04 02:00")))  # Monday, even day
+        self.assertFalse(schedule.matches(self._localTime("2024-03-05 02:00")))  # Tuesday, odd day
+        self.assertTrue(CronSchedule("@daily").matches(self._localTime("2024-03-02 00:00")))
+
+    def testCronErrors(self):
+        for spec in ("* * * *", "60 * * * *", "* * * * fun", "*/0 * * * *", "5-1 * * * *"):
+            with self.assertRaises(CronError):
+                CronSchedule(spec)
+
+    def testDueJobs(self):
+        hourly = DaemonJob("hourly", "snapOnly", CronSchedule("0 * * * *"))
+        nightly = DaemonJob("nightly", "backup", CronSchedule("30 2 * * *"))
+        daemon = BackupDaemon([hourly, nightly], None)
+        self.assertEqual(daemon.dueJobs(self._minute("2024-03-04 01:59"), self._minute("2024-03-04 02:00")), [hourly])
+        self.assertEqual(daemon.dueJobs(self._minute("2024-03-04 02:00"), self._minute("2024-03-04 02:29")), [])
+        # missed while running for a long time, each job is run once
+        self.assertEqual(daemon.dueJobs(self._minute("2024-03-04 00:10"), self._minute("2024-03-04 04:10")), [hourly, nightly])
+
+    def testRunDue(self):
+        ran = []
+
+        def runJob(job):
+            ran.append(job.backupSetName)
+            if job.backupSetName == "bad":
+                raise BackupError("no disk")
+            return None
+
+        good = DaemonJob("good", "backup", CronSchedule("* * * * *"))
+        bad = DaemonJob("bad", "backup", CronSchedule("* * * * *"))
+        daemon = BackupDaemon([bad, good], runJob)
+        daemon.runDue(self._minute("2024-03-04 01:59"), self._minute("2024-03-04 02:00"))
+        self.assertEqual(ran, ["bad", "good"])
+        self.assertEqual((bad.lastResult, bad.lastError), ("failed", "no disk"))
+        self.assertEqual((good.lastResult, good.runs), ("ok", 1))
+        # reloading configuration keeps history
+        newGood = DaemonJob("good", "backup", CronSchedule("0 * * * *"))
+        daemon.setJobs([newGood])
+        self.assertEqual((newGood.lastResult, newGood.runs), ("ok", 1))
+
+    def testNextRunCached(self):
+        class CountingSchedule(CronSchedule):
+            calls = 0
+
+            def nextTime(self, after, **kwargs):
+                CountingSchedule.calls += 1
+                return super(CountingSchedule, self).nextTime(after, **kwargs)
+
+        now = [self._minute("2024-03-04 01:00") * 60]
+        nightly = DaemonJob("nightly", "backup", CountingSchedule("30 2 * * *"))
+        daemon = BackupDaemon([nightly], lambda job: None, clock=lambda: now[0])
+        for i in range(3):
+            self.assertEqual(daemon.status()["jobs"][0]["nextRun"], "2024-03-04T02:30:00")
+        self.assertEqual(CountingSchedule.calls, 1)
+        now[0] = self._minute("2024-03-04 02:30") * 60
+        daemon.runDue(self._minute("2024-03-04 02:29"), self._minute("2024-03-04 02:30"))
+        self.assertEqual(daemon.status()["jobs"][0]["nextRun"], "2024-03-05T02:30:00")
+        self.assertEqual(CountingSchedule.calls, 2)
+
+    def testRequestRun(self):
+        ran = []
+        nightly = DaemonJob("nightly", "backup", CronSchedule("30 2 * * *"))
+        daemon = BackupDaemon([nightly], lambda job: ran.append(job))
+        daemon.requestRun("rotation")
+        daemon.requestRun("nightly")
+        daemon.requestRun("rotation")
+        daemon.runRequested()
+        self.assertEqual([str(job) for job in ran], ["backup rotation", "backup nightly"])
+        self.assertIs(ran[1], nightly)
+        self.assertEqual([(j["backupSet"], j["schedule"], j["nextRun"]) for j in daemon.status()["jobs"]][1],
+                         ("rotation", None, None))
+
+    def testStatusSocket(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            socketPath = os.path.join(tmpDir, "status.sock")
+            daemon = BackupDaemon([DaemonJob("test", "backup", CronSchedule("@daily"))], None, statusSocket=socketPath)
+            thread = threading.Thread(target=daemon.run)
+            thread.start()
+            try:
+                for i in range(100):
+                    if os.path.exists(socketPath):
+                        break
+                    time.sleep(0.01)
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(socketPath)
+                    status = json.loads(sock.makefile().read())
+            finally:
+                daemon.stop()
+                thread.join()
+            self.assertEqual(status["pid"], os.getpid())
+            self.assertEqual([(j["backupSet"], j["schedule"], j["running"]) for j in status["jobs"]], [("test", "@daily", False)])
+            self.assertTrue(status["jobs"][0]["nextRun"].endswith("T00:00:00"))
+            self.assertFalse(os.path.exists(socketPath))
+
+class PoolWatcherTests(unittest.TestCase):
+    def _mkWatcher(self, attached, appeared, **kwargs):
+        "attached is a list standing in for the available pools"
+        return PoolWatcher(lambda: list(attached), ["zackup1a", "zackup1b"], appeared.append, **kwargs)
+
+    def testPoll(self):
+        attached = ["pool1", "zackup1a"]
+        appeared = []
+        watcher = self._mkWatcher(attached, appeared)
+        self.assertEqual(watcher.poll(), ["zackup1a"])  # present at start
+        self.assertEqual(watcher.poll(), [])
+        attached[:] = ["pool1", "zackup1b"]  # rotated
+        self.assertEqual(watcher.poll(), ["zackup1b"])
+        attached[:] = ["pool1"]
+        self.assertEqual(watcher.poll(), [])
+        attached[:] = ["pool1", "zackup1b"]
+        self.assertEqual(watcher.poll(), ["zackup1b"])
+        self.assertEqual(appeared, ["zackup1a", "zackup1b", "zackup1b"])
+
+    def testListFails(self):
+        def listPoolNames():
+            raise ProcessError(1, ["zpool", "import"], "no pools available")
+        watcher = PoolWatcher(listPoolNames, ["zackup1a"], None)
+        self.assertEqual(watcher.poll(), [])
+
+    def testWake(self):
+        attached = []
+        appeared = []
+        watcher = self._mkWatcher(attached, appeared, interval=60.0)
+        watcher.start()
+        try:
+            attached.append("zackup1a")
+            for i in range(100):
+                watcher.wake()
+                if len(appeared) > 0:
+                    break
+                time.sleep(0.01)
+        finally:
+            watcher.stop()
+        self.assertEqual(appeared, ["zackup1a"])
+
+class ResourceLocksTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.lockFilePrefix = os.path.join(self.tmpDir.name, "zfszipper.lock")
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def testLockFile(self):
+        locks = ResourceLocks(self.lockFilePrefix)
+        self.assertEqual(locks.lockFile("fs", "pool1/fs 1"), self.lockFilePrefix + ".fs.pool1%2Ffs%201")
+
+    def testConflicts(self):
+        locks = ResourceLocks(self.lockFilePrefix)
+        with locks.hold(["zackup1a", "zackup1b"], ["pool1/fs1"]):
+            with self.assertRaisesRegex(LockError, "^can't lock fs pool1/fs1 "):
+                with locks.hold([], ["pool1/fs2", "pool1/fs1"]):
+                    pass
+            with locks.hold(["zackup2a"], ["pool1/fs2"]):  # independent set
+                pass
+        with locks.hold([], ["pool1/fs1"]):  # released
+            pass
+
+    def testTimeout(self):
+        locks = ResourceLocks(self.lockFilePrefix, timeout=5.0, pollInterval=0.01)
+        held = threading.Event()
+
+        def holder():
+            with locks.hold(["zackup1a"]):
+                held.set()
+                time.sleep(0.1)
+
+        thread = threading.Thread(target=holder)
+        thread.start()
+        held.wait()
+        startTime = time.monotonic()
+        with locks.hold(["zackup1a"]):
+            self.assertGreater(time.monotonic() - startTime, 0.05)
+        thread.join()
+
+    def testNoDeadlock(self):
+        locks = ResourceLocks(self.lockFilePrefix, timeout=10.0, pollInterval=0.001)
+        counts = []
+
+        def run(fileSystemNames):
+            for i in range(20):
+                with locks.hold(["zackup1a"] if i % 2 else [], fileSystemNames):
+                    counts.append(1)
+
+        threads = [threading.Thread(target=run, args=(names,))
+                   for names in (["pool1/fs1", "pool1/fs2"], ["pool1/fs2", "pool1/fs1"])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(counts), 40)
+
+class ConfigTests(unittest.TestCase):
+    configPyText = """
+from zfszipper.config import *
+config = BackupConf([BackupSetConf("set1", ["pool1/fs1", "pool1/fs2"], [BackupPoolConf("zackup1a"), BackupPoolConf("zackup1b")]),
+                     BackupSetConf("set2", ["pool1/fs2"], [BackupPoolConf("zackup2a")], schedule="@daily")],
+                    recordFilePattern="{}")
+"""
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def _mkConfig(self):
+        return BackupConf([BackupSetConf("set1", ["pool1/fs1", "pool1/fs2"], [BackupPoolConf("zackup1a"), BackupPoolConf("zackup1b")]),
+                           BackupSetConf("set2", ["pool1/fs2"], [BackupPoolConf("zackup2a")])])
+
+    def testIndexes(self):
+        config = self._mkConfig()
+        self.assertEqual(config.getBackupSet("set2").name, "set2")
+        with self.assertRaisesRegex(BackupConfigError, "^unknown backup set: set3$"):
+            config.getBackupSet("set3")
+        self.assertEqual([bs.name for bs in config.findSourceFileSystemBackupSets("pool1/fs2")], ["set1", "set2"])
+        self.assertEqual(config.findSourceFileSystemBackupSets("pool1/fs3"), [])
+        self.assertEqual([bs.name for bs in config.findBackupPoolBackupSets("zackup1b")], ["set1"])
+        self.assertEqual(config.findBackupPoolBackupSets("zackup3a"), [])
+        backupSet = config.getBackupSet("set1")
+        self.assertEqual(backupSet.getSourceFileSystem("pool1/fs1").name, "pool1/fs1")
+        with self.assertRaisesRegex(BackupConfigError, "^can't find source file system: pool1/fs3 in BackupSet set1$"):
+            backupSet.getSourceFileSystem("pool1/fs3")
+        with self.assertRaisesRegex(BackupConfigError, "^backup pool zackup2a not part of backup set set1$"):
+            backupSet.getBackupPoolConf("zackup2a")
+
+    def testConsistency(self):
+        with self.assertRaisesRegex(BackupConfigError, "^multiple backup sets named set1$"):
+            BackupConf([BackupSetConf("set1", ["pool1/fs1"], [BackupPoolConf("zackup1a")]),
+                        BackupSetConf("set1", ["pool1/fs2"], [BackupPoolConf("zackup1b")])])
+        config = BackupConf([BackupSetConf("set1", ["pool1/fs1"], [BackupPoolConf("zackup1a")]),
+                             BackupSetConf("set2", ["pool1/fs2"], [BackupPoolConf("zackup1a")])])
+        self.assertEqual([bs.name for bs in config.findBackupPoolBackupSets("zackup1a")], ["set1", "set2"])
+
+    def testConfigCache(self):
+        configPy = os.path.join(self.tmpDir.name, "config.py")
+        cacheFile = os.path.join(self.tmpDir.name, "config.cache")
+        with open(configPy, "w") as fh:
+            fh.write(self.configPyText.format("record1"))
+        config1 = evalConfigFile(configPy, cacheFile)
+        self.assertTrue(os.path.exists(cacheFile))
+        config2 = evalConfigFile(configPy, cacheFile)
+        self.assertIsNot(config2, config1)
+        self.assertEqual([bs.name for bs in config2.backupSets], ["set1", "set2"])
+        self.assertEqual([bs.name for bs in config2.findBackupPoolBackupSets("zackup2a")], ["set2"])
+        self.assertEqual(str(config2.getBackupSet("set2").schedule), "@daily")
+        self.assertEqual(config2.recordFile, "record1")
+
+        # changed file invalidates cache
+        with open(configPy, "w") as fh:
+            fh.write(self.configPyText.format("record2x"))
+        self.assertEqual(evalConfigFile(configPy, cacheFile).recordFile, "record2x")
+
+        # changed module of a cached class invalidates cache, configPy keeps it's time and size
+        configStat = os.stat(configPy)
+        with open(configPy, "w") as fh:
+            fh.write(self.configPyText.format("record3x"))
+        os.utime(configPy, ns=(configStat.st_atime_ns, configStat.st_mtime_ns))
+        self.assertEqual(evalConfigFile(configPy, cacheFile).recordFile, "record2x")
+        cronPy = sys.modules[CronSchedule.__module__].__file__
+        cronStat = os.stat(cronPy)
+        os.utime(cronPy, ns=(cronStat.st_atime_ns, cronStat.st_mtime_ns + 1000000000))
+        try:
+            self.assertEqual(evalConfigFile(configPy, cacheFile).recordFile, "record3x")
+        finally:
+            os.utime(cronPy, ns=(cronStat.st_atime_ns, cronStat.st_mtime_ns))
+
+        # corrupt cache is ignored
+        with open(cacheFile, "wb") as fh:
+            fh.write(b"junk")
+        self.assertEqual(evalConfigFile(configPy, cacheFile).recordFile, "record3x")
+
+class ZfsInventoryTests(unittest.TestCase):
+    pool1 = ZfsPool("pool1", True, ZfsPoolHealth.ONLINE)
+    pool1Fs1 = fakeZfsFileSystem("pool1/fs1")
+    pool1Fs2 = fakeZfsFileSystem("pool1/fs2")
+    pool2 = ZfsPool("pool2", True, ZfsPoolHealth.ONLINE)
+    pool2Fs1 = fakeZfsFileSystem("pool2/fs1")
+
+    def _mkZfs(self):
+        zfs = ZfsMock()
+        zfs.add(self.pool1, self.pool1Fs1, ("snap1", "snap2"))
+        zfs.add(self.pool1, self.pool1Fs2, ("snap1",))
+        zfs.add(self.pool2, self.pool2Fs1, ("snap3",))
+        return zfs
+
+    def testListSnapshots(self):
+        zfs = self._mkZfs()
+        inventory = ZfsInventory(zfs)
+        self.assertEqual(inventory.listSnapshots("pool1/fs1"), [ZfsSnapshot("pool1/fs1@snap1"), ZfsSnapshot("pool1/fs1@snap2")])
+        self.assertEqual(inventory.listSnapshots(self.pool1Fs2), [ZfsSnapshot("pool1/fs2@snap1")])
+        self.assertEqual(inventory.listSnapshots("pool1/fs3"), [])
+        self.assertEqual(inventory.listSnapshots("pool2/fs1"), [ZfsSnapshot("pool2/fs1@snap3")])
+        self.assertEqual(zfs.queries, ["zfs list -Hpr -t snapshot pool1",
+                                       "zfs list -Hpr -t snapshot pool2"])
+
+    def testAddSnapshot(self):
+        zfs = self._mkZfs()
+        inventory = ZfsInventory(zfs)
+        inventory.addSnapshot("pool2/fs1@snap4")  # not loaded, ignored
+        inventory.loadPool("pool1")
+        inventory.addSnapshot("pool1/fs1@snap3")
+        inventory.addSnapshot("pool1/fs3@snap1")
+        self.assertEqual(inventory.listSnapshots("pool1/fs1"), [ZfsSnapshot("pool1/fs1@snap1"), ZfsSnapshot("pool1/fs1@snap2"), ZfsSnapshot("pool1/fs1@snap3")])
+        self.assertEqual(inventory.listSnapshots("pool1/fs3"), [ZfsSnapshot("pool1/fs3@snap1")])
+        self.assertIsNone(inventory.findSnapshotInfo("pool2/fs1@snap4"))
+        self.assertIsNone(inventory.findSnapshotInfo("pool1/fs1@snap3").guid)
+        inventory.invalidate("pool1")
+        self.assertEqual(inventory.listSnapshots("pool1/fs1"), [ZfsSnapshot("pool1/fs1@snap1"), ZfsSnapshot("pool1/fs1@snap2")])
+
+class StreamLimiterTests(unittest.TestCase):
+    def _runStreams(self, streamLimiter, poolNames):
+        "return maximum number of concurrent streams seen per pool"
+        lock = threading.Lock()
+        active = {}
+        maxActive = {}
+
+        def stream(poolName):
+            with streamLimiter.stream(poolName):
+                with lock:
+                    active[poolName] = active.get(poolName, 0) + 1
+                    maxActive[poolName] = max(maxActive.get(poolName, 0), active[poolName])
+                time.sleep(0.05)
+                with lock:
+                    active[poolName] -= 1
+
+        threads = [threading.Thread(target=stream, args=(poolName,)) for poolName in poolNames]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return maxActive
+
+    def testLimited(self):
+        maxActive = self._runStreams(StreamLimiter(2), ["pool1", "pool1", "pool1", "pool1", "pool2"])
+        self.assertEqual(maxActive, {"pool1": 2, "pool2": 1})
+
+    def testUnlimited(self):
+        maxActive = self._runStreams(StreamLimiter(), ["pool1", "pool1", "pool1"])
+        self.assertEqual(maxActive, {"pool1": 3})
+
+class BufferRelayTests(unittest.TestCase):
+    dataSize = 3 * 1024 * 1024 + 17
+
+    def _pipeline(self, cmd2, relay):
+        "returns the stderr of the two stages"
+        pipeline = Pipeline()
+        pipeline.add(["sh", "-c", "head -c {} /dev/zero".format(self.dataSize)])
+        pipeline.add(cmd2, relay=relay)
+        return tuple([stage.stderr for stage in CmdRunner().runPipeline(pipeline)])
+
+    def testRelay(self):
+        relay = BufferRelay(2 * 1024 * 1024, chunkSize=64 * 1024)
+        stderr1, stderr2 = self._pipeline(["sh", "-c", "wc -c >&2"], relay)
+        self.assertEqual(int(stderr2.strip()), self.dataSize)
+        self.assertEqual(relay.stats.bytes, self.dataSize)
+        self.assertLessEqual(relay.stats.highWater, 2 * 1024 * 1024)
+        self.assertGreater(relay.stats.highWater, 0)
+
+    def testReceiverFails(self):
+        relay = BufferRelay(1024 * 1024, chunkSize=64 * 1024)
+        with self.assertRaisesRegex(PipelineException, "exited 3"):
+            self._pipeline(["sh", "-c", "head -c 10 >/dev/null; exit 3"], relay)
+
+class RateLimitTests(unittest.TestCase):
+    class FakeClock(object):
+        "clock that is advanced by sleeping"
+        def __init__(self):
+            self.now = 0.0
+
+        def clock(self):
+            return self.now
+
+        def sleep(self, secs):
+            self.now += secs
+
+    @staticmethod
+    def _localTime(hhmm):
+        return time.strptime(hhmm, "%H:%M")
+
+    def testSchedule(self):
+        schedule = RateSchedule.parse("08:00-18:00=20M,22:00-06:00=100M")
+        self.assertEqual(schedule.rateAt(self._localTime("07:59")), None)
+        self.assertEqual(schedule.rateAt(self._localTime("08:00")), 20 * 1024 * 1024)
+        self.assertEqual(schedule.rateAt(self._localTime("18:00")), None)
+        self.assertEqual(schedule.rateAt(self._localTime("23:30")), 100 * 1024 * 1024)
+        self.assertEqual(schedule.rateAt(self._localTime("05:59")), 100 * 1024 * 1024)
+        self.assertEqual(str(RateSchedule.parse([("08:00", "18:00", 1000)])), "08:00-18:00=1000")
+        self.assertEqual(RateSchedule.parse("2K").rateAt(self._localTime("12:00")), 2048)
+
+    def testBadConfig(self):
+        for rateLimit in ("08:00-25:00=1M", "fast", "08:00-18:00", 0):
+            with self.assertRaises(BackupConfigError):
+                BackupSetConf("test", (), (), rateLimit=rateLimit)
+
+    def testLimiter(self):
+        fakeClock = self.FakeClock()
+        limiter = RateLimiter("test", RateSchedule.constant(1000), clock=fakeClock.clock, sleep=fakeClock.sleep)
+        waits = [limiter.consume(1000) for i in range(3)]
+        self.assertEqual(waits, [0.0, 1.0, 1.0])  # first is from the burst credit
+        self.assertEqual(limiter.throttleSecs, 2.0)
+        self.assertEqual(limiter.actualRate, 1500.0)
+        limiter.setOverride(None)
+        self.assertEqual(limiter.consume(1000000), 0.0)
+
+    def testControlFile(self):
+        fakeClock = self.FakeClock()
+        with tempfile.NamedTemporaryFile("w", suffix=".rates") as fh:
+            fh.write("# adjusted for the day\nglobal none\ntest 2K\n")
+            fh.flush()
+            control = RateControl(fh.name)
+            globalLimiter = RateLimiter("global", RateSchedule.constant(1000), control, clock=fakeClock.clock)
+            setLimiter = RateLimiter("test", None, control, clock=fakeClock.clock)
+            self.assertTrue(setLimiter.enabled)
+            self.assertEqual((globalLimiter.allowedRate, setLimiter.allowedRate), (1000, None))
+            control.reload()
+            self.assertEqual((globalLimiter.allowedRate, setLimiter.allowedRate), (None, 2048))
+            fh.seek(0)
+            fh.truncate()
+            fh.write("test 3K\n")
+            fh.flush()
+            control.requestReload()
+            control.poll()
+            self.assertEqual((globalLimiter.allowedRate, setLimiter.allowedRate), (1000, 3072))
+
+    def testThrottledRelay(self):
+        waits = []
+        limiter = RateLimiter("test", RateSchedule.constant(1024 * 1024), sleep=waits.append)
+        relay = BufferRelay(1024 * 1024, chunkSize=64 * 1024, rateLimiters=(limiter,))
+        pipeline = Pipeline()
+        pipeline.add(["sh", "-c", "head -c 3145728 /dev/zero"])
+        pipeline.add(["sh", "-c", "wc -c >&2"], relay=relay)
+        self.assertEqual(int(CmdRunner().runPipeline(pipeline)[1].stderr.strip()), 3145728)
+        self.assertEqual(limiter.bytes, 3145728)
+        self.assertGreater(sum(waits), 1.5)  # 3M at 1M/sec, less the burst credit and real time elapsed
+        self.assertAlmostEqual(relay.stats.throttleSecs, sum(waits))
+
+class ProgressTests(unittest.TestCase):
+    class FakeClock(object):
+        def __init__(self):
+            self.now = 100.0
+
+        def __call__(self):
+            return self.now
+
+    def _mkProgressFile(self):
+        fd, progressFile = tempfile.mkstemp(".json", "backup-test." + self.id())
+        os.close(fd)
+        self.addCleanup(os.unlink, progressFile)
+        return progressFile
+
+    def _readProgressFile(self, progressFile):
+        with open(progressFile) as fh:
+            return json.load(fh)["transfers"]
+
+    def testProgressLine(self):
+        self.assertFalse(isSendProgressLine("full\tpool/fs@snap1\t4096\n"))
+        self.assertFalse(isSendProgressLine("size\t4096\n"))
+        self.assertTrue(isSendProgressLine("10:41:04\t4520\tpool/fs@snap1\n"))
+
+    def testSendProgress(self):
+        clock = self.FakeClock()
+        progressFile = self._mkProgressFile()
+        reporter = ProgressReporter(progressFile, clock=clock)
+        progress = reporter.start("pool/fs@snap3")
+        for line in ("incremental\tsnap1\tpool/fs@snap2\t6000\n",
+                     "incremental\tsnap2\tpool/fs@snap3\t4000\n",
+                     "size\t10000\n",
+                     "10:41:04\t3000\tpool/fs@snap2\n",
+                     "10:41:05\t6000\tpool/fs@snap2\n",
+                     "10:41:06\t2000\tpool/fs@snap3\n"):
+            progress.stderrLine(line)
+        clock.now += 4.0
+        self.assertEqual(progress.bytes, 8000)
+        self.assertEqual(progress.estimate, 10000)
+        self.assertEqual(progress.percent, 80.0)
+        self.assertEqual(progress.rate, 2000.0)
+        self.assertEqual(progress.eta, 1.0)
+        self.assertEqual(str(progress), "pool/fs@snap3: 8000 bytes of 10000 (80%), 2000 bytes/sec, ETA 0:00:01")
+        transfers = self._readProgressFile(progressFile)
+        self.assertEqual([(t["name"], t["bytes"], t["estimate"]) for t in transfers],
+                         [("pool/fs@snap3", 8000, 10000)])
+        reporter.finish(progress)
+        self.assertEqual(self._readProgressFile(progressFile), [])
+
+    def testStderrCallback(self):
+        lines = []
+        pipeline = Pipeline()
+        send = pipeline.add(["sh", "-c", "echo one >&2; echo two >&2"], stderrLineCallback=lines.append)
+        pipeline.add(["cat"])
+        CmdRunner().runPipeline(pipeline)
+        self.assertEqual(lines, ["one\n", "two\n"])
+        self.assertEqual(send.stderr, "one\ntwo\n")
+
+    def testStderrFilter(self):
+        lines = []
+        pipeline = Pipeline()
+        send = pipeline.add(["sh", "-c", "printf 'size\\t10\\n10:41:04\\t5\\tpool/fs@snap1\\n' >&2"],
+                            stderrLineCallback=lines.append, stderrLineFilter=lambda line: not isSendProgressLine(line))
+        pipeline.add(["cat"])
+        CmdRunner().runPipeline(pipeline)
+        self.assertEqual(lines, ["size\t10\n", "10:41:04\t5\tpool/fs@snap1\n"])
+        self.assertEqual(send.stderr, "size\t10\n")
+
+    def testBackupProgress(self):
+        GmtTimeFaker.setTime("1988-02-01")
+        zfs = ZfsMock()
+        zfs.add(BackuperTests.srcPool1, BackuperTests.srcPool1Fs1)
+        zfs.add(BackuperTests.backupPool1)
+        recorder = TestBackupRecorder(self.id())
+        reporter = ProgressReporter(clock=self.FakeClock())
+        fsBackup = FsBackup(zfs, recorder, BackuperTests.backupConf1, zfs.getFileSystem("srcPool1/srcPool1Fs1"),
+                            BackuperTests.backupPool1, progressReporter=reporter)
+        fsBackup.backup()
+        self.assertEqual(zfs.actions[-1],
+                         "zfs send -P -v srcPool1/srcPool1Fs1@zipper_1988-02-01T00:00:00_testBackupSet | zfs receive -s -F backupPool1/srcPool1/srcPool1Fs1@zipper_1988-02-01T00:00:00_testBackupSet")
+        self.assertEqual(reporter.active, [])
+        del recorder
+
+class PipelineTests(unittest.TestCase):
+    def testStages(self):
+        pipeline = Pipeline()
+        pipeline.add(["sh", "-c", "echo one two; echo start >&2"])
+        pipeline.add(["tr", "a-z", "A-Z"])
+        pipeline.add(["sh", "-c", "cat >&2"])
+        stages = CmdRunner().runPipeline(pipeline)
+        self.assertEqual([s.returncode for s in stages], [0, 0, 0])
+        self.assertEqual([s.stderr for s in stages], ["start\n", "", "ONE TWO\n"])
+        self.assertTrue(all(s.rusage is not None for s in stages))
+
+    def testFailureTerminates(self):
+        pipeline = Pipeline()
+        pipeline.add(["sleep", "60"])
+        pipeline.add(["sh", "-c", "exit 2"])
+        pipeline.add(["sleep", "60"])
+        startTime = time.time()
+        with self.assertRaises(PipelineException) as cm:
+            CmdRunner().runPipeline(pipeline)
+        self.assertLess(time.time() - startTime, 30)
+        sleep1, fail, sleep2 = cm.exception.stages
+        self.assertEqual((fail.returncode, fail.terminated), (2, False))
+        self.assertEqual((sleep1.returncode, sleep1.terminated), (-signal.SIGTERM, True))
+        self.assertEqual((sleep2.returncode, sleep2.terminated), (-signal.SIGTERM, True))
+        self.assertEqual(str(cm.exception), "sh -c exit 2 exited 2: \nterminated: sleep 60\nterminated: sleep 60")
+
+    def testStartFailure(self):
+        pipeline = Pipeline()
+        send = pipeline.add(["sh", "-c", "head -c 1048576 /dev/zero"])
+        relay = BufferRelay(64 * 1024)
+        pipeline.add(["cat"], relay=relay)
+        pipeline.add(["/nonexistent/zfszipper-test"])
+        with self.assertRaises(FileNotFoundError):
+            CmdRunner().runPipeline(pipeline)
+        self.assertTrue(all([not thread.is_alive() for thread in relay._threads]))
+        self.assertTrue(send.proc.stdout.closed)
+
+    def testNoWaitid(self):
+        waitid = os.waitid
+        del os.waitid
+        try:
+            pipeline = Pipeline()
+            pipeline.add(["sleep", "60"])
+            pipeline.add(["sh", "-c", "sleep 0.2; exit 2"])
+            with self.assertRaises(PipelineException) as cm:
+                CmdRunner().runPipeline(pipeline)
+        finally:
+            os.waitid = waitid
+        sleep1, fail = cm.exception.stages
+        self.assertEqual((fail.returncode, fail.terminated), (2, False))
+        self.assertEqual((sleep1.returncode, sleep1.terminated), (-signal.SIGTERM, True))
+        self.assertIsNotNone(sleep1.rusage)
+
+    def testCallAsync(self):
+        async def callAll(cmdRunner):
+            return await asyncio.gather(*[cmdRunner.callTabSplitAsync(["sh", "-c", "sleep 0.5; printf '{}\\ta\\n'".format(i)])
+                                          for i in range(4)])
+        startTime = time.monotonic()
+        self.assertEqual(asyncio.run(callAll(CmdRunner())), [[[str(i), "a"]] for i in range(4)])
+        self.assertLess(time.monotonic() - startTime, 1.5)
+        with self.assertRaisesRegex(ProcessError, "^sh -c echo oops >&2; exit 3 exited 3: oops"):
+            asyncio.run(CmdRunner().callAsync(["sh", "-c", "echo oops >&2; exit 3"]))
+
+class StderrCollectorTests(unittest.TestCase):
+    def _collect(self, numLines, **kwargs):
+        proc = subprocess.Popen(["seq", str(numLines)], stdout=subprocess.PIPE, encoding="utf-8")
+        collector = StderrCollector(proc.stdout, **kwargs)
+        proc.wait()
+        return collector.wait()
+
+    def testShort(self):
+        self.assertEqual(self._collect(3, maxHeadLines=2, maxTailLines=2), "1\n2\n3\n")
+
+    def testBounded(self):
+        self.assertEqual(self._collect(100000, maxHeadLines=2, maxTailLines=3),
+                         "1\n2\n[99995 lines omitted]\n99998\n99999\n100000\n")
+
+    def testProcessError(self):
+        pipeline = Pipeline()
+        pipeline.add(["sh", "-c", "seq 2000 >&2; exit 1"])
+        pipeline.add(["cat"])
+        with self.assertRaises(PipelineException) as cm:
+            CmdRunner().runPipeline(pipeline)
+        stderr = cm.exception.stages[0].stderr
+        self.assertEqual(stderr.count("\n"), 601)
+        self.assertIn("[1400 lines omitted]\n", stderr)
 
 def suite():
     suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ZfsParseTests))
     suite.addTest(unittest.makeSuite(BackupSnapshotTests))
     suite.addTest(unittest.makeSuite(BackuperTests))
+    suite.addTest(unittest.makeSuite(ZfsInventoryTests))
+    suite.addTest(unittest.makeSuite(ZfsCacheTests))
+    suite.addTest(unittest.makeSuite(StreamLimiterTests))
+    suite.addTest(unittest.makeSuite(BufferRelayTests))
+    suite.addTest(unittest.makeSuite(ProgressTests))
+    suite.addTest(unittest.makeSuite(StderrCollectorTests))
+    suite.addTest(unittest.makeSuite(PipelineTests))
+    suite.addTest(unittest.makeSuite(RateLimitTests))
+    suite.addTest(unittest.makeSuite(SshTransportTests))
+    suite.addTest(unittest.makeSuite(DaemonTests))
+    suite.addTest(unittest.makeSuite(PoolWatcherTests))
+    suite.addTest(unittest.makeSuite(ResourceLocksTests))
+    suite.addTest(unittest.makeSuite(ConfigTests))
+    suite.addTest(unittest.makeSuite(PoolImportTests))
     return suite
 
 if __name__ == '__main__':
@@ -0,0 +1,37 @@
+"""
+Mock CmdRunner object, returns pre-configured output for commands and records
+all commands that are run.  Used to test the real Zfs object.
+"""
+from zfszipper.cmdrunner import ProcessError
+
+class CmdRunnerMock(object):
+    def __init__(self):
+        self.responses = {}  # tuple of cmd -> list of lines
+        self.cmds = []
+
+    def addResponse(self, cmd, lines):
+        "lines are a list of strings, with tab separated columns"
+        self.responses[tuple(cmd)] = list(lines)
+
+    def addError(self, cmd, stderr):
+        "command will raise a ProcessError"
+        self.responses[tuple(cmd)] = ProcessError(1, cmd, stderr)
+
+    def _getResponse(self, cmd):
+        response = self.responses.get(tuple(cmd), [])
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def call(self, cmd):
+        self.cmds.append(" ".join(cmd))
+        return list(self._getResponse(cmd))
+
+    def callTabSplit(self, cmd):
+        return [l.split("\t") for l in self.call(cmd)]
+
+    async def callAsync(self, cmd):
+        return self.call(cmd)
+
+    async def callTabSplitAsync(self, cmd):
+        return self.callTabSplit(cmd)
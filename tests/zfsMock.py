@@ -2,9 +2,10 @@
 Mock Zfs object, returns pre-configured values for queries and logs action commands
 """
 import sys
-from zfszipper.zfs import ZfsPool, ZfsFileSystem, ZfsSnapshot
-from collections import OrderedDict
+from zfszipper.zfs import ZfsPool, ZfsFileSystem, ZfsSnapshot, ZfsSnapshotInfo, ZfsName
+from collections import OrderedDict, namedtuple, defaultdict
 from zfszipper.typeOps import asNameOrStr
+from zfszipper.cmdrunner import ProcessError
 
 def zfsSnapshotNameToFileSystemName(snapshotSpec):
     "convert a zfs snapshot name to a file system name"
@@ -64,10 +65,20 @@ class ZfsMockNode(object):
     def getChildEntries(self):
         return [n.entry for n in self.children.values()]
 
+class ZfsMockResume(namedtuple("ZfsMockResume", ("token", "sourceBaseSnapshotName", "sourceSnapshotName"))):
+    "saved state of an interrupted receive, sourceBaseSnapshotName is None for a full"
+    __slots__ = ()
+
 class ZfsMock(object):
     def __init__(self):
         self.root = ZfsMockNode(None)
+        self.exported = OrderedDict()  # pool name -> node of exported pool
         self.actions = []
+        self.queries = []  # only recorded for some queries
+        self.resumeTokens = {}  # backup file system name -> ZfsMockResume
+        self.intProps = {}  # (name, property) -> int, see getIntProp
+        self.exportBusyCount = 0  # number of clean exports to fail as busy
+        self.exportError = None  # if not None, stderr of failing exports
 
     def add(self, pool, fileSystem=None, snapshotSpecs=()):
         """Add pool, filesystem and snapshots to a ZfsMock, Adding the pool
@@ -105,6 +116,9 @@ class ZfsMock(object):
     def _recordAction(self, *args):
         self.actions.append(" ".join(args))
 
+    def _recordQuery(self, *args):
+        self.queries.append(" ".join(args))
+
     def dump(self, fh=sys.stderr):
         for poolNode in self.root.children.values():
             print("pool:", poolNode.entry.name, file=fh)
@@ -167,14 +181,52 @@ class ZfsMock(object):
         return [n.entry for n in self.root.children.values()]
 
     def findPool(self, poolName):
-        node = self.root.getChildNode(poolName)
+        node = self.root.findChildNode(poolName)
         return node.entry if node is not None else None
 
+    def invalidateListings(self):
+        pass
+
+    def listExportedPools(self):
+        return [n.entry for n in self.exported.values()]
+
+    def importPool(self, poolSpec):
+        poolName = asNameOrStr(poolSpec)
+        node = self.exported.pop(poolName)
+        node.entry = node.entry._replace(imported=True)
+        self.root.children[poolName] = node
+        self._recordAction("zpool", "import", poolName)
+
+    def exportPool(self, poolSpec, *, force=False):
+        poolName = asNameOrStr(poolSpec)
+        cmd = ("zpool", "export") + (("-f",) if force else ()) + (poolName,)
+        if self.exportError is not None:
+            self._recordQuery(*cmd)
+            raise ProcessError(1, cmd, self.exportError)
+        if (not force) and (self.exportBusyCount > 0):
+            self.exportBusyCount -= 1
+            self._recordQuery(*cmd)
+            raise ProcessError(1, cmd, "cannot export '{}': pool is busy".format(poolName))
+        node = self.root.getChildNode(poolName)
+        self.root.delChildNodeByName(poolName)
+        node.entry = node.entry._replace(imported=False)
+        self.exported[poolName] = node
+        self._recordAction(*cmd)
+
     def listSnapshots(self, fileSystemSpec):
         "parameters can be names or zfs objects"
+        self._recordQuery("zfs", "list", "-Hd", "1", "-t", "snapshot", asNameOrStr(fileSystemSpec))
         fsNode = self._getFileSystemNodeByName(asNameOrStr(fileSystemSpec))
         return fsNode.getChildEntries()
 
+    def listPoolSnapshots(self, poolSpec):
+        "parameter can be names or zfs object, properties are not set"
+        self._recordQuery("zfs", "list", "-Hpr", "-t", "snapshot", asNameOrStr(poolSpec))
+        poolNode = self.root.getChildNode(asNameOrStr(poolSpec))
+        return [ZfsSnapshotInfo(snapNode.entry, None, None, None, None)
+                for fsNode in poolNode.children.values()
+                for snapNode in fsNode.children.values()]
+
     def listFileSystems(self, poolSpec):
         "parameter can be names or zfs object"
         self._notImplemented()
@@ -199,9 +251,17 @@ class ZfsMock(object):
         return fsNode.entry
 
     def createSnapshot(self, snapshotSpec):
-        fsNode = self._findFileSystemNodeFromSnapshotName(snapshotSpec)
-        fsNode.addChildNode(ZfsSnapshot(snapshotSpec))
-        self._recordAction("zfs", "snapshot", snapshotSpec)
+        self.createSnapshots([snapshotSpec])
+
+    def createSnapshots(self, snapshotSpecs):
+        snapshotNamesByPool = defaultdict(list)
+        for snapshotSpec in snapshotSpecs:
+            snapshotName = asNameOrStr(snapshotSpec)
+            fsNode = self._findFileSystemNodeFromSnapshotName(snapshotName)
+            fsNode.addChildNode(ZfsSnapshot(snapshotName))
+            snapshotNamesByPool[ZfsName(snapshotName).pool].append(snapshotName)
+        for snapshotNames in snapshotNamesByPool.values():
+            self._recordAction("zfs", "snapshot", *snapshotNames)
 
     def destroySnapshot(self, snapshotSpec):
         snapshotName = asNameOrStr(snapshotSpec)
@@ -218,11 +278,22 @@ class ZfsMock(object):
         fsNode.addChildNode(newSnapshot)
         self._recordAction("zfs", "rename", oldSnapshot.name, newSnapshot.name)
 
-    def _recordSendRecv(self, sendCmd, recvCmd):
+    def _recordSendRecv(self, sendCmd, recvCmd, progress=None):
+        "send -v is used with progress"
+        if progress is not None:
+            sendCmd = sendCmd[0:3] + ["-v"] + sendCmd[3:]
         cmd = sendCmd + ["|"] + recvCmd
         self._recordAction(*cmd)
 
-    def sendRecvFull(self, sourceSnapshotSpec, backupSnapshotSpec):
+    @staticmethod
+    def _reportProgress(progress, snapshotName, size):
+        "generate zfs send -P -v lines"
+        if progress is not None:
+            progress.stderrLine("size\t{}\n".format(size))
+            progress.stderrLine("00:00:01\t{}\t{}\n".format(size // 2, snapshotName))
+            progress.stderrLine("00:00:02\t{}\t{}\n".format(size, snapshotName))
+
+    def sendRecvFull(self, sourceSnapshotSpec, backupSnapshotSpec, *, sendOptions=(), relay=None, progress=None):
         # parse to check if they are valid
         sourceSnapshotName = asNameOrStr(sourceSnapshotSpec)
         backupSnapshotName = asNameOrStr(backupSnapshotSpec)
@@ -233,17 +304,18 @@ class ZfsMock(object):
         if self._findSnapshotByName(backupSnapshotName):
             raise Exception("sendRecvFull backup snapshot already exists: {}", backupSnapshotName)
 
-        sendCmd = ["zfs", "send", "-P", sourceSnapshotName]
-        recvCmd = ["zfs", "receive", '-F']
+        sendCmd = ["zfs", "send", "-P"] + list(sendOptions) + [sourceSnapshotName]
+        recvCmd = ["zfs", "receive", "-s", "-F"]
         backupFsName = zfsSnapshotNameToFileSystemName(backupSnapshotName)
         if self._findFileSystemNodeByName(backupFsName) is None:
             self._addFileSystemByName(backupFsName)
         recvCmd.append(backupSnapshotName)
         self._addSnapshotByName(backupSnapshotName)
-        self._recordSendRecv(sendCmd, recvCmd)
+        self._recordSendRecv(sendCmd, recvCmd, progress)
+        self._reportProgress(progress, sourceSnapshotName, 50000)
         return (("full", sourceSnapshotName, "50000"), ("size", "50000"))
 
-    def sendRecvIncr(self, sourceBaseSnapshotSpec, sourceSnapshotSpec, backupSnapshotSpec):
+    def sendRecvIncr(self, sourceBaseSnapshotSpec, sourceSnapshotSpec, backupSnapshotSpec, *, sendOptions=(), relay=None, progress=None):
         # parse to check if they are valid, check that base exists in backup
         sourceBaseSnapshotName = asNameOrStr(sourceBaseSnapshotSpec)
         sourceSnapshotName = asNameOrStr(sourceSnapshotSpec)
@@ -263,8 +335,86 @@ class ZfsMock(object):
             raise Exception("sendRecvIncr incremental base send snapshot for {} does not exist in received file system {}".format(backupBaseSnapshot.name, backupSnapshot.fileSystem))
         if sourceSnapshot.snapName <= sourceBaseSnapshot.snapName:
             raise Exception("sendRecvIncr incremental send snapshot {} is earlier than base {}".format(sourceSnapshot.name, sourceBaseSnapshot.name))
-        sendCmd = ["zfs", "send", "-P", "-i", sourceBaseSnapshotName, sourceSnapshotName]
-        recvCmd = ["zfs", "receive", backupSnapshotName]
+        sendCmd = ["zfs", "send", "-P"] + list(sendOptions) + ["-i", sourceBaseSnapshotName, sourceSnapshotName]
+        recvCmd = ["zfs", "receive", "-s", backupSnapshotName]
         self._addSnapshotByName(backupSnapshotName)
-        self._recordSendRecv(sendCmd, recvCmd)
+        self._recordSendRecv(sendCmd, recvCmd, progress)
+        self._reportProgress(progress, sourceSnapshotName, 50000)
         return (("incremental", sourceBaseSnapshotName, sourceSnapshotName, "50000"), ("size", "50000"))
+
+    def sendRecvIncrRange(self, sourceBaseSnapshotSpec, sourceSnapshotSpec, backupFileSystemSpec, *, sendOptions=(), relay=None, progress=None):
+        "all source snapshots after the base through the source snapshot are received"
+        sourceBaseSnapshotName = asNameOrStr(sourceBaseSnapshotSpec)
+        sourceSnapshotName = asNameOrStr(sourceSnapshotSpec)
+        backupFileSystemName = asNameOrStr(backupFileSystemSpec)
+        sourceBaseSnapshot = ZfsSnapshot(sourceBaseSnapshotName)
+        if not self._findSnapshotByName(ZfsSnapshot.factory(backupFileSystemName, sourceBaseSnapshot.snapName)):
+            raise Exception("sendRecvIncrRange incremental base send snapshot for {} does not exist in received file system {}".format(sourceBaseSnapshotName, backupFileSystemName))
+        sourceSnapshotNames = [s.name for s in self._getFileSystemNodeFromSnapshotName(sourceBaseSnapshotName).getChildEntries()]
+        sourceSnapshotNames = sourceSnapshotNames[sourceSnapshotNames.index(sourceBaseSnapshotName):sourceSnapshotNames.index(sourceSnapshotName) + 1]
+        if len(sourceSnapshotNames) < 2:
+            raise Exception("sendRecvIncrRange incremental send snapshot {} is not later than base {}".format(sourceSnapshotName, sourceBaseSnapshotName))
+        rows = []
+        for fromName, toName in zip(sourceSnapshotNames[0:-1], sourceSnapshotNames[1:]):
+            self._addSnapshotByName(ZfsSnapshot.factory(backupFileSystemName, ZfsSnapshot(toName).snapName))
+            rows.append(("incremental", ZfsSnapshot(fromName).snapName, toName, "30000"))
+        self._recordSendRecv(["zfs", "send", "-P"] + list(sendOptions) + ["-I", sourceBaseSnapshotName, sourceSnapshotName],
+                             ["zfs", "receive", "-s", "-F", backupFileSystemName], progress)
+        return tuple(rows) + (("size", str(30000 * len(rows))),)
+
+    def addResumeToken(self, backupFileSystemName, token, sourceSnapshotName, sourceBaseSnapshotName=None):
+        "simulate an interrupted receive"
+        self.resumeTokens[backupFileSystemName] = ZfsMockResume(token, sourceBaseSnapshotName, sourceSnapshotName)
+
+    def getResumeToken(self, fileSystemSpec):
+        resume = self.resumeTokens.get(asNameOrStr(fileSystemSpec))
+        return resume.token if resume is not None else None
+
+    def _findResume(self, resumeToken):
+        for resume in self.resumeTokens.values():
+            if resume.token == resumeToken:
+                return resume
+        raise Exception("unknown resume token {}".format(resumeToken))
+
+    @staticmethod
+    def _resumeRows(resume):
+        if resume.sourceBaseSnapshotName is None:
+            sendInfo = ("full", resume.sourceSnapshotName, "20000")
+        else:
+            sendInfo = ("incremental", ZfsSnapshot(resume.sourceBaseSnapshotName).snapName, resume.sourceSnapshotName, "20000")
+        return (("resume token contents:",), ("nvlist version: 0",), ("", "toname = " + resume.sourceSnapshotName),
+                sendInfo, ("size", "20000"))
+
+    def getResumeTokenInfo(self, resumeToken):
+        self._recordQuery("zfs", "send", "-nP", "-t", resumeToken)
+        return self._resumeRows(self._findResume(resumeToken))
+
+    def sendRecvResume(self, resumeToken, backupFileSystemSpec, *, relay=None, progress=None):
+        backupFileSystemName = asNameOrStr(backupFileSystemSpec)
+        resume = self.resumeTokens.pop(backupFileSystemName)
+        if resume.token != resumeToken:
+            raise Exception("sendRecvResume token {} doesn't match {}".format(resumeToken, resume.token))
+        sourceSnapshot = ZfsSnapshot(resume.sourceSnapshotName)
+        self._addSnapshotByName(ZfsSnapshot.factory(backupFileSystemName, sourceSnapshot.snapName).name)
+        self._recordSendRecv(["zfs", "send", "-P", "-t", resumeToken], ["zfs", "receive", "-s", backupFileSystemName], progress)
+        return self._resumeRows(resume)
+
+    def estimateSendFull(self, sourceSnapshotName, *, sendOptions=()):
+        self._recordQuery(*(["zfs", "send", "-nP"] + list(sendOptions) + [sourceSnapshotName]))
+        return self.intProps.get((sourceSnapshotName, "send"), 40000)
+
+    def estimateSendIncr(self, sourceBaseSnapshotName, sourceSnapshotName, *, sendOptions=(), intermediate=False):
+        self._recordQuery(*(["zfs", "send", "-nP"] + list(sendOptions) + ["-I" if intermediate else "-i", sourceBaseSnapshotName, sourceSnapshotName]))
+        return self.intProps.get((sourceSnapshotName, "send"), 40000)
+
+    def getIntProp(self, spec, name):
+        """properties are obtained from intProps, the pool available property defaults
+        to 1T, others to 10000.  Estimated send size of snapshots can be set with
+        the property name `send'."""
+        self._recordQuery("zfs", "get", "-Hp", "-o", "value", name, asNameOrStr(spec))
+        return self.intProps.get((asNameOrStr(spec), name), 1024 ** 4 if name == "available" else 10000)
+
+    def abortResume(self, backupFileSystemSpec):
+        backupFileSystemName = asNameOrStr(backupFileSystemSpec)
+        del self.resumeTokens[backupFileSystemName]
+        self._recordAction("zfs", "receive", "-A", backupFileSystemName)